@@ -1,17 +1,21 @@
-import io
-import json
+import functools
 import logging
 import mimetypes
 import os
+import tempfile
+import time
 from pathlib import Path
-from typing import AsyncGenerator
+from typing import Any, AsyncGenerator, AsyncIterator, Optional, Union
 
-from azure.core.exceptions import ResourceNotFoundError
+import httpx
+import openai
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
 from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
 from azure.monitor.opentelemetry import configure_azure_monitor
 from azure.search.documents.aio import SearchClient
-from azure.storage.blob.aio import BlobServiceClient
-from openai import APIError, AsyncAzureOpenAI, AsyncOpenAI
+from azure.storage.blob.aio import BlobServiceClient, StorageStreamDownloader
+from openai import APIError, AsyncAzureOpenAI, AsyncOpenAI, RateLimitError
 from opentelemetry.instrumentation.aiohttp_client import AioHttpClientInstrumentor
 from opentelemetry.instrumentation.asgi import OpenTelemetryMiddleware
 from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
@@ -23,26 +27,52 @@ from quart import (
     jsonify,
     make_response,
     request,
-    send_file,
     send_from_directory,
 )
 from quart_cors import cors
 
+from approaches.approach import Approach
 from approaches.chatreadretrieveread import ChatReadRetrieveReadApproach
 from approaches.retrievethenread import RetrieveThenReadApproach
+from core import metrics
+from core.admission import AdmissionController, AdmissionRejectedError
+from core.answercache import AnswerCache, SemanticCache
 from core.authentication import AuthenticationHelper
+from core.blobcache import BlobCache, CachedBlob
+from core.coalescer import RequestCoalescer
+from core.embeddingcache import EmbeddingCache
+from core.framing import DeltaCoalescer
+from core.openaipool import OpenAIEndpoint, OpenAIPoolTransport, parse_endpoints
+from core.pdfpages import PageOutOfRangeError, PdfPageCache
+from core.ratelimit import RateLimitedTransport, SharedRateLimiter
+from core.readiness import Readiness
+from core.serialization import JSONProvider, dumps
+from core.tokencounter import load_encodings, use_bundled_cache
 
 CONFIG_ASK_APPROACH = "ask_approach"
 CONFIG_CHAT_APPROACH = "chat_approach"
 CONFIG_BLOB_CONTAINER_CLIENT = "blob_container_client"
+CONFIG_BLOB_CACHE = "blob_cache"
+CONFIG_PDF_PAGE_CACHE = "pdf_page_cache"
+CONFIG_ANSWER_CACHE = "answer_cache"
+CONFIG_SEMANTIC_CACHE = "semantic_cache"
+CONFIG_EMBEDDING_CACHE = "embedding_cache"
+CONFIG_REQUEST_COALESCER = "request_coalescer"
+CONFIG_ADMISSION_CONTROLLER = "admission_controller"
+CONFIG_ASK_BATCH_MAX_QUESTIONS = "ask_batch_max_questions"
+CONFIG_DELTA_COALESCER = "delta_coalescer"
+CONFIG_READINESS = "readiness"
 CONFIG_AUTH_CLIENT = "auth_client"
 CONFIG_SEARCH_CLIENT = "search_client"
 CONFIG_OPENAI_CLIENT = "openai_client"
+BLOB_DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_PAGES_AROUND = 5
 ERROR_MESSAGE = """The app encountered an error processing your request.
 If you are an administrator of the app, view the full error in the logs. See aka.ms/appservice-logs for more information.
 Error type: {error_type}
 """
 ERROR_MESSAGE_FILTER = """Your message contains content that was flagged by the OpenAI content filter."""
+ERROR_MESSAGE_BUSY = """The app is handling too many requests right now. Please try again in a few seconds."""
 
 bp = Blueprint("routes", __name__, static_folder="static")
 # Fix Windows registry issue with mimetypes
@@ -74,29 +104,138 @@ async def assets(path):
 
 # Serve content files from blob storage from within the app to keep the example self-contained.
 # *** NOTE *** this assumes that the content files are public, or at least that all users of the app
-# can access all the files. This is also slow and memory hungry.
+# can access all the files. Blobs are streamed to the client chunk by chunk, and small blobs are cached locally once
+# they have been streamed whole. Single byte ranges are honored so that PDF viewers can fetch only the parts they need.
 @bp.route("/content/<path>")
 async def content_file(path: str):
     # Remove page number from path, filename-1.txt -> filename.txt
     if path.find("#page=") > 0:
         path_parts = path.rsplit("#page=", 1)
         path = path_parts[0]
-    logging.info("Opening file %s at page %s", path)
+    logging.info("Opening file %s", path)
+    # Serve only the cited page of a PDF, optionally with its neighbours, for example /content/file.pdf?page=3
+    page = request.args.get("page", type=int)
+    if page is not None and path.lower().endswith(".pdf"):
+        pages_around = min(max(request.args.get("pages_around", 0, type=int), 0), MAX_PAGES_AROUND)
+        return await send_pdf_pages(path, page, pages_around)
+    # Only a single explicit byte range is honored, anything else (multiple or suffix ranges) gets the whole file
+    byte_range = None
+    if request.range and request.range.units == "bytes" and len(request.range.ranges) == 1:
+        if request.range.ranges[0][0] >= 0:
+            byte_range = request.range.ranges[0]
+    blob_cache: BlobCache = current_app.config[CONFIG_BLOB_CACHE]
+    try:
+        cached_blob = await blob_cache.get(path)
+    except ResourceNotFoundError:
+        logging.exception("Path not found: %s", path)
+        abort(404)
+    if cached_blob is not None:
+        if (response := await send_cached_blob(blob_cache, cached_blob, byte_range)) is not None:
+            return response
+        # The blob was evicted from the cache after it was looked up, so it's streamed from storage
+
     blob_container_client = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT]
+    blob_client = blob_container_client.get_blob_client(path)
+    offset, length = None, None
+    if byte_range is not None:
+        offset, length = byte_range[0], (byte_range[1] - byte_range[0] if byte_range[1] is not None else None)
     try:
-        blob = await blob_container_client.get_blob_client(path).download_blob()
+        blob = await blob_client.download_blob(offset=offset, length=length)
     except ResourceNotFoundError:
         logging.exception("Path not found: %s", path)
         abort(404)
+    except HttpResponseError as error:
+        if error.status_code != 416:
+            raise
+        properties = await blob_client.get_blob_properties()
+        return "", 416, {"Content-Range": f"bytes */{properties.size}"}
     if not blob.properties or not blob.properties.has_key("content_settings"):
         abort(404)
-    mime_type = blob.properties["content_settings"]["content_type"]
-    if mime_type == "application/octet-stream":
-        mime_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
-    blob_file = io.BytesIO()
-    await blob.readinto(blob_file)
-    blob_file.seek(0)
-    return await send_file(blob_file, mimetype=mime_type, as_attachment=False, attachment_filename=path)
+    headers = {"Accept-Ranges": "bytes", "Content-Length": str(blob.size)}
+    status_code = 200
+    if offset is not None:
+        status_code = 206
+        # The downloader reports the ranged size, the total blob size is kept at the end of the content range
+        blob_size = blob.properties.content_range.rsplit("/", 1)[1]
+        headers["Content-Range"] = f"bytes {offset}-{offset + blob.size - 1}/{blob_size}"
+    # Small blobs are cached once they have been sent whole, byte ranges are only streamed
+    chunks = stream_blob(blob) if offset is not None else blob_cache.stream(path, blob)
+    response = await make_response(chunks, status_code, headers)
+    response.timeout = None  # type: ignore
+    if blob.properties.etag:
+        response.set_etag(blob.properties.etag.strip('"'))
+    response.mimetype = get_mime_type(path, blob.properties["content_settings"]["content_type"])
+    return response
+
+
+async def send_cached_blob(
+    blob_cache: BlobCache, cached_blob: CachedBlob, byte_range: Optional[tuple[int, Optional[int]]]
+):
+    etag = cached_blob.etag.strip('"')
+    if request.if_none_match.contains(etag):
+        response = await make_response("", 304)
+        response.set_etag(etag)
+        return response
+    headers = {"Accept-Ranges": "bytes"}
+    status_code = 200
+    start, stop = 0, cached_blob.size
+    if byte_range is not None:
+        if byte_range[0] >= cached_blob.size:
+            return "", 416, {"Content-Range": f"bytes */{cached_blob.size}"}
+        start, stop = byte_range[0], min(byte_range[1] or cached_blob.size, cached_blob.size)
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{cached_blob.size}"
+    content = await blob_cache.read(cached_blob, start, stop)
+    if content is None:
+        return None
+    response = await make_response(content, status_code, headers)
+    response.set_etag(etag)
+    response.mimetype = get_mime_type(cached_blob.path, cached_blob.content_type)
+    return response
+
+
+async def send_pdf_pages(path: str, page: int, pages_around: int):
+    blob_cache: BlobCache = current_app.config[CONFIG_BLOB_CACHE]
+    pdf_page_cache: PdfPageCache = current_app.config[CONFIG_PDF_PAGE_CACHE]
+    blob_client = current_app.config[CONFIG_BLOB_CONTAINER_CLIENT].get_blob_client(path)
+    try:
+        cached_blob = await blob_cache.get(path)
+        etag = cached_blob.etag if cached_blob is not None else (await blob_client.get_blob_properties()).etag
+    except ResourceNotFoundError:
+        logging.exception("Path not found: %s", path)
+        abort(404)
+    pages_etag = etag.strip('"') + f"-{page}-{pages_around}"
+    if request.if_none_match.contains(pages_etag):
+        response = await make_response("", 304)
+        response.set_etag(pages_etag)
+        return response
+    content = pdf_page_cache.get(path, etag, page, pages_around)
+    if content is None:
+        pdf = await blob_cache.read(cached_blob) if cached_blob is not None else None
+        if pdf is None:
+            blob = await blob_client.download_blob(etag=etag, match_condition=MatchConditions.IfNotModified)
+            pdf = await blob.readall()
+            await blob_cache.add(path, etag, blob.properties.content_settings.content_type, pdf)
+        try:
+            content = await pdf_page_cache.extract(path, etag, pdf, page, pages_around)
+        except PageOutOfRangeError:
+            logging.exception("Page %d not found in %s", page, path)
+            abort(404)
+    response = await make_response(content)
+    response.set_etag(pages_etag)
+    response.mimetype = "application/pdf"
+    return response
+
+
+def get_mime_type(path: str, content_type: Optional[str]) -> str:
+    if content_type and content_type != "application/octet-stream":
+        return content_type
+    return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+
+async def stream_blob(blob: StorageStreamDownloader) -> AsyncGenerator[bytes, None]:
+    async for chunk in blob.chunks():
+        yield chunk
 
 
 def error_dict(error: Exception) -> dict:
@@ -105,65 +244,183 @@ def error_dict(error: Exception) -> dict:
     return {"error": ERROR_MESSAGE.format(error_type=type(error))}
 
 
+def busy_response(error: AdmissionRejectedError):
+    return jsonify({"error": ERROR_MESSAGE_BUSY}), 429, {"Retry-After": str(error.retry_after)}
+
+
 def error_response(error: Exception, route: str, status_code: int = 500):
     logging.exception("Exception in %s: %s", route, error)
     if isinstance(error, APIError) and error.code == "content_filter":
         status_code = 400
+    elif isinstance(error, RateLimitError):
+        status_code = 429
     return jsonify(error_dict(error)), status_code
 
 
+async def run_approach(
+    route: str, approach: Approach, request_json: dict, context: dict, stream: bool = False
+) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
+    messages = request_json["messages"]
+    session_state = request_json.get("session_state")
+    coalescer: Optional[RequestCoalescer] = current_app.config[CONFIG_REQUEST_COALESCER]
+    if coalescer is None:
+        return await approach.run(messages, stream=stream, context=context, session_state=session_state)
+
+    # Identical concurrent requests share one execution, and only differ by their session state
+    overrides = context.get("overrides", {})
+    key = RequestCoalescer.make_key(
+        route, messages, overrides, approach.build_filter(overrides, context["auth_claims"]), stream
+    )
+    run = functools.partial(approach.run, messages, stream=stream, context=context, session_state=session_state)
+    if stream:
+        return set_session_state(coalescer.stream(key, run), session_state)
+    result = await coalescer.run(key, run)
+    result["choices"][0]["session_state"] = session_state
+    return result
+
+
+async def set_session_state(
+    events: AsyncIterator[dict[str, Any]], session_state: Any
+) -> AsyncGenerator[dict[str, Any], None]:
+    async for event in events:
+        if event.get("choices") and "session_state" in event["choices"][0]:
+            event["choices"][0]["session_state"] = session_state
+        yield event
+
+
 @bp.route("/ask", methods=["POST"])
 async def ask():
+    return await handle_approach_request("/ask", CONFIG_ASK_APPROACH)
+
+
+@bp.route("/ask/batch", methods=["POST"])
+async def ask_batch():
     if not request.is_json:
         return jsonify({"error": "request must be json"}), 415
     request_json = await request.get_json()
+    questions = request_json.get("questions")
+    if not isinstance(questions, list) or not all(isinstance(question, str) for question in questions):
+        return jsonify({"error": "questions must be a list of strings"}), 400
+    if len(questions) > current_app.config[CONFIG_ASK_BATCH_MAX_QUESTIONS]:
+        return jsonify({"error": "too many questions"}), 400
     context = request_json.get("context", {})
     auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
     context["auth_claims"] = await auth_helper.get_auth_claims_if_enabled(request.headers)
+    # A batch takes a single slot, and bounds its own concurrency against the OpenAI and AI Search services
+    admission_controller = current_app.config[CONFIG_ADMISSION_CONTROLLER]
+    started_at = metrics.start_request("/ask/batch")
     try:
-        approach = current_app.config[CONFIG_ASK_APPROACH]
-        r = await approach.run(
-            request_json["messages"], context=context, session_state=request_json.get("session_state")
-        )
-        return jsonify(r)
-    except Exception as error:
-        return error_response(error, "/ask")
+        await admission_controller.acquire()
+    except AdmissionRejectedError as error:
+        metrics.finish_request("/ask/batch", 429, started_at)
+        return busy_response(error)
+    admitted_at = time.monotonic()
+    approach: RetrieveThenReadApproach = current_app.config[CONFIG_ASK_APPROACH]
+    results = admission_controller.hold(format_batch_results(approach.run_batch(questions, context)), admitted_at)
+    response = await make_response(format_as_ndjson(metrics.track_stream("/ask/batch", results, started_at)))
+    response.timeout = None  # type: ignore
+    response.mimetype = "application/json-lines"
+    return response
+
+
+async def format_batch_results(
+    results: AsyncGenerator[tuple[int, Union[dict[str, Any], Exception]], None],
+) -> AsyncGenerator[dict[str, Any], None]:
+    async for index, result in results:
+        if isinstance(result, Exception):
+            logging.exception("Exception in /ask/batch: %s", result, exc_info=result)
+            yield {"index": index, **error_dict(result)}
+        else:
+            yield {"index": index, **result}
 
 
-async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
+async def format_as_ndjson(r: AsyncIterator[dict]) -> AsyncGenerator[str, None]:
     try:
         async for event in r:
-            yield json.dumps(event, ensure_ascii=False) + "\n"
+            yield dumps(event) + "\n"
     except Exception as e:
         logging.exception("Exception while generating response stream: %s", e)
-        yield json.dumps(error_dict(e))
+        yield dumps(error_dict(e))
 
 
 @bp.route("/chat", methods=["POST"])
 async def chat():
+    return await handle_approach_request("/chat", CONFIG_CHAT_APPROACH)
+
+
+async def handle_approach_request(route: str, approach_config: str):
     if not request.is_json:
         return jsonify({"error": "request must be json"}), 415
     request_json = await request.get_json()
     context = request_json.get("context", {})
+    # The stages of the approach record their timings in the timings of the request
+    timings = metrics.RequestTimings()
+    metrics.current_timings.set(timings)
+    include_timings = bool(context.get("include_timings"))
     auth_helper = current_app.config[CONFIG_AUTH_CLIENT]
-    context["auth_claims"] = await auth_helper.get_auth_claims_if_enabled(request.headers)
+    with metrics.measure_stage(route.lstrip("/"), "auth"):
+        context["auth_claims"] = await auth_helper.get_auth_claims_if_enabled(request.headers)
+    started_at = metrics.start_request(route)
+    status = 500
+    streaming = False
     try:
-        approach = current_app.config[CONFIG_CHAT_APPROACH]
-        result = await approach.run(
-            request_json["messages"],
-            stream=request_json.get("stream", False),
-            context=context,
-            session_state=request_json.get("session_state"),
-        )
-        if isinstance(result, dict):
-            return jsonify(result)
-        else:
-            response = await make_response(format_as_ndjson(result))
-            response.timeout = None  # type: ignore
-            response.mimetype = "application/json-lines"
-            return response
-    except Exception as error:
-        return error_response(error, "/chat")
+        admission_controller = current_app.config[CONFIG_ADMISSION_CONTROLLER]
+        try:
+            await admission_controller.acquire()
+        except AdmissionRejectedError as error:
+            status = 429
+            return busy_response(error)
+        admitted_at = time.monotonic()
+        try:
+            approach = current_app.config[approach_config]
+            result = await run_approach(
+                route, approach, request_json, context, stream=request_json.get("stream", False)
+            )
+            if isinstance(result, dict):
+                status = 200
+                if include_timings:
+                    result["choices"][0]["context"]["timings"] = timings.as_list()
+                return jsonify(result), status, {"Server-Timing": timings.as_header()}
+            else:
+                # Only the timings of the stages run before the response starts fit in the header
+                server_timing = timings.as_header(total=False)
+                result = metrics.bind_timings(result, timings, include_timings)
+                delta_coalescer: Optional[DeltaCoalescer] = current_app.config[CONFIG_DELTA_COALESCER]
+                if delta_coalescer:
+                    result = delta_coalescer.coalesce(result)
+                # The slot is released, and the request finished, once the whole answer has been streamed
+                result = admission_controller.hold(result, admitted_at)
+                response = await make_response(format_as_ndjson(metrics.track_stream(route, result, started_at)))
+                streaming = True
+                response.timeout = None  # type: ignore
+                response.mimetype = "application/json-lines"
+                response.headers["Server-Timing"] = server_timing
+                return response
+        except Exception as error:
+            response, status = error_response(error, route)
+            return response, status, {"Server-Timing": timings.as_header()}
+        finally:
+            if not streaming:
+                admission_controller.release(time.monotonic() - admitted_at)
+    finally:
+        if not streaming:
+            metrics.finish_request(route, status, started_at)
+
+
+# Readiness probe, which only succeeds once the worker is warmed up
+@bp.route("/ready", methods=["GET"])
+def ready():
+    readiness: Readiness = current_app.config[CONFIG_READINESS]
+    if not readiness.ready:
+        return jsonify({"status": "warming up", "pending": sorted(readiness.pending)}), 503
+    return jsonify({"status": "ready"})
+
+
+# Prometheus metrics of the approaches, aggregated across workers
+@bp.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    data, content_type = metrics.generate_metrics()
+    return data, 200, {"Content-Type": content_type}
 
 
 # Send MSAL.js settings to the client UI
@@ -188,6 +445,9 @@ async def setup_clients():
     AZURE_OPENAI_SERVICE = os.getenv("AZURE_OPENAI_SERVICE")
     AZURE_OPENAI_CHATGPT_DEPLOYMENT = os.getenv("AZURE_OPENAI_CHATGPT_DEPLOYMENT") if OPENAI_HOST == "azure" else None
     AZURE_OPENAI_EMB_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMB_DEPLOYMENT") if OPENAI_HOST == "azure" else None
+    AZURE_OPENAI_CHATGPT_ENDPOINTS = (
+        os.getenv("AZURE_OPENAI_CHATGPT_ENDPOINTS", "").split(",") if OPENAI_HOST == "azure" else []
+    )
     # Used only with non-Azure OpenAI deployments
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
     OPENAI_ORGANIZATION = os.getenv("OPENAI_ORGANIZATION")
@@ -197,6 +457,41 @@ async def setup_clients():
     AZURE_CLIENT_APP_ID = os.getenv("AZURE_CLIENT_APP_ID")
     AZURE_TENANT_ID = os.getenv("AZURE_TENANT_ID")
     TOKEN_CACHE_PATH = os.getenv("TOKEN_CACHE_PATH")
+    TOKEN_CACHE_BACKEND = os.getenv("TOKEN_CACHE_BACKEND")
+
+    # Used by the local cache for citation blobs served from /content
+    BLOB_CACHE_MEMORY_SIZE_MB = int(os.getenv("BLOB_CACHE_MEMORY_SIZE_MB", "64"))
+    BLOB_CACHE_MAX_ITEM_SIZE_MB = int(os.getenv("BLOB_CACHE_MAX_ITEM_SIZE_MB", "4"))
+    BLOB_CACHE_DISK_PATH = os.getenv("BLOB_CACHE_DISK_PATH")
+    BLOB_CACHE_DISK_SIZE_MB = int(os.getenv("BLOB_CACHE_DISK_SIZE_MB", "1024"))
+    BLOB_CACHE_REVALIDATE_SECONDS = float(os.getenv("BLOB_CACHE_REVALIDATE_SECONDS", "60"))
+    PDF_PAGE_CACHE_SIZE_MB = int(os.getenv("PDF_PAGE_CACHE_SIZE_MB", "16"))
+
+    # Used by the cache of generated answers, set ANSWER_CACHE_MAX_ENTRIES to 0 to disable it
+    ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+    ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "600"))
+    # Used by the cache of answers to similar questions, disabled unless SEMANTIC_CACHE_MAX_ENTRIES is set
+    SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "0"))
+    SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97"))
+    # Used by the cache of query embeddings shared by all approaches, set EMBEDDING_CACHE_SIZE_MB to 0 to disable it
+    EMBEDDING_CACHE_SIZE_MB = int(os.getenv("EMBEDDING_CACHE_SIZE_MB", "16"))
+    # Used to share one execution between identical concurrent requests
+    REQUEST_COALESCING = os.getenv("REQUEST_COALESCING", "true").lower() == "true"
+    # Used to limit the number of /ask and /chat requests processed at once by each worker
+    ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", "16"))
+    ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+    ADMISSION_MAX_WAIT_SECONDS = float(os.getenv("ADMISSION_MAX_WAIT_SECONDS", "30"))
+    # Used to merge small streamed deltas into larger frames, set STREAM_FRAME_MAX_DELAY_MS to 0 to disable it
+    STREAM_FRAME_MAX_DELAY_MS = float(os.getenv("STREAM_FRAME_MAX_DELAY_MS", "50"))
+    STREAM_FRAME_MAX_SIZE = int(os.getenv("STREAM_FRAME_MAX_SIZE", "256"))
+    # Used to bound the size of the batches sent to /ask/batch
+    ASK_BATCH_MAX_QUESTIONS = int(os.getenv("ASK_BATCH_MAX_QUESTIONS", "1000"))
+    # Used to pace the OpenAI calls of all workers on this machine under the deployment quotas, 0 disables the limit
+    OPENAI_CHATGPT_TPM = int(os.getenv("OPENAI_CHATGPT_TPM", "0"))
+    OPENAI_EMB_TPM = int(os.getenv("OPENAI_EMB_TPM", "0"))
+    # How long a pooled chat endpoint may be waited for before the call fails over to another one
+    RATE_LIMIT_ENDPOINT_MAX_WAIT_SECONDS = float(os.getenv("RATE_LIMIT_ENDPOINT_MAX_WAIT_SECONDS", "1"))
+    RATE_LIMIT_DB_PATH = os.getenv("RATE_LIMIT_DB_PATH", os.path.join(tempfile.gettempdir(), "openai_ratelimit.sqlite"))
 
     KB_FIELDS_CONTENT = os.getenv("KB_FIELDS_CONTENT", "content")
     KB_FIELDS_SOURCEPAGE = os.getenv("KB_FIELDS_SOURCEPAGE", "sourcepage")
@@ -204,6 +499,11 @@ async def setup_clients():
     AZURE_SEARCH_QUERY_LANGUAGE = os.getenv("AZURE_SEARCH_QUERY_LANGUAGE", "en-us")
     AZURE_SEARCH_QUERY_SPELLER = os.getenv("AZURE_SEARCH_QUERY_SPELLER", "lexicon")
 
+    # Load the tiktoken encodings before serving, from the files bundled with the app if they were downloaded when
+    # it was packaged, so that neither the first request nor network isolated deployments download them
+    use_bundled_cache()
+    load_encodings()
+
     # Use the current user identity to authenticate with Azure OpenAI, AI Search and Blob Storage (no secrets needed,
     # just use 'az login' locally, and managed identity when deployed on Azure). If you need to use keys, use separate AzureKeyCredential instances with the
     # keys for each service
@@ -218,6 +518,7 @@ async def setup_clients():
         client_app_id=AZURE_CLIENT_APP_ID,
         tenant_id=AZURE_TENANT_ID,
         token_cache_path=TOKEN_CACHE_PATH,
+        token_cache_backend=TOKEN_CACHE_BACKEND,
     )
 
     # Set up clients for AI Search and Storage
@@ -226,14 +527,67 @@ async def setup_clients():
         index_name=AZURE_SEARCH_INDEX,
         credential=azure_credential,
     )
+    # Keep the initial and follow-up blob downloads small so /content can stream large files in bounded memory
     blob_client = BlobServiceClient(
-        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net", credential=azure_credential
+        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net",
+        credential=azure_credential,
+        max_single_get_size=BLOB_DOWNLOAD_CHUNK_SIZE,
+        max_chunk_get_size=BLOB_DOWNLOAD_CHUNK_SIZE,
     )
     blob_container_client = blob_client.get_container_client(AZURE_STORAGE_CONTAINER)
+    blob_cache = BlobCache(
+        blob_container_client,
+        max_memory_size=BLOB_CACHE_MEMORY_SIZE_MB * 1024 * 1024,
+        max_item_size=BLOB_CACHE_MAX_ITEM_SIZE_MB * 1024 * 1024,
+        disk_path=BLOB_CACHE_DISK_PATH,
+        max_disk_size=BLOB_CACHE_DISK_SIZE_MB * 1024 * 1024,
+        revalidate_after=BLOB_CACHE_REVALIDATE_SECONDS,
+    )
 
     # Used by the OpenAI SDK
     openai_client: AsyncOpenAI
 
+    # Additional chat deployments on other Azure OpenAI services, as "service/deployment" pairs,
+    # optionally followed by ":TPM" when their quota differs from OPENAI_CHATGPT_TPM
+    chatgpt_pool: list[tuple[OpenAIEndpoint, int]] = []
+    additional_chatgpt_endpoints = parse_endpoints(AZURE_OPENAI_CHATGPT_ENDPOINTS, OPENAI_CHATGPT_TPM)
+    if additional_chatgpt_endpoints and AZURE_OPENAI_SERVICE and AZURE_OPENAI_CHATGPT_DEPLOYMENT:
+        primary_chatgpt_endpoint = OpenAIEndpoint(AZURE_OPENAI_SERVICE, AZURE_OPENAI_CHATGPT_DEPLOYMENT)
+        chatgpt_pool = [(primary_chatgpt_endpoint, OPENAI_CHATGPT_TPM)] + additional_chatgpt_endpoints
+
+    # Calls are limited per deployment (or model), which is the name sent by the SDK,
+    # and Azure OpenAI allows 6 requests per minute for every 1000 tokens per minute
+    rate_limits: dict[str, tuple[int, int]] = {}
+    if OPENAI_CHATGPT_TPM > 0 and not chatgpt_pool:
+        chatgpt_name = AZURE_OPENAI_CHATGPT_DEPLOYMENT or OPENAI_CHATGPT_MODEL
+        rate_limits[chatgpt_name] = (OPENAI_CHATGPT_TPM, max(OPENAI_CHATGPT_TPM * 6 // 1000, 1))
+    if OPENAI_EMB_TPM > 0:
+        emb_name = AZURE_OPENAI_EMB_DEPLOYMENT or OPENAI_EMB_MODEL
+        rate_limits[emb_name] = (OPENAI_EMB_TPM, max(OPENAI_EMB_TPM * 6 // 1000, 1))
+    # With a pool, each endpoint is limited by its own quota, keyed by "service/deployment"
+    endpoint_rate_limits: dict[str, tuple[int, int]] = {}
+    for pool_endpoint, pool_endpoint_tpm in chatgpt_pool:
+        if pool_endpoint_tpm > 0:
+            endpoint_rate_limits[repr(pool_endpoint)] = (pool_endpoint_tpm, max(pool_endpoint_tpm * 6 // 1000, 1))
+    http_client = None
+    if rate_limits or chatgpt_pool:
+        transport: httpx.AsyncBaseTransport = httpx.AsyncHTTPTransport(
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=20)
+        )
+        if chatgpt_pool and AZURE_OPENAI_CHATGPT_DEPLOYMENT:
+            if endpoint_rate_limits:
+                # Below the pool, so that an endpoint out of quota answers 429 right away and the call fails over
+                # to the next endpoint instead of waiting for it
+                endpoint_rate_limiter = SharedRateLimiter(
+                    RATE_LIMIT_DB_PATH, endpoint_rate_limits, max_wait=RATE_LIMIT_ENDPOINT_MAX_WAIT_SECONDS
+                )
+                transport = RateLimitedTransport(endpoint_rate_limiter, transport)
+            pool_endpoints = [pool_endpoint for pool_endpoint, _ in chatgpt_pool]
+            transport = OpenAIPoolTransport(AZURE_OPENAI_CHATGPT_DEPLOYMENT, pool_endpoints, transport)
+        if rate_limits:
+            transport = RateLimitedTransport(SharedRateLimiter(RATE_LIMIT_DB_PATH, rate_limits), transport)
+        http_client = httpx.AsyncClient(transport=transport, timeout=openai.DEFAULT_TIMEOUT)
+
     if OPENAI_HOST == "azure":
         token_provider = get_bearer_token_provider(azure_credential, "https://cognitiveservices.azure.com/.default")
         # Store on app.config for later use inside requests
@@ -241,18 +595,56 @@ async def setup_clients():
             api_version="2023-07-01-preview",
             azure_endpoint=f"https://{AZURE_OPENAI_SERVICE}.openai.azure.com",
             azure_ad_token_provider=token_provider,
+            http_client=http_client,
         )
     else:
         openai_client = AsyncOpenAI(
             api_key=OPENAI_API_KEY,
             organization=OPENAI_ORGANIZATION,
+            http_client=http_client,
         )
 
     current_app.config[CONFIG_OPENAI_CLIENT] = openai_client
     current_app.config[CONFIG_SEARCH_CLIENT] = search_client
     current_app.config[CONFIG_BLOB_CONTAINER_CLIENT] = blob_container_client
+    current_app.config[CONFIG_BLOB_CACHE] = blob_cache
+    current_app.config[CONFIG_PDF_PAGE_CACHE] = PdfPageCache(max_size=PDF_PAGE_CACHE_SIZE_MB * 1024 * 1024)
     current_app.config[CONFIG_AUTH_CLIENT] = auth_helper
 
+    # The document count is readable with the same data plane role used for searching,
+    # so cached answers are dropped whenever documents are added to or removed from the index
+    answer_cache = None
+    if ANSWER_CACHE_MAX_ENTRIES > 0:
+        answer_cache = AnswerCache(
+            max_entries=ANSWER_CACHE_MAX_ENTRIES,
+            ttl=ANSWER_CACHE_TTL_SECONDS,
+            get_index_version=search_client.get_document_count,
+        )
+    current_app.config[CONFIG_ANSWER_CACHE] = answer_cache
+    semantic_cache = None
+    if SEMANTIC_CACHE_MAX_ENTRIES > 0:
+        semantic_cache = SemanticCache(
+            threshold=SEMANTIC_CACHE_THRESHOLD,
+            max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+            ttl=ANSWER_CACHE_TTL_SECONDS,
+            get_index_version=search_client.get_document_count,
+        )
+    current_app.config[CONFIG_SEMANTIC_CACHE] = semantic_cache
+    embedding_cache = None
+    if EMBEDDING_CACHE_SIZE_MB > 0:
+        embedding_cache = EmbeddingCache(max_size=EMBEDDING_CACHE_SIZE_MB * 1024 * 1024)
+    current_app.config[CONFIG_EMBEDDING_CACHE] = embedding_cache
+    current_app.config[CONFIG_REQUEST_COALESCER] = RequestCoalescer() if REQUEST_COALESCING else None
+    current_app.config[CONFIG_ADMISSION_CONTROLLER] = AdmissionController(
+        max_inflight=ADMISSION_MAX_INFLIGHT, max_queue=ADMISSION_MAX_QUEUE, max_wait=ADMISSION_MAX_WAIT_SECONDS
+    )
+    current_app.config[CONFIG_ASK_BATCH_MAX_QUESTIONS] = ASK_BATCH_MAX_QUESTIONS
+    current_app.config[CONFIG_DELTA_COALESCER] = (
+        DeltaCoalescer(max_delay=STREAM_FRAME_MAX_DELAY_MS / 1000, max_size=STREAM_FRAME_MAX_SIZE)
+        if STREAM_FRAME_MAX_DELAY_MS > 0
+        else None
+    )
+
     # Various approaches to integrate GPT and external knowledge, most applications will use a single one of these patterns
     # or some derivative, here we include several for exploration purposes
     current_app.config[CONFIG_ASK_APPROACH] = RetrieveThenReadApproach(
@@ -266,6 +658,9 @@ async def setup_clients():
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        answer_cache=answer_cache,
+        semantic_cache=semantic_cache,
+        embedding_cache=embedding_cache,
     )
 
     current_app.config[CONFIG_CHAT_APPROACH] = ChatReadRetrieveReadApproach(
@@ -279,11 +674,44 @@ async def setup_clients():
         content_field=KB_FIELDS_CONTENT,
         query_language=AZURE_SEARCH_QUERY_LANGUAGE,
         query_speller=AZURE_SEARCH_QUERY_SPELLER,
+        answer_cache=answer_cache,
+        semantic_cache=semantic_cache,
+        embedding_cache=embedding_cache,
     )
 
+    # Open the connections to OpenAI and AI Search in the background, /ready succeeds once they are open
+    readiness = Readiness()
+
+    async def warm_up_openai():
+        try:
+            await openai_client.models.list()
+        except openai.APIStatusError:
+            pass  # The service answered, so the connection is open
+
+    async def warm_up_search():
+        try:
+            await search_client.get_document_count()
+        except HttpResponseError:
+            pass
+
+    readiness.start("openai", warm_up_openai)
+    readiness.start("search", warm_up_search)
+    current_app.config[CONFIG_READINESS] = readiness
+
+
+@bp.after_app_serving
+async def close_clients():
+    if readiness := current_app.config.get(CONFIG_READINESS):
+        await readiness.close()
+    if blob_cache := current_app.config.get(CONFIG_BLOB_CACHE):
+        blob_cache.close()
+    if auth_helper := current_app.config.get(CONFIG_AUTH_CLIENT):
+        await auth_helper.close()
+
 
 def create_app():
     app = Quart(__name__)
+    app.json = JSONProvider(app)
     app.register_blueprint(bp)
 
     if os.getenv("APPLICATIONINSIGHTS_CONNECTION_STRING"):
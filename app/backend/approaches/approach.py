@@ -1,7 +1,12 @@
 from abc import ABC
 from typing import Any, AsyncGenerator, Optional, Union
 
+from openai.types.chat import ChatCompletionMessageParam
+
 from core.authentication import AuthenticationHelper
+from core.messagebuilder import compile_message
+from core.metrics import current_timings
+from core.modelhelper import num_tokens_from_messages
 
 
 class Approach(ABC):
@@ -15,6 +20,39 @@ class Approach(ABC):
             filters.append(security_filter)
         return None if len(filters) == 0 else " and ".join(filters)
 
+    def compile_prompts(self, messages: list[tuple[str, str]], model: str):
+        """
+        Compiles the (role, content) messages that every prompt of the approach starts with, and counts their tokens,
+        so that requests only normalize and count the messages that come from the user
+        """
+        for role, content in messages:
+            num_tokens_from_messages(dict(compile_message(role, content)), model)  # type: ignore
+
+    def get_dry_run_info(
+        self,
+        messages: list[ChatCompletionMessageParam],
+        model: str,
+        token_limit: int,
+        truncated_history: int,
+        dropped_sources: int = 0,
+    ) -> dict[str, Any]:
+        """
+        Describes the prompt of the final chat completion, for the dry_run override, which stops right before it:
+        the messages with their token counts, the token limit of the messages, the number of history messages
+        and sources left out to fit in it, and the timings of the stages run so far
+        """
+        token_counts = [num_tokens_from_messages(dict(message), model) for message in messages]  # type: ignore
+        timings = current_timings.get()
+        return {
+            "messages": messages,
+            "token_counts": token_counts,
+            "total_tokens": sum(token_counts),
+            "token_limit": token_limit,
+            "truncated_history": truncated_history,
+            "dropped_sources": dropped_sources,
+            "timings": timings.as_list() if timings is not None else [],
+        }
+
     async def run(
         self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
@@ -1,22 +1,52 @@
+import asyncio
 import json
 import logging
 import re
-from typing import Any, AsyncGenerator, Coroutine, Literal, Optional, Union, overload
+import time
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Coroutine,
+    Literal,
+    Optional,
+    Union,
+    overload,
+)
 
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType, RawVectorQuery, VectorQuery
-from openai import AsyncOpenAI, AsyncStream
+from openai import AsyncOpenAI
 from openai.types.chat import (
     ChatCompletion,
     ChatCompletionChunk,
+    ChatCompletionMessage,
     ChatCompletionMessageParam,
 )
+from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_chunk import Choice as ChunkChoice
+from openai.types.chat.chat_completion_chunk import ChoiceDelta
 
 from approaches.approach import Approach
+from core.answercache import AnswerCache, SemanticCache
+from core.embeddingcache import EmbeddingCache
 from core.messagebuilder import MessageBuilder
+from core.metrics import measure_completion, measure_stage, record_speculation
 from core.modelhelper import get_token_limit
+from core.serialization import encode_chunk
+from core.tokenbudget import TokenBudget
 from text import nonewlines
 
+# Maximum number of tokens of the search query, and of an answer
+QUERY_RESPONSE_TOKEN_LIMIT = 100
+RESPONSE_TOKEN_LIMIT = 1024
+# Share of the tokens left by the prompt and the question that the sources can use, the rest is kept for the history
+SOURCES_TOKEN_SHARE = 0.75
+# Speculative results are used when this share of the words of the search query are in the question,
+# or, for a first question, when the semantic ranker scores their best source at least this high (out of 4)
+SPECULATIVE_QUERY_OVERLAP = 0.8
+SPECULATIVE_RERANKER_SCORE = 2.0
+
 
 class ChatReadRetrieveReadApproach(Approach):
     # Chat roles
@@ -75,6 +105,9 @@ If you cannot generate a search query, return just the number 0.
         content_field: str,
         query_language: str,
         query_speller: str,
+        answer_cache: Optional[AnswerCache] = None,
+        semantic_cache: Optional[SemanticCache] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -86,7 +119,24 @@ If you cannot generate a search query, return just the number 0.
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.answer_cache = answer_cache
+        self.semantic_cache = semantic_cache
+        self.embedding_cache = embedding_cache
         self.chatgpt_token_limit = get_token_limit(chatgpt_model)
+        self.compile_prompts(
+            [("system", self.query_prompt_template)]
+            + [(shot["role"], shot["content"]) for shot in self.query_prompt_few_shots]
+            + [
+                (
+                    "system",
+                    self.system_message_chat_conversation.format(
+                        injected_prompt="", follow_up_questions_prompt=follow_up_questions_prompt
+                    ),
+                )
+                for follow_up_questions_prompt in ["", self.follow_up_questions_prompt_content]
+            ],
+            chatgpt_model,
+        )
 
     @overload
     async def run_until_final_call(
@@ -95,8 +145,7 @@ If you cannot generate a search query, return just the number 0.
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: Literal[False],
-    ) -> tuple[dict[str, Any], Coroutine[Any, Any, ChatCompletion]]:
-        ...
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, ChatCompletion]]: ...
 
     @overload
     async def run_until_final_call(
@@ -105,8 +154,7 @@ If you cannot generate a search query, return just the number 0.
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: Literal[True],
-    ) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncStream[ChatCompletionChunk]]]:
-        ...
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, AsyncIterator[ChatCompletionChunk]]]: ...
 
     async def run_until_final_call(
         self,
@@ -114,11 +162,9 @@ If you cannot generate a search query, return just the number 0.
         overrides: dict[str, Any],
         auth_claims: dict[str, Any],
         should_stream: bool = False,
-    ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncStream[ChatCompletionChunk]]]]:
+    ) -> tuple[dict[str, Any], Coroutine[Any, Any, Union[ChatCompletion, AsyncIterator[ChatCompletionChunk]]]]:
         has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
-        use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
-        top = overrides.get("top", 3)
         filter = self.build_filter(overrides, auth_claims)
         original_user_query = history[-1]["content"]
         user_query_request = "Generate search query for: " + original_user_query
@@ -141,67 +187,85 @@ If you cannot generate a search query, return just the number 0.
         ]
 
         # STEP 1: Generate an optimized keyword search query based on the chat history and the last question
+        query_budget = TokenBudget(self.chatgpt_model, QUERY_RESPONSE_TOKEN_LIMIT, self.chatgpt_token_limit)
+        query_budget.reserve(self.SYSTEM, self.query_prompt_template)
+        for shot in self.query_prompt_few_shots:
+            query_budget.reserve(shot["role"], shot["content"])
         messages = self.get_messages_from_history(
             system_prompt=self.query_prompt_template,
             model_id=self.chatgpt_model,
             history=history,
             user_content=user_query_request,
-            max_tokens=self.chatgpt_token_limit - len(user_query_request),
+            max_tokens=query_budget.available,
             few_shots=self.query_prompt_few_shots,
         )
-        chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
-            messages=messages,  # type: ignore
-            # Azure Open AI takes the deployment name as the model name
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            temperature=0.0,
-            max_tokens=100,  # Setting too low risks malformed JSON, setting too high may affect performance
-            n=1,
-            functions=functions,
-            function_call="auto",
-        )
+
+        # Optionally retrieve with the question as is while the search query is generated, betting that they're close
+        speculative_retrieval: Optional[asyncio.Task] = None
+        if overrides.get("speculative_retrieval"):
+            speculative_retrieval = asyncio.create_task(
+                self.retrieve(original_user_query, has_text, has_vector, overrides, filter, "speculative_")
+            )
+            # Failures are handled once the search query is known, or not at all if the retrieval is cancelled first
+            speculative_retrieval.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+        try:
+            with measure_stage("chat", "query_rewrite"):
+                chat_completion: ChatCompletion = await self.openai_client.chat.completions.create(
+                    messages=messages,  # type: ignore
+                    # Azure Open AI takes the deployment name as the model name
+                    model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                    temperature=0.0,
+                    max_tokens=QUERY_RESPONSE_TOKEN_LIMIT,  # Setting too low risks malformed JSON, setting too high may affect performance
+                    n=1,
+                    functions=functions,
+                    function_call="auto",
+                )
+        except BaseException:
+            if speculative_retrieval:
+                speculative_retrieval.cancel()
+            raise
 
         query_text = self.get_search_query(chat_completion, original_user_query)
 
         # STEP 2: Retrieve relevant documents from the search index with the GPT optimized query
-
-        # If retrieval mode includes vectors, compute an embedding for the query
-        vectors: list[VectorQuery] = []
-        if has_vector:
-            embedding = await self.openai_client.embeddings.create(
-                # Azure Open AI takes the deployment name as the model name
-                model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-                input=query_text,
+        retrieved = None
+        if speculative_retrieval:
+            # Later turns depend on the history, which the question alone misses however well its sources score
+            retrieved = await self.use_speculative_retrieval(
+                speculative_retrieval,
+                original_user_query,
+                query_text,
+                use_reranker_score=len(history) == 1 and bool(overrides.get("semantic_ranker")) and has_text,
             )
-            query_vector = embedding.data[0].embedding
-            vectors.append(RawVectorQuery(vector=query_vector, k=50, fields="embedding"))
+        query_vector: Optional[list[float]] = None
+        if retrieved:
+            query_text = original_user_query
+            query_vector, results, _ = retrieved
+        elif has_vector:
+            # If retrieval mode includes vectors, compute an embedding for the query
+            query_vector = await self.compute_query_vector(query_text)
+
+        semantic_partition = None
+        if query_vector is not None:
+            # For a first question, reuse the answer to a previous question with a very similar search query embedding.
+            # Later turns also depend on the conversation history, so they always get a new answer.
+            if self.semantic_cache and len(history) == 1 and not overrides.get("dry_run"):
+                semantic_partition = SemanticCache.make_partition(
+                    "chat",
+                    overrides,
+                    f"{self.chatgpt_model}:{self.chatgpt_deployment}:{self.embedding_model}:{self.embedding_deployment}",
+                    filter,
+                )
+                if (cached_answer := await self.semantic_cache.get(semantic_partition, query_vector)) is not None:
+                    return (cached_answer["context"], self.replay_completion(cached_answer["content"], should_stream))
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         if not has_text:
             query_text = None
 
-        # Use semantic L2 reranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language=self.query_language,
-                query_speller=self.query_speller,
-                semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                vector_queries=vectors,
-            )
-        else:
-            r = await self.search_client.search(query_text, filter=filter, top=top, vector_queries=vectors)
-        if use_semantic_captions:
-            results = [
-                doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
-                async for doc in r
-            ]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
-        content = "\n".join(results)
+        if not retrieved:
+            results, _ = await self.search(query_text, query_vector, overrides, filter)
 
         follow_up_questions_prompt = (
             self.follow_up_questions_prompt_content if overrides.get("suggest_followup_questions") else ""
@@ -222,33 +286,61 @@ If you cannot generate a search query, return just the number 0.
         else:
             system_message = prompt_override.format(follow_up_questions_prompt=follow_up_questions_prompt)
 
-        response_token_limit = 1024
-        messages_token_limit = self.chatgpt_token_limit - response_token_limit
-        messages = self.get_messages_from_history(
-            system_prompt=system_message,
-            model_id=self.chatgpt_model,
-            history=history,
+        messages_token_limit = self.chatgpt_token_limit - RESPONSE_TOKEN_LIMIT
+        with measure_stage("chat", "prompt"):
             # Model does not handle lengthy system messages well. Moving sources to latest user conversation to solve follow up questions prompt.
-            user_content=original_user_query + "\n\nSources:\n" + content,
-            max_tokens=messages_token_limit,
-        )
+            question = original_user_query + "\n\nSources:\n"
+            budget = TokenBudget(self.chatgpt_model, RESPONSE_TOKEN_LIMIT, self.chatgpt_token_limit)
+            budget.reserve(self.SYSTEM, system_message)
+            conversation_token_limit = budget.available
+            budget.reserve(self.USER, question)
+            # The best ranked sources are kept first, and whatever they leave goes to the most recent history
+            results = budget.pack_sources(results, SOURCES_TOKEN_SHARE)
+            if budget.dropped_sources:
+                logging.debug("Reached max tokens of the sources, %d sources dropped", budget.dropped_sources)
+            messages = self.get_messages_from_history(
+                system_prompt=system_message,
+                model_id=self.chatgpt_model,
+                history=history,
+                user_content=question + "\n".join(results),
+                max_tokens=conversation_token_limit,
+            )
         msg_to_display = "\n\n".join([str(message) for message in messages])
 
-        extra_info = {
+        extra_info: dict[str, Any] = {
             "data_points": results,
             "thoughts": f"Searched for:<br>{query_text}<br><br>Conversations:<br>"
             + msg_to_display.replace("\n", "<br>"),
         }
 
-        chat_coroutine = self.openai_client.chat.completions.create(
-            # Azure Open AI takes the deployment name as the model name
-            model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-            messages=messages,
-            temperature=overrides.get("temperature") or 0.7,
-            max_tokens=response_token_limit,
-            n=1,
-            stream=should_stream,
+        if overrides.get("dry_run"):
+            # Stop before the final completion, and answer with the prompt it would have been sent instead
+            extra_info["dry_run"] = self.get_dry_run_info(
+                messages,
+                self.chatgpt_model,
+                messages_token_limit,
+                len(history) - 1 - (len(messages) - 2),
+                budget.dropped_sources,
+            )
+            return (extra_info, self.replay_completion("", should_stream))
+
+        chat_coroutine = measure_completion(
+            "chat",
+            self.openai_client.chat.completions.create(
+                # Azure Open AI takes the deployment name as the model name
+                model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                messages=messages,
+                temperature=overrides.get("temperature") or 0.7,
+                max_tokens=RESPONSE_TOKEN_LIMIT,
+                n=1,
+                stream=should_stream,
+            ),
         )
+        if self.semantic_cache and semantic_partition and query_vector is not None:
+            return (
+                extra_info,
+                self.add_to_semantic_cache(chat_coroutine, semantic_partition, query_vector, extra_info),
+            )
         return (extra_info, chat_coroutine)
 
     async def run_without_streaming(
@@ -258,6 +350,11 @@ If you cannot generate a search query, return just the number 0.
         auth_claims: dict[str, Any],
         session_state: Any = None,
     ) -> dict[str, Any]:
+        cache_key = self.get_answer_cache_key(history, overrides, auth_claims)
+        if self.answer_cache and cache_key:
+            if (cached_answer := await self.answer_cache.get(cache_key)) is not None:
+                cached_answer["choices"][0]["session_state"] = session_state
+                return cached_answer
         extra_info, chat_coroutine = await self.run_until_final_call(
             history, overrides, auth_claims, should_stream=False
         )
@@ -268,6 +365,8 @@ If you cannot generate a search query, return just the number 0.
             content, followup_questions = self.extract_followup_questions(chat_resp["choices"][0]["message"]["content"])
             chat_resp["choices"][0]["message"]["content"] = content
             chat_resp["choices"][0]["context"]["followup_questions"] = followup_questions
+        if self.answer_cache and cache_key:
+            self.answer_cache.set(cache_key, chat_resp)
         chat_resp["choices"][0]["session_state"] = session_state
         return chat_resp
 
@@ -278,6 +377,12 @@ If you cannot generate a search query, return just the number 0.
         auth_claims: dict[str, Any],
         session_state: Any = None,
     ) -> AsyncGenerator[dict, None]:
+        cache_key = self.get_answer_cache_key(history, overrides, auth_claims)
+        if self.answer_cache and cache_key:
+            if (cached_answer := await self.answer_cache.get(cache_key)) is not None:
+                for event in self.replay_answer(cached_answer, session_state):
+                    yield event
+                return
         extra_info, chat_coroutine = await self.run_until_final_call(
             history, overrides, auth_claims, should_stream=True
         )
@@ -296,9 +401,10 @@ If you cannot generate a search query, return just the number 0.
 
         followup_questions_started = False
         followup_content = ""
+        answer_content = ""
         async for event_chunk in await chat_coroutine:
             # "2023-07-01-preview" API version has a bug where first response has empty choices
-            event = event_chunk.model_dump()  # Convert pydantic model to dict
+            event = encode_chunk(event_chunk)  # Only keep the fields sent to the browser
             if event["choices"]:
                 # if event contains << and not >>, it is start of follow-up question, truncate
                 content = event["choices"][0]["delta"].get("content")
@@ -308,12 +414,15 @@ If you cannot generate a search query, return just the number 0.
                     earlier_content = content[: content.index("<<")]
                     if earlier_content:
                         event["choices"][0]["delta"]["content"] = earlier_content
+                        answer_content += earlier_content
                         yield event
                     followup_content += content[content.index("<<") :]
                 elif followup_questions_started:
                     followup_content += content
                 else:
+                    answer_content += content
                     yield event
+        followup_questions = []
         if followup_content:
             _, followup_questions = self.extract_followup_questions(followup_content)
             yield {
@@ -327,6 +436,25 @@ If you cannot generate a search query, return just the number 0.
                 ],
                 "object": "chat.completion.chunk",
             }
+        if self.answer_cache and cache_key:
+            # Store the streamed answer in the same shape as a non-streaming response
+            answer_context = dict(extra_info)
+            if overrides.get("suggest_followup_questions"):
+                answer_context["followup_questions"] = followup_questions
+            self.answer_cache.set(
+                cache_key,
+                {
+                    "choices": [
+                        {
+                            "message": {"role": self.ASSISTANT, "content": answer_content},
+                            "context": answer_context,
+                            "finish_reason": "stop",
+                            "index": 0,
+                        }
+                    ],
+                    "object": "chat.completion",
+                },
+            )
 
     async def run(
         self, messages: list[dict], stream: bool = False, session_state: Any = None, context: dict[str, Any] = {}
@@ -338,6 +466,232 @@ If you cannot generate a search query, return just the number 0.
         else:
             return self.run_with_streaming(messages, overrides, auth_claims, session_state)
 
+    async def replay_completion(
+        self, content: str, should_stream: bool
+    ) -> Union[ChatCompletion, AsyncIterator[ChatCompletionChunk]]:
+        """Returns a cached answer as if it had been generated by the chat completion API"""
+        if not should_stream:
+            return ChatCompletion(
+                id="cached",
+                object="chat.completion",
+                created=int(time.time()),
+                model=self.chatgpt_model,
+                choices=[
+                    Choice(
+                        index=0,
+                        finish_reason="stop",
+                        message=ChatCompletionMessage(role="assistant", content=content),
+                    )
+                ],
+            )
+
+        async def replay_chunks() -> AsyncIterator[ChatCompletionChunk]:
+            yield ChatCompletionChunk(
+                id="cached",
+                object="chat.completion.chunk",
+                created=int(time.time()),
+                model=self.chatgpt_model,
+                choices=[ChunkChoice(index=0, finish_reason="stop", delta=ChoiceDelta(content=content))],
+            )
+
+        return replay_chunks()
+
+    async def add_to_semantic_cache(
+        self,
+        chat_coroutine: Coroutine[Any, Any, Union[ChatCompletion, AsyncIterator[ChatCompletionChunk]]],
+        partition: str,
+        query_vector: list[float],
+        extra_info: dict[str, Any],
+    ) -> Union[ChatCompletion, AsyncIterator[ChatCompletionChunk]]:
+        """Stores the raw completion content once it has been generated, so replays go through the same post-processing"""
+        semantic_cache = self.semantic_cache
+        assert semantic_cache is not None
+        completion = await chat_coroutine
+        if isinstance(completion, ChatCompletion):
+            if content := completion.choices[0].message.content:
+                semantic_cache.add(partition, query_vector, {"context": extra_info, "content": content})
+            return completion
+
+        async def accumulate_chunks(stream: AsyncIterator[ChatCompletionChunk]) -> AsyncIterator[ChatCompletionChunk]:
+            content = ""
+            async for chunk in stream:
+                if chunk.choices:
+                    content += chunk.choices[0].delta.content or ""
+                yield chunk
+            if content:
+                semantic_cache.add(partition, query_vector, {"context": extra_info, "content": content})
+
+        return accumulate_chunks(completion)
+
+    def get_answer_cache_key(
+        self, history: list[dict[str, str]], overrides: dict[str, Any], auth_claims: dict[str, Any]
+    ) -> Optional[str]:
+        if not self.answer_cache or overrides.get("dry_run"):
+            return None
+        return AnswerCache.make_key(
+            "chat",
+            history,
+            overrides,
+            f"{self.chatgpt_model}:{self.chatgpt_deployment}:{self.embedding_model}:{self.embedding_deployment}",
+            self.build_filter(overrides, auth_claims),
+        )
+
+    def replay_answer(self, answer: dict[str, Any], session_state: Any = None) -> list[dict[str, Any]]:
+        """Converts a cached answer into the chunks that a streamed response would have produced"""
+        choice = answer["choices"][0]
+        context = dict(choice["context"])
+        followup_questions = context.pop("followup_questions", None)
+        events: list[dict[str, Any]] = [
+            {
+                "choices": [
+                    {
+                        "delta": {"role": self.ASSISTANT},
+                        "context": context,
+                        "session_state": session_state,
+                        "finish_reason": None,
+                        "index": 0,
+                    }
+                ],
+                "object": "chat.completion.chunk",
+            },
+            {
+                "choices": [
+                    {
+                        "delta": {"role": self.ASSISTANT, "content": choice["message"]["content"]},
+                        "finish_reason": "stop",
+                        "index": 0,
+                    }
+                ],
+                "object": "chat.completion.chunk",
+            },
+        ]
+        if followup_questions:
+            events.append(
+                {
+                    "choices": [
+                        {
+                            "delta": {"role": self.ASSISTANT},
+                            "context": {"followup_questions": followup_questions},
+                            "finish_reason": None,
+                            "index": 0,
+                        }
+                    ],
+                    "object": "chat.completion.chunk",
+                }
+            )
+        return events
+
+    async def compute_query_vector(self, query_text: str, stage_prefix: str = "") -> list[float]:
+        embedding_model = f"{self.embedding_model}:{self.embedding_deployment}"
+        if (
+            self.embedding_cache
+            and (cached_vector := self.embedding_cache.get(embedding_model, query_text)) is not None
+        ):
+            return cached_vector
+        with measure_stage("chat", stage_prefix + "embedding"):
+            embedding = await self.openai_client.embeddings.create(
+                # Azure Open AI takes the deployment name as the model name
+                model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
+                input=query_text,
+            )
+        query_vector = embedding.data[0].embedding
+        if self.embedding_cache:
+            self.embedding_cache.set(embedding_model, query_text, query_vector)
+        return query_vector
+
+    async def search(
+        self,
+        query_text: Optional[str],
+        query_vector: Optional[list[float]],
+        overrides: dict[str, Any],
+        filter: Optional[str],
+        stage_prefix: str = "",
+    ) -> tuple[list[str], Optional[float]]:
+        """Returns the sources found for the query, with the reranker score of the best one if it was reranked"""
+        has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
+        use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
+        top = overrides.get("top", 3)
+        vectors: list[VectorQuery] = []
+        if query_vector is not None:
+            vectors.append(RawVectorQuery(vector=query_vector, k=50, fields="embedding"))
+
+        # Use semantic L2 reranker if requested and if retrieval mode is text or hybrid (vectors + text)
+        with measure_stage("chat", stage_prefix + "search"):
+            if overrides.get("semantic_ranker") and has_text:
+                r = await self.search_client.search(
+                    query_text,  # type: ignore
+                    filter=filter,
+                    query_type=QueryType.SEMANTIC,
+                    query_language=self.query_language,
+                    query_speller=self.query_speller,
+                    semantic_configuration_name="default",
+                    top=top,
+                    query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                    vector_queries=vectors,
+                )
+            else:
+                r = await self.search_client.search(
+                    query_text, filter=filter, top=top, vector_queries=vectors  # type: ignore
+                )
+            docs = [doc async for doc in r]
+        if use_semantic_captions:
+            results = [
+                doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
+                for doc in docs
+            ]
+        else:
+            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) for doc in docs]
+        return results, docs[0].get("@search.reranker_score") if docs else None
+
+    async def retrieve(
+        self,
+        query_text: str,
+        has_text: bool,
+        has_vector: bool,
+        overrides: dict[str, Any],
+        filter: Optional[str],
+        stage_prefix: str = "",
+    ) -> tuple[Optional[list[float]], list[str], Optional[float]]:
+        query_vector = await self.compute_query_vector(query_text, stage_prefix) if has_vector else None
+        results, reranker_score = await self.search(
+            query_text if has_text else None, query_vector, overrides, filter, stage_prefix
+        )
+        return query_vector, results, reranker_score
+
+    async def use_speculative_retrieval(
+        self,
+        speculative_retrieval: asyncio.Task,
+        original_user_query: str,
+        query_text: str,
+        use_reranker_score: bool,
+    ) -> Optional[tuple[Optional[list[float]], list[str], Optional[float]]]:
+        """
+        Returns the results of the retrieval started with the question as is, if they can stand for the results of the
+        search query: when most of the words of the search query are in the question, or, if use_reranker_score is set,
+        when their best source was reranked with a high score. Otherwise, cancels it and returns None.
+        """
+        query_words = set(re.findall(r"\w+", query_text.casefold()))
+        question_words = set(re.findall(r"\w+", original_user_query.casefold()))
+        overlap = len(query_words & question_words) / len(query_words) if query_words else 0
+        if overlap < SPECULATIVE_QUERY_OVERLAP and not use_reranker_score:
+            speculative_retrieval.cancel()
+            record_speculation("chat", "rejected")
+            return None
+        try:
+            retrieved = await speculative_retrieval
+        except Exception as error:
+            logging.warning("Speculative retrieval failed, retrieving with the search query: %s", error)
+            record_speculation("chat", "failed")
+            return None
+        reranker_score = retrieved[2]
+        if overlap >= SPECULATIVE_QUERY_OVERLAP or (
+            use_reranker_score and reranker_score is not None and reranker_score >= SPECULATIVE_RERANKER_SCORE
+        ):
+            record_speculation("chat", "accepted")
+            return retrieved
+        record_speculation("chat", "rejected")
+        return None
+
     def get_messages_from_history(
         self,
         system_prompt: str,
@@ -351,21 +705,20 @@ If you cannot generate a search query, return just the number 0.
 
         # Add examples to show the chat what responses we want. It will try to mimic any responses and make sure they match the rules laid out in the system message.
         for shot in reversed(few_shots):
-            message_builder.insert_message(shot.get("role"), shot.get("content"))
+            message_builder.insert_prompt_message(shot.get("role"), shot.get("content"))
 
         append_index = len(few_shots) + 1
 
         message_builder.insert_message(self.USER, user_content, index=append_index)
-        total_token_count = message_builder.count_tokens_for_message(dict(message_builder.messages[-1]))  # type: ignore
-
-        newest_to_oldest = list(reversed(history[:-1]))
-        for message in newest_to_oldest:
-            potential_message_count = message_builder.count_tokens_for_message(message)
-            if (total_token_count + potential_message_count) > max_tokens:
-                logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
-                break
+
+        # The user message and the most recent history share max_tokens, the response reserve is already left out
+        budget = TokenBudget(model_id, 0, max_tokens)
+        budget.reserve(self.USER, user_content)
+        packed_history = budget.pack_history(history[:-1])
+        if budget.truncated_history:
+            logging.debug("Reached max tokens of %d, history will be truncated", max_tokens)
+        for message in reversed(packed_history):
             message_builder.insert_message(message["role"], message["content"], index=append_index)
-            total_token_count += potential_message_count
         return message_builder.messages
 
     def get_search_query(self, chat_completion: ChatCompletion, user_query: str):
@@ -1,13 +1,27 @@
+import asyncio
+import logging
 from typing import Any, AsyncGenerator, Optional, Union
 
 from azure.search.documents.aio import SearchClient
 from azure.search.documents.models import QueryType, RawVectorQuery, VectorQuery
 from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletionMessageParam
 
 from approaches.approach import Approach
+from core.answercache import AnswerCache, SemanticCache
+from core.embeddingcache import EmbeddingCache
 from core.messagebuilder import MessageBuilder
+from core.metrics import measure_completion, measure_stage
+from core.modelhelper import get_token_limit
+from core.serialization import encode_chunk
+from core.tokenbudget import TokenBudget
 from text import nonewlines
 
+# Number of questions embedded by each call to the embeddings API
+EMBEDDING_BATCH_SIZE = 16
+# Maximum number of tokens of an answer
+RESPONSE_TOKEN_LIMIT = 1024
+
 
 class RetrieveThenReadApproach(Approach):
     """
@@ -50,6 +64,9 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         content_field: str,
         query_language: str,
         query_speller: str,
+        answer_cache: Optional[AnswerCache] = None,
+        semantic_cache: Optional[SemanticCache] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
     ):
         self.search_client = search_client
         self.openai_client = openai_client
@@ -61,93 +78,407 @@ info4.pdf: In-network institutions include Overlake, Swedish and others in the r
         self.content_field = content_field
         self.query_language = query_language
         self.query_speller = query_speller
+        self.answer_cache = answer_cache
+        self.semantic_cache = semantic_cache
+        self.embedding_cache = embedding_cache
+        self.compile_prompts(
+            [("system", self.system_chat_template), ("assistant", self.answer), ("user", self.question)],
+            chatgpt_model,
+        )
 
     async def run(
         self,
         messages: list[dict],
-        stream: bool = False,  # Stream is not used in this approach
+        stream: bool = False,
         session_state: Any = None,
         context: dict[str, Any] = {},
     ) -> Union[dict[str, Any], AsyncGenerator[dict[str, Any], None]]:
         q = messages[-1]["content"]
         overrides = context.get("overrides", {})
         auth_claims = context.get("auth_claims", {})
-        has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
+        filter = self.build_filter(overrides, auth_claims)
+        if stream:
+            return self.run_with_streaming(q, overrides, filter, session_state)
+        return await self.run_without_streaming(q, overrides, filter, session_state)
+
+    async def run_without_streaming(
+        self, q: str, overrides: dict[str, Any], filter: Optional[str], session_state: Any = None
+    ) -> dict[str, Any]:
+        cached_answer, cache_key, semantic_partition, query_vector = await self.lookup(q, overrides, filter)
+        if cached_answer is not None:
+            cached_answer["choices"][0]["session_state"] = session_state
+            return cached_answer
+        query_text, results = await self.retrieve(q, query_vector, overrides, filter)
+        if overrides.get("dry_run"):
+            chat_completion = self.get_dry_run_answer(q, query_text, results, overrides)
+        else:
+            chat_completion = await self.generate(q, query_text, results, overrides)
+            self.store(chat_completion, cache_key, semantic_partition, query_vector)
+        chat_completion["choices"][0]["session_state"] = session_state
+        return chat_completion
+
+    async def run_with_streaming(
+        self, q: str, overrides: dict[str, Any], filter: Optional[str], session_state: Any = None
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        cached_answer, cache_key, semantic_partition, query_vector = await self.lookup(q, overrides, filter)
+        if cached_answer is not None:
+            for event in self.replay_answer(cached_answer, session_state):
+                yield event
+            return
+        query_text, results = await self.retrieve(q, query_vector, overrides, filter)
+        if overrides.get("dry_run"):
+            for event in self.replay_answer(self.get_dry_run_answer(q, query_text, results, overrides), session_state):
+                yield event
+            return
+        messages, results = self.build_messages(q, results, overrides)
+        extra_info = self.get_extra_info(query_text, results, messages)
+        # The sources are sent before the answer, like the /chat stream
+        yield {
+            "choices": [
+                {
+                    "delta": {"role": "assistant"},
+                    "context": extra_info,
+                    "session_state": session_state,
+                    "finish_reason": None,
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+
+        answer_content = ""
+        async for event_chunk in await measure_completion(
+            "ask",
+            self.openai_client.chat.completions.create(
+                # Azure Open AI takes the deployment name as the model name
+                model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                messages=messages,
+                temperature=overrides.get("temperature") or 0.3,
+                max_tokens=RESPONSE_TOKEN_LIMIT,
+                n=1,
+                stream=True,
+            ),
+        ):
+            # "2023-07-01-preview" API version has a bug where first response has empty choices
+            event = encode_chunk(event_chunk)  # Only keep the fields sent to the browser
+            if event["choices"]:
+                answer_content += event["choices"][0]["delta"].get("content") or ""
+                yield event
+
+        # Store the streamed answer in the same shape as a non-streaming response
+        self.store(
+            {
+                "choices": [
+                    {
+                        "message": {"role": "assistant", "content": answer_content},
+                        "context": extra_info,
+                        "finish_reason": "stop",
+                        "index": 0,
+                    }
+                ],
+                "object": "chat.completion",
+            },
+            cache_key,
+            semantic_partition,
+            query_vector,
+        )
+
+    async def lookup(
+        self, q: str, overrides: dict[str, Any], filter: Optional[str]
+    ) -> tuple[Optional[dict[str, Any]], Optional[str], Optional[str], Optional[list[float]]]:
+        """
+        Looks up an answer to the question in the answer and semantic caches.
+        Returns the cached answer, if any, along with the cache keys and the query embedding needed to answer it.
+        """
         has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
+        model = f"{self.chatgpt_model}:{self.chatgpt_deployment}:{self.embedding_model}:{self.embedding_deployment}"
+
+        # Only the last question is used by this approach, so it's the only message that needs to match
+        cache_key = None
+        # A dry run needs a new prompt, and is never stored either
+        dry_run = overrides.get("dry_run")
+        if self.answer_cache and not dry_run:
+            cache_key = AnswerCache.make_key("ask", [{"role": "user", "content": q}], overrides, model, filter)
+            if (cached_answer := await self.answer_cache.get(cache_key)) is not None:
+                return cached_answer, cache_key, None, None
+
+        # If retrieval mode includes vectors, compute an embedding for the query
+        query_vector = None
+        semantic_partition = None
+        if has_vector:
+            query_vector = (await self.compute_embeddings([q]))[0]
+
+            # Reuse the answer to a previous question with a very similar embedding, skipping search and completion
+            if self.semantic_cache and not dry_run:
+                semantic_partition = SemanticCache.make_partition("ask", overrides, model, filter)
+                if (cached_answer := await self.semantic_cache.get(semantic_partition, query_vector)) is not None:
+                    return cached_answer, cache_key, semantic_partition, query_vector
+        return None, cache_key, semantic_partition, query_vector
+
+    def replay_answer(self, answer: dict[str, Any], session_state: Any = None) -> list[dict[str, Any]]:
+        """Converts a cached answer into the chunks that a streamed response would have produced"""
+        choice = answer["choices"][0]
+        return [
+            {
+                "choices": [
+                    {
+                        "delta": {"role": "assistant"},
+                        "context": choice["context"],
+                        "session_state": session_state,
+                        "finish_reason": None,
+                        "index": 0,
+                    }
+                ],
+                "object": "chat.completion.chunk",
+            },
+            {
+                "choices": [
+                    {
+                        "delta": {"role": "assistant", "content": choice["message"]["content"]},
+                        "finish_reason": "stop",
+                        "index": 0,
+                    }
+                ],
+                "object": "chat.completion.chunk",
+            },
+        ]
+
+    async def run_batch(
+        self,
+        questions: list[str],
+        context: dict[str, Any] = {},
+        max_search_concurrency: int = 8,
+        max_completion_concurrency: int = 4,
+    ) -> AsyncGenerator[tuple[int, Union[dict[str, Any], Exception]], None]:
+        """
+        Answers several questions like run does, and yields (index, answer) pairs as soon as each answer is ready.
+        The questions are embedded together, and at most max_search_concurrency searches and
+        max_completion_concurrency completions run at once. A question that fails yields its exception as the answer,
+        without stopping the others.
+        """
+        overrides = context.get("overrides", {})
+        auth_claims = context.get("auth_claims", {})
+        has_vector = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
+        filter = self.build_filter(overrides, auth_claims)
+        model = f"{self.chatgpt_model}:{self.chatgpt_deployment}:{self.embedding_model}:{self.embedding_deployment}"
+        dry_run = overrides.get("dry_run")
+        semantic_partition = None
+        if has_vector and not dry_run:
+            semantic_partition = SemanticCache.make_partition("ask", overrides, model, filter)
+
+        pending = []
+        for index, q in enumerate(questions):
+            cache_key = None
+            if self.answer_cache and not dry_run:
+                cache_key = AnswerCache.make_key("ask", [{"role": "user", "content": q}], overrides, model, filter)
+                if (cached_answer := await self.answer_cache.get(cache_key)) is not None:
+                    cached_answer["choices"][0]["session_state"] = None
+                    yield index, cached_answer
+                    continue
+            pending.append((index, q, cache_key))
+        if not pending:
+            return
+
+        query_vectors: list[Optional[list[float]]] = [None] * len(pending)
+        if has_vector:
+            try:
+                query_vectors = list(await self.compute_embeddings([q for _, q, _ in pending]))
+            except Exception as error:
+                for index, _, _ in pending:
+                    yield index, error
+                return
+
+        search_semaphore = asyncio.Semaphore(max_search_concurrency)
+        completion_semaphore = asyncio.Semaphore(max_completion_concurrency)
+
+        async def answer(
+            index: int, q: str, cache_key: Optional[str], query_vector: Optional[list[float]]
+        ) -> tuple[int, Union[dict[str, Any], Exception]]:
+            try:
+                if self.semantic_cache and semantic_partition and query_vector is not None:
+                    if (cached_answer := await self.semantic_cache.get(semantic_partition, query_vector)) is not None:
+                        cached_answer["choices"][0]["session_state"] = None
+                        return index, cached_answer
+                async with search_semaphore:
+                    query_text, results = await self.retrieve(q, query_vector, overrides, filter)
+                if dry_run:
+                    chat_completion = self.get_dry_run_answer(q, query_text, results, overrides)
+                else:
+                    async with completion_semaphore:
+                        chat_completion = await self.generate(q, query_text, results, overrides)
+                    self.store(chat_completion, cache_key, semantic_partition, query_vector)
+                chat_completion["choices"][0]["session_state"] = None
+                return index, chat_completion
+            except Exception as error:
+                return index, error
+
+        tasks = [
+            asyncio.create_task(answer(index, q, cache_key, query_vector))
+            for (index, q, cache_key), query_vector in zip(pending, query_vectors)
+        ]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            # Stop the remaining questions if the client goes away
+            for task in tasks:
+                task.cancel()
+
+    async def compute_embeddings(self, texts: list[str]) -> list[list[float]]:
+        """Embeds the texts that aren't in the embedding cache, with one call per EMBEDDING_BATCH_SIZE texts"""
+        embedding_model = f"{self.embedding_model}:{self.embedding_deployment}"
+        vectors: dict[str, list[float]] = {}
+        for text in texts:
+            if self.embedding_cache and (cached_vector := self.embedding_cache.get(embedding_model, text)) is not None:
+                vectors[text] = cached_vector
+        missing = list(dict.fromkeys(text for text in texts if text not in vectors))
+        for start in range(0, len(missing), EMBEDDING_BATCH_SIZE):
+            batch = missing[start : start + EMBEDDING_BATCH_SIZE]
+            with measure_stage("ask", "embedding"):
+                embedding = await self.openai_client.embeddings.create(
+                    # Azure Open AI takes the deployment name as the model name
+                    model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
+                    input=batch,
+                )
+            for item in embedding.data:
+                vectors[batch[item.index]] = item.embedding
+                if self.embedding_cache:
+                    self.embedding_cache.set(embedding_model, batch[item.index], item.embedding)
+        return [vectors[text] for text in texts]
+
+    async def retrieve(
+        self, q: str, query_vector: Optional[list[float]], overrides: dict[str, Any], filter: Optional[str]
+    ) -> tuple[str, list[str]]:
+        has_text = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         use_semantic_captions = True if overrides.get("semantic_captions") and has_text else False
         top = overrides.get("top", 3)
-        filter = self.build_filter(overrides, auth_claims)
-        # If retrieval mode includes vectors, compute an embedding for the query
         vectors: list[VectorQuery] = []
-        if has_vector:
-            embedding = await self.openai_client.embeddings.create(
-                # Azure Open AI takes the deployment name as the model name
-                model=self.embedding_deployment if self.embedding_deployment else self.embedding_model,
-                input=q,
-            )
-            query_vector = embedding.data[0].embedding
+        if query_vector is not None:
             vectors.append(RawVectorQuery(vector=query_vector, k=50, fields="embedding"))
 
         # Only keep the text query if the retrieval mode uses text, otherwise drop it
         query_text = q if has_text else ""
 
         # Use semantic ranker if requested and if retrieval mode is text or hybrid (vectors + text)
-        if overrides.get("semantic_ranker") and has_text:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                query_type=QueryType.SEMANTIC,
-                query_language=self.query_language,
-                query_speller=self.query_speller,
-                semantic_configuration_name="default",
-                top=top,
-                query_caption="extractive|highlight-false" if use_semantic_captions else None,
-                vector_queries=vectors,
-            )
-        else:
-            r = await self.search_client.search(
-                query_text,
-                filter=filter,
-                top=top,
-                vector_queries=vectors,
-            )
-        if use_semantic_captions:
-            results = [
-                doc[self.sourcepage_field] + ": " + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
-                async for doc in r
-            ]
-        else:
-            results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
-        content = "\n".join(results)
+        with measure_stage("ask", "search"):
+            if overrides.get("semantic_ranker") and has_text:
+                r = await self.search_client.search(
+                    query_text,
+                    filter=filter,
+                    query_type=QueryType.SEMANTIC,
+                    query_language=self.query_language,
+                    query_speller=self.query_speller,
+                    semantic_configuration_name="default",
+                    top=top,
+                    query_caption="extractive|highlight-false" if use_semantic_captions else None,
+                    vector_queries=vectors,
+                )
+            else:
+                r = await self.search_client.search(
+                    query_text,
+                    filter=filter,
+                    top=top,
+                    vector_queries=vectors,
+                )
+            if use_semantic_captions:
+                results = [
+                    doc[self.sourcepage_field]
+                    + ": "
+                    + nonewlines(" . ".join([c.text for c in doc["@search.captions"]]))
+                    async for doc in r
+                ]
+            else:
+                results = [doc[self.sourcepage_field] + ": " + nonewlines(doc[self.content_field]) async for doc in r]
+        return query_text, results
 
-        message_builder = MessageBuilder(
-            overrides.get("prompt_template") or self.system_chat_template, self.chatgpt_model
-        )
+    def build_messages(
+        self, q: str, results: list[str], overrides: dict[str, Any]
+    ) -> tuple[list[ChatCompletionMessageParam], list[str]]:
+        """Returns the messages of the prompt, and the sources that fit in it, in rank order"""
+        with measure_stage("ask", "prompt"):
+            system_content = overrides.get("prompt_template") or self.system_chat_template
+            question = q + "\n" + "Sources:\n "
+            budget = TokenBudget(self.chatgpt_model, RESPONSE_TOKEN_LIMIT)
+            budget.reserve("system", system_content)
+            budget.reserve("assistant", self.answer)
+            budget.reserve("user", self.question)
+            budget.reserve("user", question)
+            results = budget.pack_sources(results)
+            if budget.dropped_sources:
+                logging.debug("Reached max tokens of the sources, %d sources dropped", budget.dropped_sources)
 
-        # add user question
-        user_content = q + "\n" + f"Sources:\n {content}"
-        message_builder.insert_message("user", user_content)
+            message_builder = MessageBuilder(system_content, self.chatgpt_model)
 
-        # Add shots/samples. This helps model to mimic response and make sure they match rules laid out in system message.
-        message_builder.insert_message("assistant", self.answer)
-        message_builder.insert_message("user", self.question)
+            # add user question
+            user_content = question + "\n".join(results)
+            message_builder.insert_message("user", user_content)
 
-        chat_completion = (
-            await self.openai_client.chat.completions.create(
-                # Azure Open AI takes the deployment name as the model name
-                model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
-                messages=message_builder.messages,
-                temperature=overrides.get("temperature") or 0.3,
-                max_tokens=1024,
-                n=1,
-            )
-        ).model_dump()
+            # Add shots/samples. This helps model to mimic response and make sure they match rules laid out in system message.
+            message_builder.insert_prompt_message("assistant", self.answer)
+            message_builder.insert_prompt_message("user", self.question)
+        return message_builder.messages, results
 
-        extra_info = {
+    def get_extra_info(
+        self, query_text: str, results: list[str], messages: list[ChatCompletionMessageParam]
+    ) -> dict[str, Any]:
+        return {
             "data_points": results,
             "thoughts": f"Question:<br>{query_text}<br><br>Prompt:<br>"
-            + "\n\n".join([str(message) for message in message_builder.messages]),
+            + "\n\n".join([str(message) for message in messages]),
         }
-        chat_completion["choices"][0]["context"] = extra_info
-        chat_completion["choices"][0]["session_state"] = session_state
+
+    async def generate(self, q: str, query_text: str, results: list[str], overrides: dict[str, Any]) -> dict[str, Any]:
+        messages, results = self.build_messages(q, results, overrides)
+        chat_completion = (
+            await measure_completion(
+                "ask",
+                self.openai_client.chat.completions.create(
+                    # Azure Open AI takes the deployment name as the model name
+                    model=self.chatgpt_deployment if self.chatgpt_deployment else self.chatgpt_model,
+                    messages=messages,
+                    temperature=overrides.get("temperature") or 0.3,
+                    max_tokens=RESPONSE_TOKEN_LIMIT,
+                    n=1,
+                ),
+            )
+        ).model_dump()
+        chat_completion["choices"][0]["context"] = self.get_extra_info(query_text, results, messages)
         return chat_completion
+
+    def get_dry_run_answer(
+        self, q: str, query_text: str, results: list[str], overrides: dict[str, Any]
+    ) -> dict[str, Any]:
+        """Answers with the prompt that the final completion would have been sent, for the dry_run override"""
+        messages, sources = self.build_messages(q, results, overrides)
+        extra_info = self.get_extra_info(query_text, sources, messages)
+        # The question is the only message of the conversation used by this approach, so no history gets truncated
+        extra_info["dry_run"] = self.get_dry_run_info(
+            messages,
+            self.chatgpt_model,
+            get_token_limit(self.chatgpt_model) - RESPONSE_TOKEN_LIMIT,
+            0,
+            len(results) - len(sources),
+        )
+        return {
+            "choices": [
+                {
+                    "message": {"role": "assistant", "content": ""},
+                    "context": extra_info,
+                    "finish_reason": "stop",
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion",
+        }
+
+    def store(
+        self,
+        chat_completion: dict[str, Any],
+        cache_key: Optional[str],
+        semantic_partition: Optional[str],
+        query_vector: Optional[list[float]],
+    ):
+        if self.answer_cache and cache_key:
+            self.answer_cache.set(cache_key, chat_completion)
+        if self.semantic_cache and semantic_partition and query_vector is not None:
+            self.semantic_cache.add(semantic_partition, query_vector, chat_completion)
@@ -0,0 +1,71 @@
+import argparse
+import json
+import timeit
+
+from openai.types.chat import ChatCompletionChunk
+
+from core import serialization
+from core.serialization import dumps, encode_chunk
+
+
+def make_chunk(content: str) -> ChatCompletionChunk:
+    # Shaped like the chunks streamed by Azure OpenAI, with the content filter results the frontend doesn't read
+    return ChatCompletionChunk.model_validate(
+        {
+            "id": "chatcmpl-8VvHqKRcIxwnbVXVnCVJMhRbZ1Sc2",
+            "object": "chat.completion.chunk",
+            "created": 1702563314,
+            "model": "gpt-35-turbo",
+            "choices": [
+                {
+                    "delta": {"content": content},
+                    "finish_reason": None,
+                    "index": 0,
+                    "content_filter_results": {
+                        "hate": {"filtered": False, "severity": "safe"},
+                        "self_harm": {"filtered": False, "severity": "safe"},
+                        "sexual": {"filtered": False, "severity": "safe"},
+                        "violence": {"filtered": False, "severity": "safe"},
+                    },
+                }
+            ],
+        }
+    )
+
+
+def model_dump_json(chunk: ChatCompletionChunk) -> str:
+    # How each chunk was serialized before the lean encoder
+    return json.dumps(chunk.model_dump(), ensure_ascii=False)
+
+
+def lean_json(chunk: ChatCompletionChunk) -> str:
+    return dumps(encode_chunk(chunk))
+
+
+def run(number: int, repeat: int):
+    chunk = make_chunk(" Northwind")
+    results = {
+        "model_dump + json.dumps": min(timeit.repeat(lambda: model_dump_json(chunk), number=number, repeat=repeat))
+    }
+    if serialization.orjson is not None:
+        results["encode_chunk + orjson"] = min(timeit.repeat(lambda: lean_json(chunk), number=number, repeat=repeat))
+    orjson, serialization.orjson = serialization.orjson, None
+    try:
+        results["encode_chunk + json"] = min(timeit.repeat(lambda: lean_json(chunk), number=number, repeat=repeat))
+    finally:
+        serialization.orjson = orjson
+    baseline = results["model_dump + json.dumps"]
+    for name, seconds in results.items():
+        print(f"{name:<26} {seconds / number * 1e6:8.2f} us/chunk {baseline / seconds:6.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the time to serialize a streamed chat completion chunk with model_dump and json.dumps, "
+        "and with the lean encoder of the app, with and without orjson",
+        epilog="Example: cd app/backend && python -m benchmarks.benchmark_serialization",
+    )
+    parser.add_argument("--number", type=int, default=20000, help="Chunks serialized per run (default: 20000)")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs, of which the fastest is reported (default: 5)")
+    args = parser.parse_args()
+    run(args.number, args.repeat)
@@ -0,0 +1,85 @@
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+
+from msal import TokenCache
+from msal_extensions import FilePersistence, PersistedTokenCache
+
+from core.tokencache import SqliteTokenCache
+
+BACKENDS = ["memory", "sqlite", "file"]
+
+
+def token_event(uid: str, access_token: str) -> dict:
+    client_info = base64.urlsafe_b64encode(json.dumps({"uid": uid, "utid": "tenant"}).encode()).decode()
+    return {
+        "client_id": "SERVER_APP",
+        "scope": ["https://graph.microsoft.com/.default"],
+        "token_endpoint": "https://login.microsoftonline.com/tenant/oauth2/v2.0/token",
+        "response": {
+            "access_token": access_token,
+            "refresh_token": "refresh-" + access_token,
+            "expires_in": 3600,
+            "client_info": client_info,
+        },
+    }
+
+
+def build_token_cache(backend: str, path: str) -> TokenCache:
+    # The same caches as AuthenticationHelper.build_token_cache, without the encryption of the file persistence
+    if backend == "memory":
+        return TokenCache()
+    if backend == "sqlite":
+        return SqliteTokenCache(path)
+    return PersistedTokenCache(FilePersistence(location=path))
+
+
+def run_worker(backend: str, path: str, worker: int, users: int, operations: int, write_every: int) -> float:
+    token_cache = build_token_cache(backend, path)
+    started_at = time.perf_counter()
+    for operation in range(operations):
+        uid = f"user{(worker * 7919 + operation) % users}"
+        # Most lookups find a cached token, and a token is acquired (and written) every write_every lookups
+        token_cache.find(TokenCache.CredentialType.ACCESS_TOKEN, query={"home_account_id": f"{uid}.tenant"})
+        if operation % write_every == 0:
+            token_cache.add(token_event(uid, f"token-{worker}-{operation}"))
+    return time.perf_counter() - started_at
+
+
+def run_backend(backend: str, workers: int, users: int, operations: int, write_every: int) -> float:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "token_cache.bin")
+        # Start from a cache with a token for every user, like a warm deployment
+        token_cache = build_token_cache(backend, path)
+        for user in range(users):
+            token_cache.add(token_event(f"user{user}", f"token-{user}"))
+        arguments = [(backend, path, worker, users, operations, write_every) for worker in range(workers)]
+        started_at = time.perf_counter()
+        with multiprocessing.Pool(workers) as pool:
+            pool.starmap(run_worker, arguments)
+        return time.perf_counter() - started_at
+
+
+def run(backends: list[str], workers: int, users: int, operations: int, write_every: int):
+    for backend in backends:
+        seconds = run_backend(backend, workers, users, operations, write_every)
+        print(f"{backend:<7} {workers * operations / seconds:10.0f} lookups/s with {workers} workers")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the throughput of the MSAL token cache backends when several worker processes look up "
+        "and store tokens at once. The memory backend isn't shared, so each worker only sees its own tokens.",
+        epilog="Example: cd app/backend && python -m benchmarks.benchmark_tokencache --workers 9",
+    )
+    parser.add_argument("--backend", action="append", choices=BACKENDS, help="Backend to run, can be repeated")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Worker processes (default: CPUs)")
+    parser.add_argument("--users", type=int, default=100, help="Users with a cached token (default: 100)")
+    parser.add_argument("--operations", type=int, default=500, help="Lookups per worker (default: 500)")
+    parser.add_argument("--write-every", type=int, default=20, help="Lookups per stored token (default: 20)")
+    args = parser.parse_args()
+    run(args.backend or BACKENDS, args.workers, args.users, args.operations, args.write_every)
@@ -0,0 +1,63 @@
+import argparse
+import random
+import time
+
+import tiktoken
+
+from core import modelhelper
+from core.modelhelper import get_oai_chatmodel_tiktok, num_tokens_from_messages
+from core.tokencounter import TokenCounter, load_encodings
+
+WORDS = "the policy covers dental vision and hospital stays for employees and their families with a deductible".split()
+
+
+def make_conversation(turns: int, seed: int = 0) -> list[dict[str, str]]:
+    generator = random.Random(seed)
+    messages = []
+    for _ in range(turns):
+        messages.append({"role": "user", "content": " ".join(generator.choices(WORDS, k=20)) + "?"})
+        messages.append({"role": "assistant", "content": " ".join(generator.choices(WORDS, k=200)) + " [info1.pdf]"})
+    return messages
+
+
+def count_uncached(message: dict[str, str], model: str) -> int:
+    # How messages were counted before the token counter: the encoding is looked up and every value encoded each time
+    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+    return 2 + sum(len(encoding.encode(str(value))) for value in message.values())
+
+
+def count_conversation(messages: list[dict[str, str]], model: str, count) -> int:
+    # Every turn counts the whole history again, like the message builder does when the prompt is built
+    total = 0
+    for turn in range(2, len(messages) + 1, 2):
+        total += sum(count(message, model) for message in messages[:turn])
+    return total
+
+
+def run(turns: int, conversations: int, model: str):
+    load_encodings()
+    samples = [make_conversation(turns, seed) for seed in range(conversations)]
+    results = {}
+    for name, count in (("tiktoken per call", count_uncached), ("token counter", num_tokens_from_messages)):
+        # Start from an empty LRU, so that the first turn of each conversation is counted from scratch
+        modelhelper.token_counter = TokenCounter()
+        started_at = time.perf_counter()
+        totals = [count_conversation(messages, model, count) for messages in samples]
+        results[name] = (time.perf_counter() - started_at, totals)
+    baseline, baseline_totals = results["tiktoken per call"]
+    for name, (seconds, totals) in results.items():
+        assert totals == baseline_totals, "Both ways must count the same tokens"
+        print(f"{name:<18} {seconds / conversations * 1000:8.2f} ms/conversation {baseline / seconds:6.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compare the time to count the tokens of the history at every turn of conversations, "
+        "with a tiktoken lookup and encoding per message and with the memoized token counter",
+        epilog="Example: cd app/backend && python -m benchmarks.benchmark_tokencounter --turns 20",
+    )
+    parser.add_argument("--turns", type=int, default=20, help="Turns of each conversation (default: 20)")
+    parser.add_argument("--conversations", type=int, default=20, help="Conversations to count (default: 20)")
+    parser.add_argument("--model", default="gpt-35-turbo", help="Chat model (default: gpt-35-turbo)")
+    args = parser.parse_args()
+    run(args.turns, args.conversations, args.model)
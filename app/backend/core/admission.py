@@ -0,0 +1,146 @@
+import asyncio
+import collections
+import logging
+import math
+import time
+from typing import AsyncIterator, TypeVar
+
+from opentelemetry import metrics
+
+from .closingstream import ClosingStream
+from .metrics import (
+    admission_inflight,
+    admission_queued,
+    admission_rejected,
+    admission_wait_time,
+)
+
+T = TypeVar("T")
+
+meter = metrics.get_meter(__name__)
+inflight_counter = meter.create_up_down_counter(
+    "app.admission.inflight", description="Number of requests being processed by this worker"
+)
+queued_counter = meter.create_up_down_counter(
+    "app.admission.queued", description="Number of requests waiting for a free slot in this worker"
+)
+wait_histogram = meter.create_histogram(
+    "app.admission.wait_time", unit="s", description="Time spent by admitted requests waiting for a free slot"
+)
+rejected_counter = meter.create_counter(
+    "app.admission.rejected", description="Number of requests rejected because the queue was full or too slow"
+)
+
+
+class AdmissionRejectedError(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Request rejected: {reason}, retry after {retry_after} seconds")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Limits the number of requests processed at once by a worker, so that admitted requests keep a steady latency
+    instead of all of them hitting the Azure OpenAI rate limits together.
+    Requests beyond max_inflight wait in a FIFO queue of at most max_queue requests. A request is rejected right away
+    when the queue is full or when its expected wait, estimated from recent processing times, exceeds max_wait,
+    and is also rejected if it is still queued after max_wait seconds.
+    """
+
+    def __init__(self, max_inflight: int = 16, max_queue: int = 64, max_wait: float = 30):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.inflight = 0
+        self.waiters: collections.deque[asyncio.Future] = collections.deque()
+        # Exponential moving average of how long a request holds its slot, used to estimate waits
+        self.average_service_time = 1.0
+        self.last_wait_time = 0.0
+        self.admitted = 0
+        self.rejected = 0
+
+    @property
+    def queued(self) -> int:
+        return len(self.waiters)
+
+    def estimate_wait(self, position: int) -> float:
+        return self.average_service_time * position / max(self.max_inflight, 1)
+
+    def reject(self, reason: str) -> AdmissionRejectedError:
+        self.rejected += 1
+        rejected_counter.add(1, {"reason": reason})
+        admission_rejected.labels(reason).inc()
+        retry_after = max(1, math.ceil(self.estimate_wait(self.queued + 1)))
+        logging.warning("Rejecting request (%s): %d in flight, %d queued", reason, self.inflight, self.queued)
+        return AdmissionRejectedError(reason, retry_after)
+
+    async def acquire(self) -> float:
+        """
+        Waits for a free slot and returns the time waited, raises AdmissionRejectedError if the request is shed.
+        Every successful acquire must be followed by a release.
+        """
+        if self.inflight < self.max_inflight and not self.waiters:
+            self.inflight += 1
+            inflight_counter.add(1)
+            admission_inflight.inc()
+            self.record_admission(0)
+            return 0
+        if self.queued >= self.max_queue:
+            raise self.reject("queue_full")
+        if self.estimate_wait(self.queued + 1) > self.max_wait:
+            raise self.reject("deadline")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        queued_counter.add(1)
+        admission_queued.inc()
+        started_at = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                raise self.reject("timeout")
+        except asyncio.CancelledError:
+            # A slot handed over to a request that has gone away is passed on to the next one
+            if waiter.done() and not waiter.cancelled():
+                self.release_slot()
+            raise
+        finally:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+                waiter.cancel()
+            queued_counter.add(-1)
+            admission_queued.dec()
+        # The slot was handed over by release, so it is already counted as in flight
+        wait_time = time.monotonic() - started_at
+        self.record_admission(wait_time)
+        return wait_time
+
+    def record_admission(self, wait_time: float):
+        self.admitted += 1
+        self.last_wait_time = wait_time
+        wait_histogram.record(wait_time)
+        admission_wait_time.observe(wait_time)
+
+    def release(self, service_time: float):
+        self.average_service_time = 0.8 * self.average_service_time + 0.2 * service_time
+        self.release_slot()
+
+    def release_slot(self):
+        # Hand the slot over to the oldest waiting request, if there is one
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.inflight -= 1
+        inflight_counter.add(-1)
+        admission_inflight.dec()
+
+    def hold(self, events: AsyncIterator[T], admitted_at: float) -> ClosingStream[T]:
+        """
+        Keeps the slot until a streamed response is complete, or closed, or dropped without being sent,
+        e.g. when the client disconnects before the response starts
+        """
+        return ClosingStream(events, lambda: self.release(time.monotonic() - admitted_at))
@@ -0,0 +1,239 @@
+import copy
+import hashlib
+import json
+import logging
+import re
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+import numpy as np
+
+from core.metrics import record_cache_lookup
+
+
+class IndexVersionedCache(ABC):
+    """
+    Base class for caches of generated answers that must be cleared when the search index changes.
+    The version reported by get_index_version is checked at most every index_check_interval seconds.
+    """
+
+    def __init__(
+        self,
+        get_index_version: Optional[Callable[[], Awaitable[Any]]] = None,
+        index_check_interval: float = 60,
+    ):
+        self.get_index_version = get_index_version
+        self.index_check_interval = index_check_interval
+        self.index_version: Any = None
+        self.index_checked_at = time.monotonic()
+
+    @abstractmethod
+    def invalidate(self):
+        raise NotImplementedError
+
+    async def check_index_version(self):
+        if self.get_index_version is None or time.monotonic() - self.index_checked_at < self.index_check_interval:
+            return
+        self.index_checked_at = time.monotonic()
+        try:
+            index_version = await self.get_index_version()
+        except Exception:
+            logging.exception("Unable to read the search index version, keeping cached answers")
+            return
+        if self.index_version is not None and index_version != self.index_version:
+            logging.info("Search index changed, invalidating cached answers")
+            self.invalidate()
+        self.index_version = index_version
+
+
+class AnswerCache(IndexVersionedCache):
+    """
+    Exact-match cache for generated answers, keyed by the normalized conversation, the overrides,
+    the model/deployment and the search filter (which carries the security filter), so that answers
+    trimmed by access control are never shared across users with different permissions.
+    Entries expire after ttl seconds, the least recently used entries are evicted beyond max_entries,
+    and the whole cache is cleared when the version reported by get_index_version changes.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1000,
+        ttl: float = 600,
+        get_index_version: Optional[Callable[[], Awaitable[Any]]] = None,
+        index_check_interval: float = 60,
+    ):
+        super().__init__(get_index_version, index_check_interval)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, dict[str, Any]]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip().casefold()
+
+    @classmethod
+    def make_key(
+        cls,
+        approach: str,
+        messages: list[dict[str, Any]],
+        overrides: dict[str, Any],
+        model: str,
+        filter: Optional[str],
+    ) -> str:
+        key = {
+            "approach": approach,
+            "messages": [
+                {"role": message.get("role"), "content": cls.normalize_text(str(message.get("content") or ""))}
+                for message in messages
+            ],
+            "overrides": overrides,
+            "model": model,
+            "filter": filter,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    async def get(self, key: str) -> Optional[dict[str, Any]]:
+        await self.check_index_version()
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            record_cache_lookup("answer", hit=False)
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        record_cache_lookup("answer", hit=True)
+        # Callers mutate the answer (session state, follow-up questions), so never hand out the cached copy
+        return copy.deepcopy(entry[1])
+
+    def set(self, key: str, answer: dict[str, Any]):
+        if self.max_entries <= 0:
+            return
+        self.entries[key] = (time.monotonic(), copy.deepcopy(answer))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self):
+        self.entries.clear()
+
+
+class SemanticCache(IndexVersionedCache):
+    """
+    Cache of generated answers keyed by the embedding of the question, so that paraphrased questions can reuse
+    an earlier answer instead of waiting for a new chat completion.
+    Vectors are kept L2-normalized in a contiguous float32 matrix, so a lookup is a single matrix-vector product.
+    An answer is only returned when its cosine similarity is at least threshold and it belongs to the same partition,
+    which is derived from the overrides, the model/deployment and the search filter (including the security filter).
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.97,
+        max_entries: int = 1000,
+        ttl: float = 600,
+        get_index_version: Optional[Callable[[], Awaitable[Any]]] = None,
+        index_check_interval: float = 60,
+    ):
+        super().__init__(get_index_version, index_check_interval)
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # The matrix is allocated on the first insert, once the embedding dimensions are known
+        self.vectors: Optional[np.ndarray] = None
+        self.partition_ids = np.full(max_entries, -1, dtype=np.int64)
+        self.created_at = np.zeros(max_entries, dtype=np.float64)
+        self.used_at = np.zeros(max_entries, dtype=np.float64)
+        self.answers: list[Optional[dict[str, Any]]] = [None] * max_entries
+        # Ids of the partitions that have answers in the cache, which are dropped once their last answer is gone
+        self.partitions: dict[str, int] = {}
+        self.next_partition_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    @staticmethod
+    def make_partition(approach: str, overrides: dict[str, Any], model: str, filter: Optional[str]) -> str:
+        partition = {"approach": approach, "overrides": overrides, "model": model, "filter": filter}
+        return hashlib.sha256(json.dumps(partition, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def normalize_vector(vector: list[float]) -> Optional[np.ndarray]:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm > 0 else None
+
+    async def get(self, partition: str, vector: list[float]) -> Optional[dict[str, Any]]:
+        await self.check_index_version()
+        partition_id = self.partitions.get(partition)
+        query = self.normalize_vector(vector)
+        if self.vectors is None or partition_id is None or query is None or query.shape[0] != self.vectors.shape[1]:
+            self.misses += 1
+            record_cache_lookup("semantic", hit=False)
+            return None
+        now = time.monotonic()
+        similarities = self.vectors @ query
+        similarities[(self.partition_ids != partition_id) | (now - self.created_at > self.ttl)] = -np.inf
+        slot = int(np.argmax(similarities))
+        if similarities[slot] < self.threshold:
+            self.misses += 1
+            record_cache_lookup("semantic", hit=False)
+            return None
+        self.used_at[slot] = now
+        self.hits += 1
+        record_cache_lookup("semantic", hit=True)
+        return copy.deepcopy(self.answers[slot])
+
+    def add(self, partition: str, vector: list[float], answer: dict[str, Any]):
+        if self.max_entries <= 0 or (query := self.normalize_vector(vector)) is None:
+            return
+        if self.vectors is None:
+            self.vectors = np.zeros((self.max_entries, query.shape[0]), dtype=np.float32)
+        elif query.shape[0] != self.vectors.shape[1]:
+            logging.warning("Embedding has %d dimensions, expected %d", query.shape[0], self.vectors.shape[1])
+            return
+        now = time.monotonic()
+        # Empty the expired slots, then reuse an empty slot if there is one, otherwise evict the least recently used
+        expired = (self.partition_ids != -1) & (now - self.created_at > self.ttl)
+        released = bool(expired.any())
+        if released:
+            self.partition_ids[expired] = -1
+            for expired_slot in np.flatnonzero(expired):
+                self.answers[expired_slot] = None
+        free_slots = np.flatnonzero(self.partition_ids == -1)
+        if len(free_slots) > 0:
+            slot = int(free_slots[0])
+        else:
+            slot = int(np.argmin(self.used_at))
+            self.evictions += 1
+            released = True
+        if partition not in self.partitions:
+            self.partitions[partition] = self.next_partition_id
+            self.next_partition_id += 1
+        self.vectors[slot] = query
+        self.partition_ids[slot] = self.partitions[partition]
+        self.created_at[slot] = now
+        self.used_at[slot] = now
+        self.answers[slot] = copy.deepcopy(answer)
+        if released:
+            self.drop_unused_partitions()
+
+    def drop_unused_partitions(self):
+        used = set(np.unique(self.partition_ids).tolist())
+        self.partitions = {key: partition_id for key, partition_id in self.partitions.items() if partition_id in used}
+
+    def invalidate(self):
+        self.partition_ids[:] = -1
+        self.partitions.clear()
+        self.answers = [None] * self.max_entries
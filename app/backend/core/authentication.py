@@ -1,19 +1,29 @@
 # Refactored from https://github.com/Azure-Samples/ms-identity-python-on-behalf-of
 
+import asyncio
+import base64
+import copy
+import functools
+import hashlib
 import json
 import logging
 import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import TemporaryDirectory
 from typing import Any, Optional
 
 import aiohttp
-from msal import ConfidentialClientApplication
+from msal import ConfidentialClientApplication, TokenCache
 from msal_extensions import (
     FilePersistence,
     PersistedTokenCache,
     build_encrypted_persistence,
 )
 
+from core.tokencache import SqliteTokenCache
+
 
 # AuthError is raised when the authentication token sent by the client UI cannot be parsed or there is an authentication error accessing the graph API
 class AuthError(Exception):
@@ -33,6 +43,11 @@ class AuthenticationHelper:
         client_app_id: Optional[str],
         tenant_id: Optional[str],
         token_cache_path: Optional[str] = None,
+        token_cache_backend: Optional[str] = None,
+        max_workers: int = 4,
+        claims_cache_max_entries: int = 1000,
+        groups_cache_ttl: float = 3600,
+        groups_refresh_after: float = 600,
     ):
         self.use_authentication = use_authentication
         self.server_app_id = server_app_id
@@ -40,23 +55,48 @@ class AuthenticationHelper:
         self.client_app_id = client_app_id
         self.tenant_id = tenant_id
         self.authority = f"https://login.microsoftonline.com/{tenant_id}"
+        self.claims_cache_max_entries = claims_cache_max_entries
+        # Claims are cached by the SHA-256 of the bearer token until the token expires
+        self.claims_cache: OrderedDict[str, tuple[float, dict[str, Any]]] = OrderedDict()
+        # Group memberships read from Microsoft Graph are cached by oid for groups_cache_ttl seconds,
+        # and refreshed in the background when a cached entry is older than groups_refresh_after seconds
+        self.groups_cache_ttl = groups_cache_ttl
+        self.groups_refresh_after = groups_refresh_after
+        self.groups_cache: OrderedDict[str, tuple[float, list[str]]] = OrderedDict()
+        self.groups_inflight: dict[str, asyncio.Task] = {}
+        self.graph_session: Optional[aiohttp.ClientSession] = None
 
         if self.use_authentication:
             self.token_cache_path = token_cache_path
-            if not self.token_cache_path:
-                self.temporary_directory = TemporaryDirectory()
-                self.token_cache_path = os.path.join(self.temporary_directory.name, "token_cache.bin")
-            try:
-                persistence = build_encrypted_persistence(location=self.token_cache_path)
-            except Exception:
-                logging.exception("Encryption unavailable. Opting in to plain text.")
-                persistence = FilePersistence(location=self.token_cache_path)
+            self.token_cache_backend = token_cache_backend or ("file" if token_cache_path else "memory")
             self.confidential_client = ConfidentialClientApplication(
                 server_app_id,
                 authority=self.authority,
                 client_credential=server_app_secret,
-                token_cache=PersistedTokenCache(persistence),
+                token_cache=self.build_token_cache(),
             )
+            # MSAL is synchronous and does HTTP and file-locked token cache I/O,
+            # so token exchanges run on a bounded thread pool instead of the event loop
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="msal")
+
+    def build_token_cache(self) -> TokenCache:
+        # The in-memory cache is enough for stateless app instances, and avoids the file lock taken on every token access.
+        # Use the "sqlite" backend to share tokens across workers, or the "file" backend for the msal-extensions persistence
+        if self.token_cache_backend == "memory":
+            return TokenCache()
+        if self.token_cache_backend not in ("sqlite", "file"):
+            raise ValueError(f"Unknown token cache backend {self.token_cache_backend}")
+        if not self.token_cache_path:
+            self.temporary_directory = TemporaryDirectory()
+            self.token_cache_path = os.path.join(self.temporary_directory.name, "token_cache.bin")
+        if self.token_cache_backend == "sqlite":
+            return SqliteTokenCache(self.token_cache_path)
+        try:
+            persistence = build_encrypted_persistence(location=self.token_cache_path)
+        except Exception:
+            logging.exception("Encryption unavailable. Opting in to plain text.")
+            persistence = FilePersistence(location=self.token_cache_path)
+        return PersistedTokenCache(persistence)
 
     def get_auth_setup_for_client(self) -> dict[str, Any]:
         # returns MSAL.js settings used by the client app
@@ -143,34 +183,117 @@ class AuthenticationHelper:
             return None
 
     @staticmethod
-    async def list_groups(graph_resource_access_token: dict) -> list[str]:
+    async def list_groups(
+        graph_resource_access_token: dict, session: Optional[aiohttp.ClientSession] = None
+    ) -> list[str]:
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await AuthenticationHelper.list_groups(graph_resource_access_token, session)
+
         headers = {"Authorization": "Bearer " + graph_resource_access_token["access_token"]}
         groups = []
-        async with aiohttp.ClientSession(headers=headers) as session:
-            resp_json = None
-            resp_status = None
-            async with session.get(url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id") as resp:
-                resp_json = await resp.json()
-                resp_status = resp.status
-                if resp_status != 200:
-                    raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
-
-            while resp_status == 200:
-                value = resp_json["value"]
-                for group in value:
-                    groups.append(group["id"])
-                next_link = resp_json.get("@odata.nextLink")
-                if next_link:
-                    async with session.get(url=next_link) as resp:
-                        resp_json = await resp.json()
-                        resp_status = resp.status
-                else:
-                    break
+        resp_json = None
+        resp_status = None
+        async with session.get(
+            url="https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id&$top=999", headers=headers
+        ) as resp:
+            resp_json = await resp.json()
+            resp_status = resp.status
             if resp_status != 200:
                 raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
 
+        while resp_status == 200:
+            value = resp_json["value"]
+            for group in value:
+                groups.append(group["id"])
+            next_link = resp_json.get("@odata.nextLink")
+            if next_link:
+                async with session.get(url=next_link, headers=headers) as resp:
+                    resp_json = await resp.json()
+                    resp_status = resp.status
+            else:
+                break
+        if resp_status != 200:
+            raise AuthError(error=json.dumps(resp_json), status_code=resp_status)
+
         return groups
 
+    async def get_groups(self, oid: str, graph_resource_access_token: dict) -> list[str]:
+        """
+        Returns the groups of the user from the cache, reading them from Microsoft Graph if needed.
+        Concurrent requests for the same user share a single Graph lookup.
+        """
+        entry = self.groups_cache.get(oid)
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+            if age < self.groups_cache_ttl:
+                self.groups_cache.move_to_end(oid)
+                if age >= self.groups_refresh_after and oid not in self.groups_inflight:
+                    self.start_groups_lookup(oid, graph_resource_access_token)
+                return list(entry[1])
+        task = self.groups_inflight.get(oid) or self.start_groups_lookup(oid, graph_resource_access_token)
+        # Shield the shared lookup so that a disconnecting client doesn't cancel it for everyone else
+        return list(await asyncio.shield(task))
+
+    def start_groups_lookup(self, oid: str, graph_resource_access_token: dict) -> asyncio.Task:
+        def on_done(task: asyncio.Task):
+            self.groups_inflight.pop(oid, None)
+            # Errors are raised to the requests waiting on the lookup, a failed background refresh keeps the cached groups
+            if not task.cancelled():
+                task.exception()
+
+        task = asyncio.create_task(self.fetch_groups(oid, graph_resource_access_token))
+        self.groups_inflight[oid] = task
+        task.add_done_callback(on_done)
+        return task
+
+    async def fetch_groups(self, oid: str, graph_resource_access_token: dict) -> list[str]:
+        if self.graph_session is None or self.graph_session.closed:
+            # A single long-lived session keeps connections to Microsoft Graph alive across requests
+            self.graph_session = aiohttp.ClientSession()
+        groups = await AuthenticationHelper.list_groups(graph_resource_access_token, self.graph_session)
+        self.groups_cache[oid] = (time.monotonic(), groups)
+        self.groups_cache.move_to_end(oid)
+        while len(self.groups_cache) > self.claims_cache_max_entries:
+            self.groups_cache.popitem(last=False)
+        return groups
+
+    async def close(self):
+        for task in list(self.groups_inflight.values()):
+            task.cancel()
+        if self.graph_session is not None:
+            await self.graph_session.close()
+        if self.use_authentication:
+            self.executor.shutdown(wait=False)
+
+    @staticmethod
+    def get_token_expiration(token: str) -> Optional[float]:
+        # Reads the exp claim without validating the token, so it must only be trusted once the token has been accepted
+        try:
+            payload = token.split(".")[1]
+            claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+            return float(claims["exp"])
+        except Exception:
+            return None
+
+    def get_cached_auth_claims(self, token_hash: str) -> Optional[dict[str, Any]]:
+        entry = self.claims_cache.get(token_hash)
+        if entry is None:
+            return None
+        if time.time() >= entry[0]:
+            del self.claims_cache[token_hash]
+            return None
+        self.claims_cache.move_to_end(token_hash)
+        return copy.deepcopy(entry[1])
+
+    def set_cached_auth_claims(self, token_hash: str, expires_at: float, auth_claims: dict[str, Any]):
+        if self.claims_cache_max_entries <= 0:
+            return
+        self.claims_cache[token_hash] = (expires_at, copy.deepcopy(auth_claims))
+        self.claims_cache.move_to_end(token_hash)
+        while len(self.claims_cache) > self.claims_cache_max_entries:
+            self.claims_cache.popitem(last=False)
+
     async def get_auth_claims_if_enabled(self, headers: dict) -> dict[str, Any]:
         if not self.use_authentication:
             return {}
@@ -179,8 +302,16 @@ class AuthenticationHelper:
             # The scope is set to the Microsoft Graph API, which may need to be called for more authorization information
             # https://learn.microsoft.com/en-us/azure/active-directory/develop/v2-oauth2-on-behalf-of-flow
             auth_token = AuthenticationHelper.get_token_auth_header(headers)
-            graph_resource_access_token = self.confidential_client.acquire_token_on_behalf_of(
-                user_assertion=auth_token, scopes=["https://graph.microsoft.com/.default"]
+            token_hash = hashlib.sha256(auth_token.encode("utf-8")).hexdigest()
+            if (cached_auth_claims := self.get_cached_auth_claims(token_hash)) is not None:
+                return cached_auth_claims
+            graph_resource_access_token = await asyncio.get_running_loop().run_in_executor(
+                self.executor,
+                functools.partial(
+                    self.confidential_client.acquire_token_on_behalf_of,
+                    user_assertion=auth_token,
+                    scopes=["https://graph.microsoft.com/.default"],
+                ),
             )
             if "error" in graph_resource_access_token:
                 raise AuthError(error=str(graph_resource_access_token), status_code=401)
@@ -201,7 +332,11 @@ class AuthenticationHelper:
             )
             if missing_groups_claim or has_group_overage_claim:
                 # Read the user's groups from Microsoft Graph
-                auth_claims["groups"] = await AuthenticationHelper.list_groups(graph_resource_access_token)
+                auth_claims["groups"] = await self.get_groups(id_token_claims["oid"], graph_resource_access_token)
+
+            # The token was accepted by the On Behalf Of Flow, so its expiration can be trusted
+            if (expires_at := AuthenticationHelper.get_token_expiration(auth_token)) is not None:
+                self.set_cached_auth_claims(token_hash, expires_at, auth_claims)
             return auth_claims
         except AuthError as e:
             print(e.error)
@@ -0,0 +1,225 @@
+import asyncio
+import hashlib
+import logging
+import os
+import shutil
+import time
+from collections import OrderedDict
+from typing import AsyncGenerator, Optional
+
+from azure.storage.blob.aio import ContainerClient, StorageStreamDownloader
+
+
+class CachedBlob:
+    """
+    Metadata for a blob held by the BlobCache, with its content either in memory or in a file on disk
+    """
+
+    def __init__(self, path: str, etag: str, content_type: Optional[str], size: int):
+        self.path = path
+        self.etag = etag
+        self.content_type = content_type
+        self.size = size
+        self.validated_at = time.monotonic()
+        self.content: Optional[bytes] = None
+        self.file_path: Optional[str] = None
+
+
+class BlobCache:
+    """
+    Cache for citation blobs, in front of a blob container client.
+    Blobs are added once they have been downloaded whole, e.g. while they are streamed to a client, so that a miss
+    never delays the first byte of a response. Only blobs of at most max_item_size bytes are kept.
+    Blobs are kept in a size-aware LRU memory tier, and are demoted to an optional on-disk tier when evicted from memory.
+    Entries older than revalidate_after seconds are revalidated against the blob ETag before being served again,
+    and concurrent requests for the same blob share a single revalidation.
+    """
+
+    def __init__(
+        self,
+        container_client: ContainerClient,
+        max_memory_size: int = 64 * 1024 * 1024,
+        max_item_size: int = 4 * 1024 * 1024,
+        disk_path: Optional[str] = None,
+        max_disk_size: int = 1024 * 1024 * 1024,
+        revalidate_after: float = 60,
+    ):
+        self.container_client = container_client
+        self.max_memory_size = max_memory_size
+        self.max_item_size = max_item_size
+        self.max_disk_size = max_disk_size
+        self.revalidate_after = revalidate_after
+        self.memory_size = 0
+        self.disk_size = 0
+        self.entries: OrderedDict[str, CachedBlob] = OrderedDict()
+        self.inflight: dict[str, asyncio.Task] = {}
+        self.demoting: set[str] = set()
+        self.disk_directory: Optional[str] = None
+        if disk_path:
+            # Each worker process gets its own directory, since entries are only indexed in memory
+            self.disk_directory = os.path.join(disk_path, f"blobcache-{os.getpid()}")
+            shutil.rmtree(self.disk_directory, ignore_errors=True)
+            os.makedirs(self.disk_directory)
+
+    async def get(self, path: str) -> Optional[CachedBlob]:
+        """
+        Returns the cached blob for path, revalidating it first if needed, or None if it isn't cached (anymore).
+        Raises ResourceNotFoundError if a cached blob doesn't exist anymore.
+        """
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.validated_at < self.revalidate_after:
+            self.entries.move_to_end(path)
+            return entry
+        task = self.inflight.get(path)
+        if task is None:
+            task = asyncio.create_task(self.revalidate(path, entry))
+            self.inflight[path] = task
+            task.add_done_callback(lambda _: self.inflight.pop(path, None))
+        # Shield the shared revalidation so that a disconnecting client doesn't cancel it for everyone else
+        return await asyncio.shield(task)
+
+    async def read(self, entry: CachedBlob, start: int = 0, stop: Optional[int] = None) -> Optional[bytes]:
+        """
+        Returns the content of a blob returned by get, or None if it was evicted in the meantime,
+        in which case callers should read it from storage instead
+        """
+        if (content := entry.content) is not None:
+            return content[start:stop]
+        if (file_path := entry.file_path) is None:
+            return None
+        try:
+            return await asyncio.to_thread(self.read_file, file_path, start, stop)
+        except FileNotFoundError:
+            return None
+
+    async def revalidate(self, path: str, entry: CachedBlob) -> Optional[CachedBlob]:
+        blob_client = self.container_client.get_blob_client(path)
+        try:
+            properties = await blob_client.get_blob_properties()
+        except Exception:
+            self.remove(path)
+            raise
+        if entry.etag == properties.etag and self.entries.get(path) is entry:
+            entry.validated_at = time.monotonic()
+            self.entries.move_to_end(path)
+            return entry
+        self.remove(path)
+        return None
+
+    async def add(self, path: str, etag: str, content_type: Optional[str], content: bytes) -> Optional[CachedBlob]:
+        """Caches the whole content of a blob, unless it's larger than max_item_size"""
+        if len(content) > self.max_item_size:
+            return None
+        entry = self.entries.get(path)
+        if entry is not None and entry.etag == etag:
+            # Another request has already cached the same version
+            return entry
+        self.remove(path)
+        entry = CachedBlob(path, etag, content_type, len(content))
+        await self.store(entry, content)
+        return entry
+
+    async def stream(self, path: str, downloader: StorageStreamDownloader) -> AsyncGenerator[bytes, None]:
+        """
+        Yields the chunks of the download of a whole blob, and caches the blob once all of them have been yielded,
+        if it's small enough. Nothing is cached if the stream is closed before its end.
+        """
+        chunks: Optional[list[bytes]] = [] if downloader.size <= self.max_item_size else None
+        async for chunk in downloader.chunks():
+            if chunks is not None:
+                chunks.append(chunk)
+            yield chunk
+        if chunks is not None:
+            properties = downloader.properties
+            await self.add(path, properties.etag, properties.content_settings.content_type, b"".join(chunks))
+
+    async def store(self, entry: CachedBlob, content: bytes):
+        self.entries[entry.path] = entry
+        if entry.size <= self.max_memory_size:
+            entry.content = content
+            self.memory_size += entry.size
+        elif not await self.demote(entry, content):
+            del self.entries[entry.path]
+            return
+        await self.evict()
+
+    async def evict(self):
+        # Least recently used entries are moved from memory to disk, and dropped from disk when it is full too
+        for entry in list(self.entries.values()):
+            if self.memory_size <= self.max_memory_size:
+                break
+            if entry.content is not None and entry.path not in self.demoting:
+                # The content stays in memory until the file is written, so that the entry can be read meanwhile
+                self.demoting.add(entry.path)
+                try:
+                    demoted = await self.demote(entry, entry.content)
+                finally:
+                    self.demoting.discard(entry.path)
+                if self.entries.get(entry.path) is not entry:
+                    continue
+                if not demoted:
+                    self.remove(entry.path)
+                elif entry.content is not None:
+                    entry.content = None
+                    self.memory_size -= entry.size
+        for entry in list(self.entries.values()):
+            if self.disk_size <= self.max_disk_size:
+                break
+            if entry.file_path is not None:
+                self.remove(entry.path)
+
+    async def demote(self, entry: CachedBlob, content: bytes) -> bool:
+        if self.disk_directory is None or entry.size > self.max_disk_size:
+            return False
+        file_name = hashlib.sha256(entry.path.encode("utf-8")).hexdigest() + ".blob"
+        file_path = os.path.join(self.disk_directory, file_name)
+        try:
+            await asyncio.to_thread(self.write_file, file_path, content)
+        except OSError:
+            logging.exception("Unable to write blob %s to the disk cache", entry.path)
+            return False
+        if self.entries.get(entry.path) is not entry:
+            # The entry was removed while its file was written
+            await asyncio.to_thread(self.remove_file, file_path)
+            return False
+        entry.file_path = file_path
+        self.disk_size += entry.size
+        return True
+
+    def remove(self, path: str):
+        entry = self.entries.pop(path, None)
+        if entry is None:
+            return
+        if entry.content is not None:
+            entry.content = None
+            self.memory_size -= entry.size
+        if entry.file_path is not None:
+            self.remove_file(entry.file_path)
+            entry.file_path = None
+            self.disk_size -= entry.size
+
+    def close(self):
+        for path in list(self.entries):
+            self.remove(path)
+        if self.disk_directory is not None:
+            shutil.rmtree(self.disk_directory, ignore_errors=True)
+
+    @staticmethod
+    def remove_file(file_path: str):
+        try:
+            os.remove(file_path)
+        except OSError:
+            logging.warning("Unable to remove cached blob file %s", file_path)
+
+    @staticmethod
+    def write_file(file_path: str, content: bytes):
+        with open(file_path, "wb") as f:
+            f.write(content)
+
+    @staticmethod
+    def read_file(file_path: str, start: int, stop: Optional[int]) -> bytes:
+        with open(file_path, "rb") as f:
+            f.seek(start)
+            return f.read(-1 if stop is None else stop - start)
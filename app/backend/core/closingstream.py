@@ -0,0 +1,43 @@
+from typing import AsyncIterator, Callable, Generic, TypeVar
+
+T = TypeVar("T")
+
+
+class ClosingStream(Generic[T]):
+    """
+    Async iterator over events that calls on_close exactly once, when the events are exhausted or fail, when the stream
+    is closed, or when it's garbage collected without having been iterated to the end.
+    The last case covers response bodies that are never iterated, e.g. when the client disconnects before the response
+    starts: closing an async generator that hasn't started doesn't run its finally blocks, so they can't be relied on
+    to release resources held for the response.
+    """
+
+    def __init__(self, events: AsyncIterator[T], on_close: Callable[[], None]):
+        self.events = events
+        self.on_close = on_close
+        self.closed = False
+
+    def __aiter__(self) -> "ClosingStream[T]":
+        return self
+
+    async def __anext__(self) -> T:
+        try:
+            return await self.events.__anext__()
+        except BaseException:
+            self.close()
+            raise
+
+    async def aclose(self):
+        try:
+            if aclose := getattr(self.events, "aclose", None):
+                await aclose()
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.on_close()
+
+    def __del__(self):
+        self.close()
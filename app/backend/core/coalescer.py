@@ -0,0 +1,127 @@
+import asyncio
+import copy
+import hashlib
+import inspect
+import json
+from typing import Any, AsyncGenerator, Awaitable, Callable, Coroutine, Optional
+
+from core.answercache import AnswerCache
+from core.closingstream import ClosingStream
+
+
+class StreamBroadcast:
+    """
+    Reads an event stream once and replays it to any number of subscribers.
+    Subscribers that join late first receive the events they missed, then follow the stream live.
+    When the last subscriber goes away before the end of the stream, the stream is abandoned: it stops being read,
+    so that no more completion tokens are spent on an answer that nobody receives.
+    """
+
+    def __init__(self, source: Awaitable[AsyncGenerator[Any, None]]):
+        self.events: list[dict[str, Any]] = []
+        self.done = False
+        self.abandoned = False
+        self.subscribers = 0
+        self.error: Optional[BaseException] = None
+        self.condition = asyncio.Condition()
+        self.task = asyncio.create_task(self.produce(source))
+        # A stream abandoned before it started never awaits its source
+        if inspect.iscoroutine(source):
+            self.task.add_done_callback(lambda _: source.close())
+
+    async def produce(self, source: Awaitable[AsyncGenerator[Any, None]]):
+        try:
+            async for event in await source:
+                async with self.condition:
+                    self.events.append(event)
+                    self.condition.notify_all()
+        except Exception as error:
+            self.error = error
+        finally:
+            async with self.condition:
+                self.done = True
+                self.condition.notify_all()
+
+    def subscribe(self) -> ClosingStream[dict[str, Any]]:
+        self.subscribers += 1
+        return ClosingStream(self.replay(), self.unsubscribe)
+
+    def unsubscribe(self):
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.done:
+            self.abandoned = True
+            self.task.cancel()
+
+    async def replay(self) -> AsyncGenerator[dict[str, Any], None]:
+        index = 0
+        while True:
+            if index < len(self.events):
+                # Each subscriber may adjust its own copy, e.g. to set its session state
+                yield copy.deepcopy(self.events[index])
+                index += 1
+            elif self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            else:
+                async with self.condition:
+                    await self.condition.wait_for(lambda: index < len(self.events) or self.done)
+
+
+class RequestCoalescer:
+    """
+    Shares one execution of the approach between identical concurrent requests, i.e. requests with the same
+    normalized messages, overrides and search filter (which carries the security filter).
+    Non-streaming requests await the same result, and streaming requests receive the same events.
+    Executions are shielded so that a disconnecting client doesn't cancel them for the other requests,
+    and are forgotten as soon as they finish, so later requests always start a new execution.
+    """
+
+    def __init__(self):
+        self.inflight: dict[str, asyncio.Task] = {}
+        self.streams: dict[str, StreamBroadcast] = {}
+        self.coalesced = 0
+
+    @staticmethod
+    def make_key(
+        route: str, messages: list[dict[str, Any]], overrides: dict[str, Any], filter: Optional[str], stream: bool
+    ) -> str:
+        key = {
+            "route": route,
+            "messages": [
+                {"role": message.get("role"), "content": AnswerCache.normalize_text(str(message.get("content") or ""))}
+                for message in messages
+            ],
+            "overrides": overrides,
+            "filter": filter,
+            "stream": stream,
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    async def run(self, key: str, run: Callable[[], Coroutine[Any, Any, Any]]) -> Any:
+        task = self.inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(run())
+            self.inflight[key] = task
+            task.add_done_callback(lambda task: self.forget(self.inflight, key, task))
+        else:
+            self.coalesced += 1
+        return copy.deepcopy(await asyncio.shield(task))
+
+    def stream(self, key: str, run: Callable[[], Awaitable[Any]]) -> ClosingStream[dict[str, Any]]:
+        broadcast = self.streams.get(key)
+        if broadcast is None or broadcast.abandoned:
+            broadcast = StreamBroadcast(run())
+            self.streams[key] = broadcast
+            broadcast.task.add_done_callback(lambda _: self.forget(self.streams, key, broadcast))
+        else:
+            self.coalesced += 1
+        return broadcast.subscribe()
+
+    @staticmethod
+    def forget(executions: dict[str, Any], key: str, execution: Any):
+        if executions.get(key) is execution:
+            del executions[key]
+        # Errors are raised to the requests waiting on the execution, even if all of them have gone away
+        if isinstance(execution, asyncio.Task) and not execution.cancelled():
+            execution.exception()
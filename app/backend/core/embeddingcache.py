@@ -0,0 +1,57 @@
+import re
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+
+from core.metrics import record_cache_lookup
+
+
+class EmbeddingCache:
+    """
+    LRU cache of query embeddings, keyed by the embedding model/deployment and the normalized query text.
+    Vectors are stored as compact float32 arrays, and the least recently used ones are evicted beyond max_size bytes.
+    """
+
+    def __init__(self, max_size: int = 16 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.entries: OrderedDict[tuple[str, str], np.ndarray] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        # Embeddings are case sensitive, so unlike answer cache keys the case is preserved
+        return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+    def get(self, model: str, text: str) -> Optional[list[float]]:
+        key = (model, self.normalize_text(text))
+        vector = self.entries.get(key)
+        if vector is None:
+            self.misses += 1
+            record_cache_lookup("embedding", hit=False)
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        record_cache_lookup("embedding", hit=True)
+        return vector.tolist()
+
+    def set(self, model: str, text: str, embedding: list[float]):
+        vector = np.asarray(embedding, dtype=np.float32)
+        if vector.nbytes > self.max_size:
+            return
+        key = (model, self.normalize_text(text))
+        if (previous := self.entries.pop(key, None)) is not None:
+            self.size -= previous.nbytes
+        self.entries[key] = vector
+        self.size += vector.nbytes
+        while self.size > self.max_size:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
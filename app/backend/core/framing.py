@@ -0,0 +1,90 @@
+import asyncio
+import time
+from typing import Any, AsyncGenerator, Optional
+
+
+class DeltaCoalescer:
+    """
+    Merges consecutive content deltas of a streamed answer into larger frames, so that a long answer is sent as
+    fewer JSON lines. A frame is sent once max_delay seconds have passed since its first delta, or once it holds
+    max_size bytes of content. The first delta of the answer is always sent right away, and other events, e.g. the
+    ones carrying the context or follow-up questions, are sent unchanged, after any pending frame.
+    """
+
+    def __init__(self, max_delay: float = 0.05, max_size: int = 256):
+        self.max_delay = max_delay
+        self.max_size = max_size
+
+    @staticmethod
+    def get_content(event: dict[str, Any]) -> Optional[str]:
+        """Returns the content of an event that holds nothing but a content delta, None for any other event"""
+        choices = event.get("choices")
+        if not choices or len(choices) != 1 or event.keys() - {"choices", "object"}:
+            return None
+        choice = choices[0]
+        if choice.keys() - {"delta", "finish_reason", "index"} or choice.get("finish_reason") is not None:
+            return None
+        delta = choice.get("delta") or {}
+        if delta.keys() != {"content"} or not delta["content"]:
+            return None
+        return delta["content"]
+
+    @staticmethod
+    def finish_frame(frame: dict[str, Any], contents: list[str]) -> dict[str, Any]:
+        frame["choices"][0]["delta"]["content"] = "".join(contents)
+        return frame
+
+    async def coalesce(self, events: AsyncGenerator[dict[str, Any], None]) -> AsyncGenerator[dict[str, Any], None]:
+        frame: Optional[dict[str, Any]] = None
+        frame_contents: list[str] = []
+        frame_size = 0
+        frame_started_at = 0.0
+        first_content_sent = False
+        next_event: Optional[asyncio.Future] = None
+        try:
+            while True:
+                if next_event is None:
+                    next_event = asyncio.ensure_future(events.__anext__())
+                if frame is not None:
+                    # Wait for the next event only until the pending frame is due
+                    timeout = max(frame_started_at + self.max_delay - time.monotonic(), 0)
+                    await asyncio.wait({next_event}, timeout=timeout)
+                    if not next_event.done():
+                        yield self.finish_frame(frame, frame_contents)
+                        frame = None
+                        continue
+                try:
+                    event = await next_event
+                except StopAsyncIteration:
+                    break
+                except Exception:
+                    # Send what was received before the error, which is then raised as usual
+                    if frame is not None:
+                        yield self.finish_frame(frame, frame_contents)
+                        frame = None
+                    raise
+                finally:
+                    if next_event.done():
+                        next_event = None
+
+                content = self.get_content(event)
+                if content is None or not first_content_sent:
+                    if frame is not None:
+                        yield self.finish_frame(frame, frame_contents)
+                        frame = None
+                    first_content_sent = first_content_sent or content is not None
+                    yield event
+                    continue
+                if frame is None:
+                    frame, frame_contents, frame_size = event, [], 0
+                    frame_started_at = time.monotonic()
+                frame_contents.append(content)
+                frame_size += len(content.encode("utf-8"))
+                if frame_size >= self.max_size:
+                    yield self.finish_frame(frame, frame_contents)
+                    frame = None
+            if frame is not None:
+                yield self.finish_frame(frame, frame_contents)
+        finally:
+            if next_event is not None and not next_event.done():
+                next_event.cancel()
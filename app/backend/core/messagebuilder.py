@@ -1,3 +1,4 @@
+import functools
 import unicodedata
 
 from openai.types.chat import (
@@ -10,6 +11,30 @@ from openai.types.chat import (
 from .modelhelper import num_tokens_from_messages
 
 
+def normalize_content(content: str) -> str:
+    return unicodedata.normalize("NFC", content)
+
+
+def make_message(role: str, content: str) -> ChatCompletionMessageParam:
+    if role == "user":
+        return ChatCompletionUserMessageParam(role="user", content=content)
+    elif role == "system":
+        return ChatCompletionSystemMessageParam(role="system", content=content)
+    elif role == "assistant":
+        return ChatCompletionAssistantMessageParam(role="assistant", content=content)
+    raise ValueError(f"Invalid role: {role}")
+
+
+@functools.lru_cache(maxsize=256)
+def compile_message(role: str, content: str) -> ChatCompletionMessageParam:
+    """
+    Builds a message of a prompt, i.e. a system message or a few-shot, normalized once for all the requests that use it.
+    Messages are keyed by their role and content, so a prompt_template override is compiled the first time it's seen.
+    The compiled messages are shared, so callers insert copies of them.
+    """
+    return make_message(role, normalize_content(content))
+
+
 class MessageBuilder:
     """
     A class for building and managing messages in a chat conversation.
@@ -23,9 +48,7 @@ class MessageBuilder:
     """
 
     def __init__(self, system_content: str, chatgpt_model: str):
-        self.messages: list[ChatCompletionMessageParam] = [
-            ChatCompletionSystemMessageParam(role="system", content=self.normalize_content(system_content))
-        ]
+        self.messages: list[ChatCompletionMessageParam] = [dict(compile_message("system", system_content))]  # type: ignore
         self.model = chatgpt_model
 
     def insert_message(self, role: str, content: str, index: int = 1):
@@ -37,19 +60,17 @@ class MessageBuilder:
             content (str): The content of the message.
             index (int): The index at which to insert the message.
         """
-        message: ChatCompletionMessageParam
-        if role == "user":
-            message = ChatCompletionUserMessageParam(role="user", content=self.normalize_content(content))
-        elif role == "system":
-            message = ChatCompletionSystemMessageParam(role="system", content=self.normalize_content(content))
-        elif role == "assistant":
-            message = ChatCompletionAssistantMessageParam(role="assistant", content=self.normalize_content(content))
-        else:
-            raise ValueError(f"Invalid role: {role}")
-        self.messages.insert(index, message)
+        self.messages.insert(index, make_message(role, normalize_content(content)))
+
+    def insert_prompt_message(self, role: str, content: str, index: int = 1):
+        """
+        Inserts a message that is part of the prompt, e.g. a few-shot, rather than supplied by the user,
+        which is only normalized the first time it's seen.
+        """
+        self.messages.insert(index, dict(compile_message(role, content)))  # type: ignore
 
     def count_tokens_for_message(self, message: dict[str, str]):
         return num_tokens_from_messages(message, self.model)
 
     def normalize_content(self, content: str):
-        return unicodedata.normalize("NFC", content)
+        return normalize_content(content)
@@ -0,0 +1,236 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Coroutine,
+    Iterator,
+    Optional,
+    TypeVar,
+)
+
+from openai.types.chat import ChatCompletionChunk
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+from .closingstream import ClosingStream
+
+T = TypeVar("T")
+
+# Prometheus metrics, served from /metrics independently of Application Insights.
+# With several workers, PROMETHEUS_MULTIPROC_DIR must be set before this module is imported (gunicorn.conf.py does it),
+# so that the metrics of all workers are written to that directory and aggregated by every scrape.
+stage_duration = Histogram(
+    "app_stage_duration_seconds",
+    "Duration of each stage of the approaches, first_token being the time to the first token of a streamed answer",
+    ["approach", "stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 8, 13, 21, 34),
+)
+request_count = Counter("app_requests", "Number of requests handled by the approaches", ["route", "status"])
+request_duration = Histogram(
+    "app_request_duration_seconds",
+    "Duration of the requests handled by the approaches, until the end of streamed responses",
+    ["route"],
+    buckets=(0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89),
+)
+requests_in_flight = Gauge(
+    "app_requests_in_flight", "Number of requests being handled", ["route"], multiprocess_mode="livesum"
+)
+# The admission controller reports these too, along with the app.admission.* OpenTelemetry metrics
+admission_inflight = Gauge(
+    "app_admission_inflight", "Number of admitted requests holding a slot", multiprocess_mode="livesum"
+)
+admission_queued = Gauge(
+    "app_admission_queued", "Number of requests waiting for a free slot", multiprocess_mode="livesum"
+)
+admission_wait_time = Histogram(
+    "app_admission_wait_seconds",
+    "Time spent by admitted requests waiting for a free slot",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 34, 55),
+)
+admission_rejected = Counter(
+    "app_admission_rejected", "Number of requests rejected because the queue was full or too slow", ["reason"]
+)
+streamed_tokens = Counter("app_streamed_tokens", "Number of tokens streamed by the approaches", ["approach"])
+stream_token_rate = Histogram(
+    "app_stream_tokens_per_second",
+    "Tokens per second of each streamed answer, from its first token",
+    ["approach"],
+    buckets=(5, 10, 20, 30, 40, 60, 80, 120, 160, 240),
+)
+cache_lookups = Counter("app_cache_lookups", "Number of cache lookups, by cache and result", ["cache", "result"])
+speculations = Counter(
+    "app_speculative_retrievals",
+    "Number of retrievals started before the search query was generated, by whether their results were used",
+    ["approach", "result"],
+)
+
+
+class RequestTimings:
+    """
+    Timings of the stages of a single request, in the order they started, for the Server-Timing header and the
+    timings in the response context. A stage that runs several times, e.g. one embedding call per batch, has
+    one timing per run.
+    """
+
+    def __init__(self, started_at: Optional[float] = None):
+        self.started_at = time.perf_counter() if started_at is None else started_at
+        self.timings: list[tuple[str, float, float]] = []
+
+    def add(self, stage: str, started_at: float, duration: float):
+        self.timings.append((stage, started_at, duration))
+
+    def as_list(self, total: bool = True) -> list[dict[str, Any]]:
+        """Returns the start offsets and durations of the stages in milliseconds, with the total duration so far"""
+        timings = [
+            {
+                "name": stage,
+                "start": round((started_at - self.started_at) * 1000, 1),
+                "duration": round(duration * 1000, 1),
+            }
+            for stage, started_at, duration in sorted(self.timings, key=lambda timing: timing[1])
+        ]
+        if total:
+            timings.append(
+                {"name": "total", "start": 0.0, "duration": round((time.perf_counter() - self.started_at) * 1000, 1)}
+            )
+        return timings
+
+    def as_header(self, total: bool = True) -> str:
+        return ", ".join(f"{timing['name']};dur={timing['duration']}" for timing in self.as_list(total))
+
+
+# Timings of the request being handled, set by the app for the requests it reports timings for
+current_timings: ContextVar[Optional[RequestTimings]] = ContextVar("current_timings", default=None)
+
+
+def observe_stage(approach: str, stage: str, started_at: float, timings: Optional[RequestTimings] = None):
+    duration = time.perf_counter() - started_at
+    stage_duration.labels(approach, stage).observe(duration)
+    if timings is not None:
+        timings.add(stage, started_at, duration)
+
+
+@contextmanager
+def measure_stage(approach: str, stage: str) -> Iterator[None]:
+    timings = current_timings.get()
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(approach, stage, started_at, timings)
+
+
+async def measure_completion(approach: str, completion: Coroutine[Any, Any, Any]) -> Any:
+    """
+    Awaits a chat completion call, recording the duration of a complete answer as the "answer" stage,
+    or wrapping a streamed answer to record its time to first token and token rate
+    """
+    timings = current_timings.get()
+    started_at = time.perf_counter()
+    result = await completion
+    if hasattr(result, "__aiter__"):
+        return measure_stream(approach, result, started_at, timings)
+    observe_stage(approach, "answer", started_at, timings)
+    return result
+
+
+async def measure_stream(
+    approach: str,
+    chunks: AsyncIterator[ChatCompletionChunk],
+    started_at: float,
+    timings: Optional[RequestTimings] = None,
+) -> AsyncGenerator[ChatCompletionChunk, None]:
+    # Every content delta of a streamed completion is one token
+    tokens = 0
+    first_token_at = None
+    try:
+        async for chunk in chunks:
+            if chunk.choices and chunk.choices[0].delta.content:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                    observe_stage(approach, "first_token", started_at, timings)
+                tokens += 1
+            yield chunk
+    finally:
+        if tokens:
+            streamed_tokens.labels(approach).inc(tokens)
+        if first_token_at is not None and tokens > 1:
+            elapsed = time.perf_counter() - first_token_at
+            if elapsed > 0:
+                stream_token_rate.labels(approach).observe((tokens - 1) / elapsed)
+        # The "answer" histogram only covers complete answers, but the timings show the whole streamed answer too
+        if timings is not None:
+            timings.add("answer", started_at, time.perf_counter() - started_at)
+
+
+def record_cache_lookup(cache: str, hit: bool):
+    cache_lookups.labels(cache, "hit" if hit else "miss").inc()
+
+
+def record_speculation(approach: str, result: str):
+    speculations.labels(approach, result).inc()
+
+
+def start_request(route: str) -> float:
+    requests_in_flight.labels(route).inc()
+    return time.perf_counter()
+
+
+def finish_request(route: str, status: int, started_at: float):
+    requests_in_flight.labels(route).dec()
+    request_count.labels(route, str(status)).inc()
+    request_duration.labels(route).observe(time.perf_counter() - started_at)
+
+
+def track_stream(route: str, events: AsyncIterator[T], started_at: float) -> ClosingStream[T]:
+    """Finishes the request once the whole response has been streamed, or closed, or dropped without being sent"""
+    return ClosingStream(events, lambda: finish_request(route, 200, started_at))
+
+
+async def bind_timings(
+    events: AsyncGenerator[dict[str, Any], None], timings: RequestTimings, include_timings: bool = False
+) -> AsyncGenerator[dict[str, Any], None]:
+    """
+    Records the timings of the stages of a streamed response, which run while it's being sent, and optionally
+    sends them in the context of a last event once the answer is complete
+    """
+    while True:
+        # Each event may be read from a different task, e.g. when the deltas are coalesced
+        current_timings.set(timings)
+        try:
+            event = await events.__anext__()
+        except StopAsyncIteration:
+            break
+        yield event
+    if include_timings:
+        yield {
+            "choices": [
+                {
+                    "delta": {"role": "assistant"},
+                    "context": {"timings": timings.as_list()},
+                    "finish_reason": None,
+                    "index": 0,
+                }
+            ],
+            "object": "chat.completion.chunk",
+        }
+
+
+def generate_metrics() -> tuple[bytes, str]:
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
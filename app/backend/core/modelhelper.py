@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-import tiktoken
+from .tokencounter import get_encoding_name_for_model, token_counter
 
 MODELS_2_TOKEN_LIMITS = {
     "gpt-35-turbo": 4000,
@@ -34,10 +34,9 @@ def num_tokens_from_messages(message: dict[str, str], model: str) -> int:
         num_tokens_from_messages(message, model)
         output: 11
     """
-    encoding = tiktoken.encoding_for_model(get_oai_chatmodel_tiktok(model))
+    encoding_name = get_encoding_name_for_model(get_oai_chatmodel_tiktok(model))
     num_tokens = 2  # For "role" and "content" keys
-    for value in message.values():
-        num_tokens += len(encoding.encode(str(value)))
+    num_tokens += sum(token_counter.count_many([str(value) for value in message.values()], encoding_name))
     return num_tokens
 
 
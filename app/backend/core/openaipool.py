@@ -0,0 +1,189 @@
+import logging
+import math
+import random
+import time
+from typing import Optional
+
+import httpx
+
+# How long an endpoint is left out after a failure that didn't say when to retry
+DEFAULT_EJECTION_SECONDS = 10.0
+# The remaining quota reported by an endpoint is only trusted for this long, as it refills every minute
+REMAINING_QUOTA_TTL_SECONDS = 60.0
+
+
+class OpenAIEndpoint:
+    """An Azure OpenAI service and the name of a chat deployment on it, with what was last seen of its quota"""
+
+    def __init__(self, service: str, deployment: str):
+        self.service = service
+        self.deployment = deployment
+        self.host = f"{service}.openai.azure.com"
+        self.remaining_tokens: Optional[int] = None
+        self.remaining_requests: Optional[int] = None
+        self.updated_at = 0.0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    def __repr__(self) -> str:
+        return f"{self.service}/{self.deployment}"
+
+    def is_available(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def weight(self, now: float, default: float) -> float:
+        if self.remaining_tokens is None or now - self.updated_at > REMAINING_QUOTA_TTL_SECONDS:
+            return default
+        if self.remaining_requests == 0:
+            return 1
+        return max(self.remaining_tokens, 1)
+
+    def update(self, response: httpx.Response, now: float):
+        remaining_tokens = response.headers.get("x-ratelimit-remaining-tokens")
+        remaining_requests = response.headers.get("x-ratelimit-remaining-requests")
+        if remaining_tokens is not None and remaining_tokens.isdigit():
+            self.remaining_tokens = int(remaining_tokens)
+            self.updated_at = now
+        if remaining_requests is not None and remaining_requests.isdigit():
+            self.remaining_requests = int(remaining_requests)
+
+    def eject(self, now: float, retry_after: Optional[float]):
+        self.failures += 1
+        self.ejected_until = now + (retry_after if retry_after is not None else DEFAULT_EJECTION_SECONDS)
+
+
+def parse_endpoints(entries: list[str], default_tokens_per_minute: int) -> list[tuple[OpenAIEndpoint, int]]:
+    """
+    Parses "service/deployment" entries, each optionally followed by ":TPM" when the quota of the deployment differs
+    from default_tokens_per_minute, into endpoints and their tokens per minute. Empty entries are skipped.
+    """
+    endpoints = []
+    for entry in entries:
+        value = entry.strip()
+        if not value:
+            continue
+        name, _, tokens_per_minute = value.partition(":")
+        service, _, deployment = name.partition("/")
+        if (
+            not service
+            or not deployment
+            or "/" in deployment
+            or (tokens_per_minute and not tokens_per_minute.isdigit())
+        ):
+            raise ValueError(
+                f"Invalid OpenAI endpoint '{value}', expected 'service/deployment' or 'service/deployment:TPM'"
+            )
+        endpoints.append(
+            (
+                OpenAIEndpoint(service, deployment),
+                int(tokens_per_minute) if tokens_per_minute else default_tokens_per_minute,
+            )
+        )
+    return endpoints
+
+
+class OpenAIPoolTransport(httpx.AsyncBaseTransport):
+    """
+    HTTP transport for the Azure OpenAI client that spreads the calls to a chat deployment across several endpoints,
+    i.e. deployments of the same model on other Azure OpenAI services, to aggregate their quotas.
+    Endpoints are picked at random, weighted by the remaining tokens they report in their x-ratelimit-remaining-*
+    headers. An endpoint answering 429 or 5xx, or that can't be reached, is left out until its Retry-After has passed,
+    and the call is sent again to the next endpoint. This happens before any of the response is read,
+    so streaming and non-streaming calls fail over the same way.
+    Calls to other deployments, e.g. embeddings, are sent to the configured service unchanged.
+    """
+
+    def __init__(
+        self,
+        deployment: str,
+        endpoints: list[OpenAIEndpoint],
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        random_generator: Optional[random.Random] = None,
+    ):
+        # The deployment name used by the approaches, which is swapped for the one of the chosen endpoint
+        self.deployment = deployment
+        self.endpoints = endpoints
+        self.transport = transport or httpx.AsyncHTTPTransport()
+        self.random = random_generator or random.Random()
+
+    def choose_endpoints(self, now: float) -> list[OpenAIEndpoint]:
+        """Returns the available endpoints, in the order they should be tried"""
+        candidates = [endpoint for endpoint in self.endpoints if endpoint.is_available(now)]
+        # Endpoints without a recent quota report get the best known weight, so they are tried too
+        known_weights = [endpoint.weight(now, 0) for endpoint in candidates if endpoint.weight(now, 0) > 0]
+        default_weight = max(known_weights, default=1)
+        weights = [endpoint.weight(now, default_weight) for endpoint in candidates]
+        ordered = []
+        while candidates:
+            index = self.random.choices(range(len(candidates)), weights=weights)[0]
+            ordered.append(candidates.pop(index))
+            weights.pop(index)
+        return ordered
+
+    def rewrite(self, request: httpx.Request, endpoint: OpenAIEndpoint) -> httpx.Request:
+        path = request.url.path.replace(f"/deployments/{self.deployment}/", f"/deployments/{endpoint.deployment}/", 1)
+        headers = [(name, value) for name, value in request.headers.multi_items() if name.lower() != "host"]
+        return httpx.Request(
+            request.method,
+            request.url.copy_with(host=endpoint.host, path=path),
+            headers=headers,
+            content=request.content,
+            extensions=request.extensions,
+        )
+
+    @staticmethod
+    def get_retry_after(response: httpx.Response) -> Optional[float]:
+        retry_after_ms = response.headers.get("retry-after-ms")
+        retry_after = response.headers.get("retry-after")
+        try:
+            if retry_after_ms is not None:
+                return float(retry_after_ms) / 1000
+            if retry_after is not None:
+                return float(retry_after)
+        except ValueError:
+            pass
+        return None
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        if f"/deployments/{self.deployment}/" not in request.url.path:
+            return await self.transport.handle_async_request(request)
+
+        now = time.monotonic()
+        endpoints = self.choose_endpoints(now)
+        if not endpoints:
+            # Every endpoint is left out, so answer like the service would until the first one is back
+            retry_after = min(endpoint.ejected_until for endpoint in self.endpoints) - now
+            return httpx.Response(
+                429,
+                headers={"Retry-After": str(max(math.ceil(retry_after), 1))},
+                json={"error": {"code": "429", "message": "All the OpenAI endpoints are rate limited or unavailable"}},
+                request=request,
+            )
+
+        response: Optional[httpx.Response] = None
+        for attempt, endpoint in enumerate(endpoints):
+            endpoint.requests += 1
+            is_last = attempt == len(endpoints) - 1
+            try:
+                response = await self.transport.handle_async_request(self.rewrite(request, endpoint))
+            except httpx.TransportError as error:
+                endpoint.eject(time.monotonic(), None)
+                logging.warning("OpenAI endpoint %s failed, failing over: %s", endpoint, error)
+                if is_last:
+                    raise
+                continue
+            now = time.monotonic()
+            endpoint.update(response, now)
+            if response.status_code != 429 and response.status_code < 500:
+                return response
+            endpoint.eject(now, self.get_retry_after(response))
+            logging.warning("OpenAI endpoint %s returned %d, failing over", endpoint, response.status_code)
+            if is_last:
+                return response
+            await response.aclose()
+        assert response is not None
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
@@ -0,0 +1,69 @@
+import asyncio
+import io
+from collections import OrderedDict
+from typing import Optional
+
+from pypdf import PdfReader, PdfWriter
+
+
+class PageOutOfRangeError(Exception):
+    def __init__(self, page: int, page_count: int):
+        super().__init__(f"Page {page} is out of range, the document has {page_count} pages")
+        self.page = page
+        self.page_count = page_count
+
+
+class PdfPageCache:
+    """
+    Extracts a page, optionally with its neighbouring pages, from a PDF into a small standalone PDF.
+    Extracted documents are kept in a size-aware LRU cache keyed by the blob path, ETag and requested pages,
+    so a re-uploaded blob never serves stale pages.
+    """
+
+    def __init__(self, max_size: int = 16 * 1024 * 1024):
+        self.max_size = max_size
+        self.size = 0
+        self.entries: OrderedDict[tuple[str, str, int, int], bytes] = OrderedDict()
+
+    def get(self, path: str, etag: str, page: int, pages_around: int) -> Optional[bytes]:
+        key = (path, etag, page, pages_around)
+        content = self.entries.get(key)
+        if content is not None:
+            self.entries.move_to_end(key)
+        return content
+
+    async def extract(self, path: str, etag: str, pdf: bytes, page: int, pages_around: int = 0) -> bytes:
+        """
+        Returns a PDF with only the given 1-based page and up to pages_around pages on each side of it.
+        Raises PageOutOfRangeError if the page doesn't exist in the document.
+        """
+        if (content := self.get(path, etag, page, pages_around)) is not None:
+            return content
+        # Parsing and writing PDFs is CPU bound, so keep it off the event loop
+        content = await asyncio.to_thread(self.extract_pages, pdf, page, pages_around)
+        self.store((path, etag, page, pages_around), content)
+        return content
+
+    def store(self, key: tuple[str, str, int, int], content: bytes):
+        if len(content) > self.max_size:
+            return
+        if (previous := self.entries.pop(key, None)) is not None:
+            self.size -= len(previous)
+        self.entries[key] = content
+        self.size += len(content)
+        while self.size > self.max_size:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    @staticmethod
+    def extract_pages(pdf: bytes, page: int, pages_around: int) -> bytes:
+        reader = PdfReader(io.BytesIO(pdf))
+        page_count = len(reader.pages)
+        if page < 1 or page > page_count:
+            raise PageOutOfRangeError(page, page_count)
+        writer = PdfWriter()
+        for index in range(max(page - 1 - pages_around, 0), min(page + pages_around, page_count)):
+            writer.add_page(reader.pages[index])
+        output = io.BytesIO()
+        writer.write(output)
+        return output.getvalue()
@@ -0,0 +1,218 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from typing import Any, Optional
+
+import httpx
+
+from core.tokencounter import token_counter
+
+# Every chat and embedding model used by this app shares this encoding
+ENCODING_NAME = "cl100k_base"
+
+
+class RateLimitExceededError(Exception):
+    def __init__(self, key: str, retry_after: int):
+        super().__init__(f"Rate limit for {key} exceeded, retry after {retry_after} seconds")
+        self.key = key
+        self.retry_after = retry_after
+
+
+class SharedRateLimiter:
+    """
+    Tokens-per-minute and requests-per-minute buckets for each model deployment, stored in a SQLite database
+    so that every worker process on the host draws from the same quota.
+    A call reserves its estimated tokens up front and waits until the bucket has refilled enough for them,
+    so calls are paced under the quota instead of being rejected with 429 by the service.
+    Calls that would have to wait longer than max_wait raise RateLimitExceededError instead.
+    """
+
+    def __init__(self, path: str, limits: dict[str, tuple[int, int]], max_wait: float = 60, timeout: float = 30):
+        self.path = path
+        # Maps a deployment (or model) name to its (tokens per minute, requests per minute) quotas
+        self.limits = limits
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.local = threading.local()
+        self.tasks: set[asyncio.Future] = set()
+        with self.connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "key TEXT PRIMARY KEY, tokens REAL NOT NULL, requests REAL NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def connect(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self.local.connection = connection
+        return connection
+
+    async def reserve(self, key: str, tokens: int):
+        if key not in self.limits:
+            return
+        reservation = asyncio.ensure_future(asyncio.to_thread(self.reserve_sync, key, tokens))
+        try:
+            wait = await asyncio.shield(reservation)
+            if wait > 0:
+                logging.info("Waiting %.2f seconds for the %s rate limit", wait, key)
+                await asyncio.sleep(wait)
+        except BaseException:
+            # A call cancelled while it waits is never made, so its tokens are given back once they are reserved
+            reservation.add_done_callback(lambda reservation: self.give_back(reservation, key, tokens))
+            raise
+
+    def give_back(self, reservation: asyncio.Future, key: str, tokens: int):
+        if reservation.cancelled() or reservation.exception() is not None:
+            return
+        task = asyncio.ensure_future(self.adjust(key, tokens))
+        # Keep a reference to the task until it's done, so it isn't garbage collected
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def adjust(self, key: str, tokens: int):
+        """Gives back tokens that were reserved but not used, or takes more if the estimate was too low"""
+        if key in self.limits and tokens != 0:
+            await asyncio.to_thread(self.adjust_sync, key, tokens)
+
+    def reserve_sync(self, key: str, tokens: int, now: Optional[float] = None) -> float:
+        tokens_per_minute, requests_per_minute = self.limits[key]
+        now = time.time() if now is None else now
+        connection = self.connect()
+        # IMMEDIATE takes the write lock up front, so concurrent reservations from other workers are serialized
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            available_tokens, available_requests = self.refill(connection, key, now)
+            # The buckets may go negative: later calls then wait for the tokens reserved by earlier ones
+            wait = max(
+                (tokens - available_tokens) * 60 / tokens_per_minute,
+                (1 - available_requests) * 60 / requests_per_minute,
+                0,
+            )
+            if wait > self.max_wait:
+                raise RateLimitExceededError(key, int(wait) + 1)
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, requests, updated_at) VALUES (?, ?, ?, ?)",
+                (key, available_tokens - tokens, available_requests - 1, now),
+            )
+            connection.execute("COMMIT")
+            return wait
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def adjust_sync(self, key: str, tokens: int, now: Optional[float] = None):
+        tokens_per_minute, _ = self.limits[key]
+        now = time.time() if now is None else now
+        connection = self.connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            available_tokens, available_requests = self.refill(connection, key, now)
+            connection.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, requests, updated_at) VALUES (?, ?, ?, ?)",
+                (key, min(available_tokens + tokens, tokens_per_minute), available_requests, now),
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+
+    def refill(self, connection: sqlite3.Connection, key: str, now: float) -> tuple[float, float]:
+        tokens_per_minute, requests_per_minute = self.limits[key]
+        row = connection.execute("SELECT tokens, requests, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return tokens_per_minute, requests_per_minute
+        tokens, requests, updated_at = row
+        elapsed = max(now - updated_at, 0)
+        return (
+            min(tokens + elapsed * tokens_per_minute / 60, tokens_per_minute),
+            min(requests + elapsed * requests_per_minute / 60, requests_per_minute),
+        )
+
+
+class RateLimitedTransport(httpx.AsyncBaseTransport):
+    """
+    HTTP transport for the OpenAI client that paces chat completion and embedding calls with a SharedRateLimiter.
+    Calls are limited by the deployment (or model) name sent by the SDK, or by "service/deployment" when the limiter
+    has a quota for the Azure OpenAI service and deployment that the call is sent to, e.g. below an OpenAIPoolTransport.
+    The prompt is counted with tiktoken and max_tokens is reserved for the response, like the service does,
+    and the reservation is reconciled with the reported usage once a non-streaming response is received.
+    The whole reservation is given back when the call fails or doesn't get a 200 response.
+    """
+
+    def __init__(self, rate_limiter: SharedRateLimiter, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.rate_limiter = rate_limiter
+        self.transport = transport or httpx.AsyncHTTPTransport()
+
+    def estimate_tokens(self, body: dict[str, Any]) -> int:
+        if "messages" in body:
+            # Each message is wrapped in a few formatting tokens, and the reply is primed with 3 more
+            contents = [str(message.get("content") or "") for message in body["messages"]]
+            prompt_tokens = 3 + 4 * len(contents) + sum(token_counter.count_many(contents, ENCODING_NAME))
+            return prompt_tokens + (body.get("max_tokens") or 0)
+        inputs = body.get("input") or []
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        texts = [text for text in inputs if isinstance(text, str)]
+        # Inputs can also be lists of token ids
+        return sum(token_counter.count_many(texts, ENCODING_NAME)) + sum(
+            len(text) for text in inputs if not isinstance(text, str)
+        )
+
+    @staticmethod
+    def get_endpoint_key(request: httpx.Request) -> Optional[str]:
+        # Azure OpenAI paths look like /openai/deployments/{deployment}/chat/completions
+        parts = request.url.path.split("/")
+        if len(parts) > 3 and parts[1] == "openai" and parts[2] == "deployments":
+            return f"{request.url.host.split('.')[0]}/{parts[3]}"
+        return None
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        try:
+            body = json.loads(request.content)
+        except (ValueError, httpx.RequestNotRead):
+            body = None
+        key = self.get_endpoint_key(request)
+        if key not in self.rate_limiter.limits:
+            key = body.get("model") if isinstance(body, dict) else None
+        if key not in self.rate_limiter.limits:
+            return await self.transport.handle_async_request(request)
+
+        assert isinstance(body, dict) and isinstance(key, str)
+        reserved_tokens = await asyncio.to_thread(self.estimate_tokens, body)
+        try:
+            await self.rate_limiter.reserve(key, reserved_tokens)
+        except RateLimitExceededError as error:
+            # Answer like the service would, so the OpenAI client applies its usual retry and error handling
+            return httpx.Response(
+                429,
+                headers={"Retry-After": str(error.retry_after)},
+                json={"error": {"code": "429", "message": str(error)}},
+                request=request,
+            )
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            # The call never reached the service, or its answer was lost, so none of the tokens were used
+            await asyncio.shield(self.rate_limiter.adjust(key, reserved_tokens))
+            raise
+        if response.status_code != 200:
+            # Failed calls, e.g. 429, 400 or 5xx, don't consume the quota of the deployment
+            await self.rate_limiter.adjust(key, reserved_tokens)
+        elif not body.get("stream"):
+            # The content is kept by the response, so the OpenAI client can still read it afterwards
+            await response.aread()
+            try:
+                usage = json.loads(response.content).get("usage") or {}
+            except ValueError:
+                usage = {}
+            if "total_tokens" in usage:
+                await self.rate_limiter.adjust(key, reserved_tokens - usage["total_tokens"])
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
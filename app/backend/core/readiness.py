@@ -0,0 +1,43 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable
+
+
+class Readiness:
+    """
+    Tracks whether this worker is ready to answer quickly, i.e. whether its warm-ups are done. A warm-up is a cheap
+    call that opens the connection pool of a client (DNS lookup, TLS handshake, access token), so that the first
+    requests don't pay for it. Warm-ups run in the background and are retried with an exponential backoff, up to
+    max_retry_delay seconds, until they reach their service. They should return normally on any response of the
+    service, even an error, since the connection is open by then.
+    """
+
+    def __init__(self, max_retry_delay: float = 60):
+        self.max_retry_delay = max_retry_delay
+        self.pending: set[str] = set()
+        self.tasks: list[asyncio.Task] = []
+
+    @property
+    def ready(self) -> bool:
+        return not self.pending
+
+    def start(self, name: str, warm_up: Callable[[], Awaitable[Any]]):
+        self.pending.add(name)
+        self.tasks.append(asyncio.create_task(self.run(name, warm_up)))
+
+    async def run(self, name: str, warm_up: Callable[[], Awaitable[Any]]):
+        delay = 1.0
+        while True:
+            try:
+                await warm_up()
+                break
+            except Exception as error:
+                logging.warning("Unable to warm up %s, retrying in %.0f seconds: %s", name, delay, error)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+        self.pending.discard(name)
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
@@ -0,0 +1,53 @@
+import json
+from types import ModuleType
+from typing import Any, Callable, Optional
+
+from openai.types.chat import ChatCompletionChunk
+from quart.json.provider import DefaultJSONProvider
+
+# orjson is several times faster than the standard library, and is installed with the app,
+# but the standard library is used when it's missing
+orjson: Optional[ModuleType]
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def dumps(obj: Any, default: Optional[Callable[[Any], Any]] = None, sort_keys: bool = False) -> str:
+    """
+    Serializes to compact JSON, keeping non-ASCII characters as they are.
+    With orjson, non-str keys are converted to strings like the standard library does, and datetimes and dataclasses
+    are passed to default instead of being serialized by orjson, so the output of both backends is the same,
+    except that orjson writes NaN and infinities as null instead of the non-standard NaN and Infinity,
+    and raises TypeError for integers that don't fit in 64 bits.
+    """
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=default, option=option).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=default, sort_keys=sort_keys)
+
+
+def encode_chunk(chunk: ChatCompletionChunk) -> dict[str, Any]:
+    """
+    Converts a streamed completion chunk to the event sent to the browser, with only the fields the frontend reads,
+    instead of dumping the whole pydantic model
+    """
+    choices = []
+    for choice in chunk.choices:
+        delta: dict[str, Any] = {}
+        if choice.delta.role is not None:
+            delta["role"] = choice.delta.role
+        if choice.delta.content is not None:
+            delta["content"] = choice.delta.content
+        choices.append({"delta": delta, "finish_reason": choice.finish_reason, "index": choice.index})
+    return {"choices": choices, "object": "chat.completion.chunk"}
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Serializes the JSON responses of the app with dumps, with sorted keys like the default provider"""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return dumps(obj, default=self.default, sort_keys=self.sort_keys)
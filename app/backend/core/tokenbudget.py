@@ -0,0 +1,65 @@
+from typing import Optional
+
+from .modelhelper import (
+    get_oai_chatmodel_tiktok,
+    get_token_limit,
+    num_tokens_from_messages,
+)
+from .tokencounter import get_encoding_name_for_model, token_counter
+
+
+class TokenBudget:
+    """
+    Plans how a prompt spends the context window of a chat model, by real token counts.
+    The response reserve is set aside first, then the messages that every prompt needs (system prompt, few-shots and
+    question) are reserved, then the sources are packed in rank order and the history newest first into what's left.
+    Sources and history messages that don't fit are dropped whole, and counted in dropped_sources and truncated_history.
+    """
+
+    def __init__(self, model: str, response_tokens: int, token_limit: Optional[int] = None):
+        self.model = model
+        self.token_limit = token_limit if token_limit is not None else get_token_limit(model)
+        self.response_tokens = response_tokens
+        self.used = 0
+        self.dropped_sources = 0
+        self.truncated_history = 0
+
+    @property
+    def available(self) -> int:
+        return max(self.token_limit - self.response_tokens - self.used, 0)
+
+    def reserve(self, role: str, content: str) -> int:
+        tokens = num_tokens_from_messages({"role": role, "content": content}, self.model)
+        self.used += tokens
+        return tokens
+
+    def pack_sources(self, sources: list[str], share: float = 1.0) -> list[str]:
+        """
+        Keeps the sources, in rank order, until they would use more than share of the available tokens,
+        so that the rest is left for the history
+        """
+        max_tokens = int(self.available * share)
+        encoding_name = get_encoding_name_for_model(get_oai_chatmodel_tiktok(self.model))
+        packed = []
+        tokens = 0
+        for source, count in zip(sources, token_counter.count_many(sources, encoding_name)):
+            # Sources are joined by newlines, which take a token each
+            if tokens + count + 1 > max_tokens:
+                break
+            packed.append(source)
+            tokens += count + 1
+        self.used += tokens
+        self.dropped_sources = len(sources) - len(packed)
+        return packed
+
+    def pack_history(self, history: list[dict[str, str]]) -> list[dict[str, str]]:
+        """Keeps the most recent messages of the history that fit in the available tokens, in their original order"""
+        packed = []
+        for message in reversed(history):
+            tokens = num_tokens_from_messages(message, self.model)
+            if tokens > self.available:
+                break
+            packed.append(message)
+            self.used += tokens
+        self.truncated_history = len(history) - len(packed)
+        return list(reversed(packed))
@@ -0,0 +1,92 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from msal import TokenCache
+
+
+class SqliteTokenCache(TokenCache):
+    """
+    MSAL token cache stored in a SQLite database, so that several worker processes on the same machine can share tokens.
+    Unlike the file persistence from msal-extensions, each token is its own row: reads don't take a lock on the whole
+    cache and writes only touch the modified token, with concurrent access handled by SQLite in WAL mode.
+    Each write also deletes the expired rows: access tokens expire when the service says, and the other entries
+    (refresh tokens, accounts...) once they haven't been written for max_age seconds, which defaults to the 90 days
+    after which Microsoft Entra ID refresh tokens expire when they aren't used.
+    """
+
+    def __init__(self, path: str, timeout: float = 30, max_age: float = 90 * 24 * 3600):
+        super().__init__()
+        self.path = path
+        self.timeout = timeout
+        self.max_age = max_age
+        self.local = threading.local()
+        with self.connect() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS tokens ("
+                "credential_type TEXT NOT NULL, key TEXT NOT NULL, home_account_id TEXT, entry TEXT NOT NULL, "
+                "expires_at REAL, PRIMARY KEY (credential_type, key))"
+            )
+            # Databases created before expires_at was added keep their rows until they are written again
+            columns = [row[1] for row in connection.execute("PRAGMA table_info(tokens)")]
+            if "expires_at" not in columns:
+                connection.execute("ALTER TABLE tokens ADD COLUMN expires_at REAL")
+            connection.execute("CREATE INDEX IF NOT EXISTS tokens_account ON tokens (credential_type, home_account_id)")
+            connection.execute("CREATE INDEX IF NOT EXISTS tokens_expires_at ON tokens (expires_at)")
+
+    def connect(self) -> sqlite3.Connection:
+        # MSAL is called from a thread pool, and SQLite connections can't be shared across threads
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+        return connection
+
+    def find(self, credential_type, target=None, query=None):
+        target_set = set(target or [])
+        query = query or {}
+        if "home_account_id" in query:
+            rows = self.connect().execute(
+                "SELECT entry FROM tokens WHERE credential_type = ? AND home_account_id = ?",
+                (credential_type, query["home_account_id"]),
+            )
+        else:
+            rows = self.connect().execute("SELECT entry FROM tokens WHERE credential_type = ?", (credential_type,))
+        entries = [json.loads(row[0]) for row in rows]
+        return [
+            entry
+            for entry in entries
+            if all(entry.get(name) == value for name, value in query.items())
+            and (target_set <= set(entry.get("target", "").split()) if target_set else True)
+        ]
+
+    def get_expires_at(self, entry: dict, now: float) -> float:
+        expires_on: Optional[str] = entry.get("expires_on")
+        if expires_on is not None and str(expires_on).isdigit():
+            return float(expires_on)
+        return now + self.max_age
+
+    def modify(self, credential_type, old_entry, new_key_value_pairs=None):
+        key = self.key_makers[credential_type](**old_entry)
+        with self.connect() as connection:
+            if new_key_value_pairs:
+                now = time.time()
+                entry = dict(old_entry, **new_key_value_pairs)
+                connection.execute("DELETE FROM tokens WHERE expires_at < ?", (now,))
+                connection.execute(
+                    "INSERT OR REPLACE INTO tokens (credential_type, key, home_account_id, entry, expires_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (
+                        credential_type,
+                        key,
+                        entry.get("home_account_id"),
+                        json.dumps(entry),
+                        self.get_expires_at(entry, now),
+                    ),
+                )
+            else:
+                connection.execute("DELETE FROM tokens WHERE credential_type = ? AND key = ?", (credential_type, key))
@@ -0,0 +1,99 @@
+import functools
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import tiktoken
+
+# Texts whose misses add up to this many characters are encoded with tiktoken's thread pool
+BATCH_THRESHOLD = 32768
+# Encodings of the chat and embedding models used by the app
+ENCODING_NAMES = ["cl100k_base"]
+# Encoding files downloaded by scripts/downloadencodings.py when the app is packaged
+BUNDLED_CACHE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tiktoken_cache")
+
+
+def use_bundled_cache() -> bool:
+    """
+    Makes tiktoken read the encodings bundled with the app, instead of downloading them into a temporary directory
+    on the first use in every process, unless another cache directory is configured
+    """
+    if "TIKTOKEN_CACHE_DIR" in os.environ or "DATA_GYM_CACHE_DIR" in os.environ:
+        return False
+    if not os.path.isdir(BUNDLED_CACHE_DIR):
+        return False
+    os.environ["TIKTOKEN_CACHE_DIR"] = BUNDLED_CACHE_DIR
+    return True
+
+
+def load_encodings(encoding_names: list[str] = ENCODING_NAMES):
+    for encoding_name in encoding_names:
+        get_encoding(encoding_name)
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(encoding_name: str) -> tiktoken.Encoding:
+    return tiktoken.get_encoding(encoding_name)
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding_name_for_model(model: str) -> str:
+    return tiktoken.encoding_name_for_model(model)
+
+
+class TokenCounter:
+    """
+    Counts the tokens of texts with tiktoken, resolving each encoding once and memoizing the counts by encoding
+    and content hash in a LRU of max_entries counts, so that the history of a conversation, the few-shots and the
+    prompts are only encoded once across turns. Many or long texts missing from the LRU are encoded together with
+    tiktoken's encode_batch, which spreads them over num_threads threads.
+    Counts are read and stored under a lock, since they are also requested from worker threads.
+    """
+
+    def __init__(self, max_entries: int = 65536, num_threads: int = 4):
+        self.max_entries = max_entries
+        self.num_threads = num_threads
+        self.counts: OrderedDict[tuple[str, bytes], int] = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(encoding_name: str, text: str) -> tuple[str, bytes]:
+        return encoding_name, hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def count(self, text: str, encoding_name: str) -> int:
+        return self.count_many([text], encoding_name)[0]
+
+    def count_many(self, texts: list[str], encoding_name: str) -> list[int]:
+        keys = [self.make_key(encoding_name, text) for text in texts]
+        counts: list[Optional[int]] = [None] * len(texts)
+        with self.lock:
+            for index, key in enumerate(keys):
+                if (count := self.counts.get(key)) is not None:
+                    self.counts.move_to_end(key)
+                    counts[index] = count
+            missing = [index for index, count in enumerate(counts) if count is None]
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        if missing:
+            encoding = get_encoding(encoding_name)
+            missing_texts = [texts[index] for index in missing]
+            if len(missing_texts) > 1 and sum(len(text) for text in missing_texts) >= BATCH_THRESHOLD:
+                tokens = encoding.encode_batch(missing_texts, num_threads=self.num_threads)
+            else:
+                tokens = [encoding.encode(text) for text in missing_texts]
+            with self.lock:
+                for index, text_tokens in zip(missing, tokens):
+                    counts[index] = len(text_tokens)
+                    self.counts[keys[index]] = len(text_tokens)
+                    self.counts.move_to_end(keys[index])
+                while len(self.counts) > self.max_entries:
+                    self.counts.popitem(last=False)
+        return [count for count in counts if count is not None]
+
+
+# Shared by the message builders and the rate limiter of every request
+token_counter = TokenCounter()
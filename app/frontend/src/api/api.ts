@@ -41,5 +41,11 @@ export async function chatApi(request: ChatAppRequest, idToken: string | undefin
 }
 
 export function getCitationFilePath(citation: string): string {
+    // Only the cited page of a PDF is downloaded, so the page fragment becomes a query parameter.
+    // The fragment is dropped, since the returned document starts at the cited page.
+    const pageMatch = citation.match(/^(.+\.pdf)#page=(\d+)$/i);
+    if (pageMatch) {
+        return `${BACKEND_URI}/content/${pageMatch[1]}?page=${pageMatch[2]}`;
+    }
     return `${BACKEND_URI}/content/${citation}`;
 }
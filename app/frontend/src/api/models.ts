@@ -17,6 +17,8 @@ export type ChatAppRequestOverrides = {
     suggest_followup_questions?: boolean;
     use_oid_security_filter?: boolean;
     use_groups_security_filter?: boolean;
+    dry_run?: boolean;
+    speculative_retrieval?: boolean;
 };
 
 export type ResponseMessage = {
@@ -28,6 +30,24 @@ export type ResponseContext = {
     thoughts: string | null;
     data_points: string[];
     followup_questions: string[] | null;
+    timings?: ResponseTiming[];
+    dry_run?: DryRunInfo;
+};
+
+export type DryRunInfo = {
+    messages: ResponseMessage[];
+    token_counts: number[];
+    total_tokens: number;
+    token_limit: number;
+    truncated_history: number;
+    dropped_sources: number;
+    timings: ResponseTiming[];
+};
+
+export type ResponseTiming = {
+    name: string;
+    start: number;
+    duration: number;
 };
 
 export type ResponseChoice = {
@@ -48,6 +68,7 @@ export type ChatAppResponse = {
 
 export type ChatAppRequestContext = {
     overrides?: ChatAppRequestOverrides;
+    include_timings?: boolean;
 };
 
 export type ChatAppRequest = {
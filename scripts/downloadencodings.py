@@ -0,0 +1,47 @@
+import argparse
+import hashlib
+import os
+import urllib.request
+
+# Encodings of the chat and embedding models used by the app
+ENCODING_NAMES = ["cl100k_base"]
+ENCODING_URL = "https://openaipublic.blob.core.windows.net/encodings/{encoding_name}.tiktoken"
+
+
+def download_encodings(cache_dir: str, encoding_names: list[str]) -> list[str]:
+    """
+    Downloads the tiktoken encodings into a cache directory laid out like tiktoken's own cache, so that tiktoken loads
+    them from disk, without any network access, when TIKTOKEN_CACHE_DIR points to that directory.
+    Only needs the standard library, so it can run before any dependency is installed.
+    Returns the paths of the files that were downloaded, skipping the ones already in the cache.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    downloaded = []
+    for encoding_name in encoding_names:
+        url = ENCODING_URL.format(encoding_name=encoding_name)
+        # tiktoken names the cached files after the SHA-1 of their URL
+        path = os.path.join(cache_dir, hashlib.sha1(url.encode()).hexdigest())
+        if os.path.exists(path):
+            continue
+        with urllib.request.urlopen(url, timeout=60) as response:
+            contents = response.read()
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            f.write(contents)
+        os.replace(temporary_path, path)
+        downloaded.append(path)
+    return downloaded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Download the tiktoken encodings into a local cache, so they don't need to be downloaded at runtime",
+        epilog="Example: python ./scripts/downloadencodings.py ./app/backend/tiktoken_cache",
+    )
+    parser.add_argument("cache_dir", help="Directory to use as TIKTOKEN_CACHE_DIR")
+    parser.add_argument(
+        "--encoding", action="append", help="Name of an encoding to download, can be repeated (default: cl100k_base)"
+    )
+    args = parser.parse_args()
+    for path in download_encodings(args.cache_dir, args.encoding or ENCODING_NAMES):
+        print(f"Downloaded {path}")
@@ -1,5 +1,6 @@
 import argparse
 import asyncio
+import os
 from typing import Any, Optional, Union
 
 from azure.core.credentials import AzureKeyCredential
@@ -132,6 +133,11 @@ async def main(strategy: Strategy, credential: AsyncTokenCredential, args: Any):
 
 
 if __name__ == "__main__":
+    # Keep the tiktoken encodings next to the script rather than in a temporary directory, so they are downloaded once,
+    # and can be downloaded beforehand with downloadencodings.py for machines without internet access
+    os.environ.setdefault(
+        "TIKTOKEN_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "tiktoken_cache")
+    )
     parser = argparse.ArgumentParser(
         description="Prepare documents by extracting content from PDFs, splitting content into sections, uploading to blob storage, and indexing in a search index.",
         epilog="Example: prepdocs.py '..\data\*' --storageaccount myaccount --container mycontainer --searchservice mysearch --index myindex -v",
@@ -1,3 +1,4 @@
+import functools
 import time
 from abc import ABC
 from typing import List, Optional, Union
@@ -14,6 +15,11 @@ from tenacity import (
 )
 
 
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(model_name)
+
+
 class EmbeddingBatch:
     """
     Represents a batch of text that is going to be embedded
@@ -45,8 +51,11 @@ class OpenAIEmbeddings(ABC):
             print("Rate limited on the OpenAI embeddings API, sleeping before retrying...")
 
     def calculate_token_length(self, text: str):
-        encoding = tiktoken.encoding_for_model(self.open_ai_model_name)
-        return len(encoding.encode(text))
+        return len(get_encoding(self.open_ai_model_name).encode(text))
+
+    def calculate_token_lengths(self, texts: List[str]) -> List[int]:
+        # The texts are encoded in parallel by tiktoken's thread pool
+        return [len(tokens) for tokens in get_encoding(self.open_ai_model_name).encode_batch(texts)]
 
     def split_text_into_batches(self, texts: List[str]) -> List[EmbeddingBatch]:
         batch_info = OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL.get(self.open_ai_model_name)
@@ -60,8 +69,7 @@ class OpenAIEmbeddings(ABC):
         batches: List[EmbeddingBatch] = []
         batch: List[str] = []
         batch_token_length = 0
-        for text in texts:
-            text_token_length = self.calculate_token_length(text)
+        for text, text_token_length in zip(texts, self.calculate_token_lengths(texts)):
             if batch_token_length + text_token_length >= batch_token_limit and len(batch) > 0:
                 batches.append(EmbeddingBatch(batch, batch_token_length))
                 batch = []
@@ -12,6 +12,7 @@ import pytest
 import pytest_asyncio
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.search.documents.aio import SearchClient
+from openai.resources.models import AsyncModels
 from openai.types import CreateEmbeddingResponse, Embedding
 from openai.types.chat import ChatCompletion, ChatCompletionChunk
 from openai.types.chat.chat_completion import (
@@ -216,6 +217,12 @@ def mock_acs_search_filter(monkeypatch):
     monkeypatch.setattr(SearchClient, "search", mock_search)
 
 
+@pytest.fixture
+def mock_warm_up(monkeypatch):
+    monkeypatch.setattr(AsyncModels, "list", mock.AsyncMock())
+    monkeypatch.setattr(SearchClient, "get_document_count", mock.AsyncMock(return_value=1))
+
+
 envs = [
     {
         "OPENAI_HOST": "openai",
@@ -265,7 +272,9 @@ def mock_env(monkeypatch, request):
 
 
 @pytest_asyncio.fixture()
-async def client(monkeypatch, mock_env, mock_openai_chatcompletion, mock_openai_embedding, mock_acs_search, request):
+async def client(
+    monkeypatch, mock_env, mock_openai_chatcompletion, mock_openai_embedding, mock_acs_search, mock_warm_up, request
+):
     quart_app = app.create_app()
 
     async with quart_app.test_app() as test_app:
@@ -283,6 +292,7 @@ async def auth_client(
     mock_confidential_client_success,
     mock_list_groups_success,
     mock_acs_search_filter,
+    mock_warm_up,
     request,
 ):
     monkeypatch.setenv("AZURE_STORAGE_ACCOUNT", "test-storage-account")
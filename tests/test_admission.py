@@ -0,0 +1,158 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+from core.admission import AdmissionController, AdmissionRejectedError
+
+
+@pytest.mark.asyncio
+async def test_admission_fifo():
+    controller = AdmissionController(max_inflight=1, max_queue=2, max_wait=5)
+    assert await controller.acquire() == 0
+    admitted = []
+
+    async def wait(name):
+        await controller.acquire()
+        admitted.append(name)
+
+    waiters = [asyncio.create_task(wait(name)) for name in ("first", "second")]
+    await asyncio.sleep(0)
+    assert controller.queued == 2
+
+    controller.release(0.1)
+    await asyncio.sleep(0.01)
+    assert admitted == ["first"]
+    assert controller.inflight == 1
+    controller.release(0.1)
+    await asyncio.gather(*waiters)
+    assert admitted == ["first", "second"]
+    assert controller.last_wait_time > 0
+    controller.release(0.1)
+    assert controller.inflight == 0
+    assert controller.queued == 0
+    assert controller.admitted == 3
+
+
+@pytest.mark.asyncio
+async def test_admission_queue_full():
+    controller = AdmissionController(max_inflight=1, max_queue=0)
+    controller.average_service_time = 2.5
+    await controller.acquire()
+    with pytest.raises(AdmissionRejectedError) as exc_info:
+        await controller.acquire()
+    assert exc_info.value.reason == "queue_full"
+    assert exc_info.value.retry_after == 3
+    assert controller.rejected == 1
+
+
+@pytest.mark.asyncio
+async def test_admission_deadline():
+    controller = AdmissionController(max_inflight=1, max_queue=10, max_wait=5)
+    # Requests take 10 seconds on average, so no queued request could start within 5 seconds
+    controller.average_service_time = 10
+    await controller.acquire()
+    with pytest.raises(AdmissionRejectedError) as exc_info:
+        await controller.acquire()
+    assert exc_info.value.reason == "deadline"
+    assert controller.queued == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_timeout():
+    controller = AdmissionController(max_inflight=1, max_queue=10, max_wait=0.01)
+    controller.average_service_time = 0
+    await controller.acquire()
+    with pytest.raises(AdmissionRejectedError) as exc_info:
+        await controller.acquire()
+    assert exc_info.value.reason == "timeout"
+    assert controller.queued == 0
+    controller.release(0)
+    assert controller.inflight == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_cancelled():
+    controller = AdmissionController(max_inflight=1, max_queue=10)
+    await controller.acquire()
+    cancelled = asyncio.create_task(controller.acquire())
+    waiting = asyncio.create_task(controller.acquire())
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    await asyncio.sleep(0.01)
+    assert controller.queued == 1
+
+    controller.release(0)
+    await waiting
+    assert controller.inflight == 1
+    controller.release(0)
+    assert controller.inflight == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_hold():
+    controller = AdmissionController(max_inflight=1)
+
+    async def events():
+        yield {"index": 0}
+        yield {"index": 1}
+
+    await controller.acquire()
+    stream = controller.hold(events(), 0)
+    assert await stream.__anext__() == {"index": 0}
+    assert controller.inflight == 1
+    assert [event async for event in stream] == [{"index": 1}]
+    assert controller.inflight == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_hold_closed_before_start():
+    controller = AdmissionController(max_inflight=1)
+
+    async def events():
+        yield {"index": 0}
+
+    await controller.acquire()
+    stream = controller.hold(events(), 0)
+    # The client disconnected before the response started
+    await stream.aclose()
+    assert controller.inflight == 0
+    # The slot is released only once
+    await stream.aclose()
+    assert controller.inflight == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_hold_dropped():
+    controller = AdmissionController(max_inflight=1)
+
+    async def events():
+        yield {"index": 0}
+
+    await controller.acquire()
+    stream = controller.hold(events(), 0)
+    # The response body is dropped without ever being iterated or closed
+    del stream
+    assert controller.inflight == 0
+
+
+@pytest.mark.asyncio
+async def test_admission_prometheus_metrics():
+    def sample(name: str, **labels) -> float:
+        return REGISTRY.get_sample_value(name, labels) or 0.0
+
+    rejected = sample("app_admission_rejected_total", reason="queue_full")
+    waits = sample("app_admission_wait_seconds_count")
+    controller = AdmissionController(max_inflight=1, max_queue=1, max_wait=5)
+    await controller.acquire()
+    assert sample("app_admission_inflight") >= 1
+    waiter = asyncio.create_task(controller.acquire())
+    await asyncio.sleep(0)
+    assert sample("app_admission_queued") >= 1
+    with pytest.raises(AdmissionRejectedError):
+        await controller.acquire()
+    assert sample("app_admission_rejected_total", reason="queue_full") == rejected + 1
+    controller.release(0.1)
+    await waiter
+    controller.release(0.1)
+    assert sample("app_admission_wait_seconds_count") == waits + 2
@@ -0,0 +1,188 @@
+import pytest
+
+from core.answercache import AnswerCache, IndexVersionedCache, SemanticCache
+
+
+def make_key(content="What is the capital of France?", overrides={}, filter=None, approach="chat"):
+    return AnswerCache.make_key(approach, [{"role": "user", "content": content}], overrides, "gpt-35-turbo", filter)
+
+
+def test_make_key_normalizes_messages():
+    assert make_key("What is the capital of France?") == make_key("  what is the\ncapital of   FRANCE? ")
+    assert make_key("á") == make_key("á")
+    assert make_key("What is the capital of France?") != make_key("What is the capital of Spain?")
+
+
+def test_make_key_partitions():
+    assert make_key(overrides={"top": 3}) != make_key(overrides={"top": 5})
+    assert make_key(approach="ask") != make_key(approach="chat")
+    # Answers trimmed by the security filter must never be shared across users
+    assert make_key(filter="oids/any(g:search.in(g, 'OID_X'))") != make_key(filter="oids/any(g:search.in(g, 'OID_Y'))")
+    assert make_key(filter="oids/any(g:search.in(g, 'OID_X'))") != make_key()
+
+
+def test_indexversionedcache_requires_invalidate():
+    class IncompleteCache(IndexVersionedCache):
+        pass
+
+    with pytest.raises(TypeError):
+        IncompleteCache()
+
+
+@pytest.mark.asyncio
+async def test_answercache_get_set():
+    answer_cache = AnswerCache()
+    key = make_key()
+    assert await answer_cache.get(key) is None
+    answer = {"choices": [{"message": {"content": "Paris"}}]}
+    answer_cache.set(key, answer)
+    cached_answer = await answer_cache.get(key)
+    assert cached_answer == answer
+    # Callers can safely mutate the returned answer
+    cached_answer["choices"][0]["session_state"] = "state"
+    assert await answer_cache.get(key) == answer
+    assert answer_cache.hits == 2
+    assert answer_cache.misses == 1
+
+
+@pytest.mark.asyncio
+async def test_answercache_ttl():
+    answer_cache = AnswerCache(ttl=-1)
+    answer_cache.set("key", {"answer": 1})
+    assert await answer_cache.get("key") is None
+    assert "key" not in answer_cache.entries
+
+
+@pytest.mark.asyncio
+async def test_answercache_max_entries():
+    answer_cache = AnswerCache(max_entries=2)
+    answer_cache.set("a", {"answer": "a"})
+    answer_cache.set("b", {"answer": "b"})
+    await answer_cache.get("a")
+    answer_cache.set("c", {"answer": "c"})
+    assert list(answer_cache.entries) == ["a", "c"]
+
+
+@pytest.mark.asyncio
+async def test_answercache_disabled():
+    answer_cache = AnswerCache(max_entries=0)
+    answer_cache.set("a", {"answer": "a"})
+    assert await answer_cache.get("a") is None
+
+
+@pytest.mark.asyncio
+async def test_answercache_index_version():
+    index_versions = [10, 10, 11]
+
+    async def get_index_version():
+        return index_versions.pop(0)
+
+    answer_cache = AnswerCache(get_index_version=get_index_version, index_check_interval=0)
+    answer_cache.set("a", {"answer": "a"})
+    assert await answer_cache.get("a") == {"answer": "a"}
+    assert await answer_cache.get("a") == {"answer": "a"}
+    # The index changed, so every cached answer is dropped
+    assert await answer_cache.get("a") is None
+    assert answer_cache.index_version == 11
+
+
+@pytest.mark.asyncio
+async def test_answercache_index_version_error():
+    async def get_index_version():
+        raise ZeroDivisionError("something bad happened")
+
+    answer_cache = AnswerCache(get_index_version=get_index_version, index_check_interval=0)
+    answer_cache.set("a", {"answer": "a"})
+    assert await answer_cache.get("a") == {"answer": "a"}
+
+
+def test_make_partition():
+    partition = SemanticCache.make_partition("chat", {"top": 3}, "gpt-35-turbo", None)
+    assert partition == SemanticCache.make_partition("chat", {"top": 3}, "gpt-35-turbo", None)
+    assert partition != SemanticCache.make_partition("ask", {"top": 3}, "gpt-35-turbo", None)
+    assert partition != SemanticCache.make_partition("chat", {"top": 5}, "gpt-35-turbo", None)
+    assert partition != SemanticCache.make_partition(
+        "chat", {"top": 3}, "gpt-35-turbo", "oids/any(g:search.in(g, 'X'))"
+    )
+
+
+@pytest.mark.asyncio
+async def test_semanticcache_threshold():
+    semantic_cache = SemanticCache(threshold=0.9, max_entries=4)
+    assert await semantic_cache.get("p", [1.0, 0.0]) is None
+    semantic_cache.add("p", [1.0, 0.0], {"answer": "east"})
+    semantic_cache.add("p", [0.0, 1.0], {"answer": "north"})
+    # Only the direction matters, not the magnitude
+    assert await semantic_cache.get("p", [2.0, 0.1]) == {"answer": "east"}
+    assert await semantic_cache.get("p", [0.1, 3.0]) == {"answer": "north"}
+    assert await semantic_cache.get("p", [1.0, 1.0]) is None
+    assert await semantic_cache.get("p", [0.0, 0.0]) is None
+    assert semantic_cache.hits == 2
+    assert semantic_cache.misses == 3
+    assert semantic_cache.hit_rate == 0.4
+
+
+@pytest.mark.asyncio
+async def test_semanticcache_partitions():
+    semantic_cache = SemanticCache(max_entries=4)
+    semantic_cache.add("user-x", [1.0, 0.0], {"answer": "x"})
+    assert await semantic_cache.get("user-y", [1.0, 0.0]) is None
+    semantic_cache.add("user-y", [1.0, 0.0], {"answer": "y"})
+    assert await semantic_cache.get("user-x", [1.0, 0.0]) == {"answer": "x"}
+    assert await semantic_cache.get("user-y", [1.0, 0.0]) == {"answer": "y"}
+
+
+@pytest.mark.asyncio
+async def test_semanticcache_partitions_dropped():
+    semantic_cache = SemanticCache(max_entries=2)
+    for user in range(10):
+        semantic_cache.add(f"user-{user}", [1.0, 0.0], {"answer": str(user)})
+    # Only the partitions of the answers still in the cache are kept
+    assert sorted(semantic_cache.partitions) == ["user-8", "user-9"]
+    assert await semantic_cache.get("user-9", [1.0, 0.0]) == {"answer": "9"}
+    semantic_cache.ttl = -1
+    semantic_cache.add("user-10", [1.0, 0.0], {"answer": "10"})
+    assert list(semantic_cache.partitions) == ["user-10"]
+    semantic_cache.invalidate()
+    assert semantic_cache.partitions == {}
+
+
+@pytest.mark.asyncio
+async def test_semanticcache_eviction():
+    semantic_cache = SemanticCache(max_entries=2)
+    semantic_cache.add("p", [1.0, 0.0, 0.0], {"answer": "a"})
+    semantic_cache.add("p", [0.0, 1.0, 0.0], {"answer": "b"})
+    await semantic_cache.get("p", [1.0, 0.0, 0.0])
+    semantic_cache.add("p", [0.0, 0.0, 1.0], {"answer": "c"})
+    # b was the least recently used answer
+    assert await semantic_cache.get("p", [0.0, 1.0, 0.0]) is None
+    assert await semantic_cache.get("p", [1.0, 0.0, 0.0]) == {"answer": "a"}
+    assert await semantic_cache.get("p", [0.0, 0.0, 1.0]) == {"answer": "c"}
+    assert semantic_cache.evictions == 1
+
+
+@pytest.mark.asyncio
+async def test_semanticcache_ttl():
+    semantic_cache = SemanticCache(max_entries=1, ttl=-1)
+    semantic_cache.add("p", [1.0, 0.0], {"answer": "a"})
+    assert await semantic_cache.get("p", [1.0, 0.0]) is None
+    # The expired slot is reused without counting as an eviction
+    semantic_cache.add("p", [0.0, 1.0], {"answer": "b"})
+    assert semantic_cache.evictions == 0
+
+
+@pytest.mark.asyncio
+async def test_semanticcache_dimensions():
+    semantic_cache = SemanticCache(max_entries=2)
+    semantic_cache.add("p", [1.0, 0.0], {"answer": "a"})
+    semantic_cache.add("p", [1.0, 0.0, 0.0], {"answer": "b"})
+    assert await semantic_cache.get("p", [1.0, 0.0, 0.0]) is None
+    assert await semantic_cache.get("p", [1.0, 0.0]) == {"answer": "a"}
+
+
+@pytest.mark.asyncio
+async def test_semanticcache_invalidate():
+    semantic_cache = SemanticCache(max_entries=2)
+    semantic_cache.add("p", [1.0, 0.0], {"answer": "a"})
+    semantic_cache.invalidate()
+    assert await semantic_cache.get("p", [1.0, 0.0]) is None
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import os
@@ -9,6 +10,7 @@ from httpx import Request, Response
 from openai import BadRequestError
 
 import app
+from core.answercache import SemanticCache
 
 
 def fake_response(http_code):
@@ -192,6 +194,24 @@ async def test_ask_rtr_hybrid(client, snapshot):
     snapshot.assert_match(json.dumps(result, indent=4), "result.json")
 
 
+@pytest.mark.asyncio
+async def test_ask_stream_text(client, snapshot):
+    response = await client.post(
+        "/ask",
+        json={
+            "stream": True,
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {
+                "overrides": {"retrieval_mode": "text"},
+            },
+        },
+    )
+    assert response.status_code == 200
+    assert response.mimetype == "application/json-lines"
+    result = await response.get_data()
+    snapshot.assert_match(result, "result.jsonlines")
+
+
 @pytest.mark.asyncio
 async def test_chat_request_must_be_json(client):
     response = await client.post("/chat")
@@ -571,6 +591,681 @@ async def test_chat_stream_followup(client, snapshot):
     snapshot.assert_match(result, "result.jsonlines")
 
 
+@pytest.mark.asyncio
+async def test_chat_answer_cache(client, monkeypatch):
+    request_json = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {
+            "overrides": {"retrieval_mode": "text", "suggest_followup_questions": True},
+        },
+    }
+    response = await client.post("/chat", json=request_json)
+    assert response.status_code == 200
+    result = await response.get_json()
+
+    # Any further call to OpenAI fails, so the answers below must come from the cache
+    chat_client = client.app.config[app.CONFIG_OPENAI_CLIENT]
+    monkeypatch.setattr(chat_client.chat.completions, "create", mock.Mock(side_effect=ZeroDivisionError("cache miss")))
+
+    response = await client.post(
+        "/chat", json={**request_json, "messages": [{"content": "what is the capital of france? ", "role": "user"}]}
+    )
+    assert response.status_code == 200
+    cached_result = await response.get_json()
+    assert cached_result["choices"][0]["message"] == result["choices"][0]["message"]
+    assert cached_result["choices"][0]["context"] == result["choices"][0]["context"]
+
+    response = await client.post("/chat", json={**request_json, "stream": True, "session_state": {"id": 1}})
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data()).decode().splitlines()]
+    assert events[0]["choices"][0]["context"]["data_points"] == result["choices"][0]["context"]["data_points"]
+    assert events[0]["choices"][0]["session_state"] == {"id": 1}
+    assert events[1]["choices"][0]["delta"]["content"] == result["choices"][0]["message"]["content"]
+    assert events[2]["choices"][0]["context"]["followup_questions"] == ["What is the capital of Spain?"]
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_answer_cache(client, monkeypatch):
+    request_json = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {
+            "overrides": {"retrieval_mode": "text"},
+        },
+    }
+    response = await client.post("/chat", json={**request_json, "stream": True})
+    assert response.status_code == 200
+    await response.get_data()
+
+    chat_client = client.app.config[app.CONFIG_OPENAI_CLIENT]
+    monkeypatch.setattr(chat_client.chat.completions, "create", mock.Mock(side_effect=ZeroDivisionError("cache miss")))
+
+    response = await client.post("/chat", json=request_json)
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result["choices"][0]["message"]["content"] == "The capital of France is Paris. [Benefit_Options-2.pdf]."
+
+    # Different overrides are a different answer
+    response = await client.post("/chat", json={**request_json, "context": {"overrides": {"top": 1}}})
+    assert response.status_code == 500
+
+
+@pytest.mark.asyncio
+async def test_ask_answer_cache(client, monkeypatch):
+    request_json = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {
+            "overrides": {"retrieval_mode": "text"},
+        },
+    }
+    response = await client.post("/ask", json=request_json)
+    assert response.status_code == 200
+    result = await response.get_json()
+
+    chat_client = client.app.config[app.CONFIG_OPENAI_CLIENT]
+    monkeypatch.setattr(chat_client.chat.completions, "create", mock.Mock(side_effect=ZeroDivisionError("cache miss")))
+
+    response = await client.post("/ask", json={**request_json, "session_state": {"id": 1}})
+    assert response.status_code == 200
+    cached_result = await response.get_json()
+    assert cached_result["choices"][0]["message"] == result["choices"][0]["message"]
+    assert cached_result["choices"][0]["session_state"] == {"id": 1}
+
+
+@pytest.mark.asyncio
+async def test_ask_stream_answer_cache(client, monkeypatch):
+    request_json = {
+        "stream": True,
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {
+            "overrides": {"retrieval_mode": "text"},
+        },
+    }
+    response = await client.post("/ask", json=request_json)
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    streamed_answer = "".join(event["choices"][0]["delta"].get("content") or "" for event in events)
+
+    chat_client = client.app.config[app.CONFIG_OPENAI_CLIENT]
+    monkeypatch.setattr(chat_client.chat.completions, "create", mock.Mock(side_effect=ZeroDivisionError("cache miss")))
+
+    # The streamed answer is cached, and replayed to both streaming and non-streaming requests
+    response = await client.post("/ask", json={**request_json, "session_state": {"id": 1}})
+    assert response.status_code == 200
+    replayed_events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert replayed_events[0]["choices"][0]["context"] == events[0]["choices"][0]["context"]
+    assert replayed_events[0]["choices"][0]["session_state"] == {"id": 1}
+    assert replayed_events[1]["choices"][0]["delta"]["content"] == streamed_answer
+    response = await client.post("/ask", json={**request_json, "stream": False})
+    assert response.status_code == 200
+    assert (await response.get_json())["choices"][0]["message"]["content"] == streamed_answer
+
+
+@pytest.mark.asyncio
+async def test_chat_semantic_cache(client, monkeypatch):
+    # The mocked embedding is the same for every question, so paraphrased questions are close enough to reuse answers
+    semantic_cache = SemanticCache(max_entries=10)
+    chat_approach = client.app.config[app.CONFIG_CHAT_APPROACH]
+    monkeypatch.setattr(chat_approach, "answer_cache", None)
+    monkeypatch.setattr(chat_approach, "semantic_cache", semantic_cache)
+    request_json = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {
+            "overrides": {"suggest_followup_questions": True},
+        },
+    }
+    response = await client.post("/chat", json=request_json)
+    assert response.status_code == 200
+    result = await response.get_json()
+
+    chat_client = client.app.config[app.CONFIG_OPENAI_CLIENT]
+    create = chat_client.chat.completions.create
+    monkeypatch.setattr(chat_client.chat.completions, "create", mock.AsyncMock(side_effect=create))
+
+    response = await client.post(
+        "/chat", json={**request_json, "messages": [{"content": "Which city is France's capital?", "role": "user"}]}
+    )
+    assert response.status_code == 200
+    cached_result = await response.get_json()
+    assert cached_result["choices"][0]["message"] == result["choices"][0]["message"]
+    assert cached_result["choices"][0]["context"] == result["choices"][0]["context"]
+
+    response = await client.post("/chat", json={**request_json, "stream": True})
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data()).decode().splitlines()]
+    assert events[0]["choices"][0]["context"]["data_points"] == result["choices"][0]["context"]["data_points"]
+    assert events[1]["choices"][0]["delta"]["content"] == result["choices"][0]["message"]["content"]
+    assert events[2]["choices"][0]["context"]["followup_questions"] == ["What is the capital of Spain?"]
+
+    # Only the query rewrite was generated for the cached answers
+    assert chat_client.chat.completions.create.call_count == 2
+    assert semantic_cache.hits == 2
+
+    # Different overrides and later turns in a conversation always get a new answer
+    response = await client.post("/chat", json={**request_json, "context": {"overrides": {"top": 1}}})
+    assert response.status_code == 200
+    response = await client.post(
+        "/chat",
+        json={
+            **request_json,
+            "messages": [
+                {"content": "What is the capital of France?", "role": "user"},
+                {"content": "The capital of France is Paris.", "role": "assistant"},
+                {"content": "What is the capital of France?", "role": "user"},
+            ],
+        },
+    )
+    assert response.status_code == 200
+    assert chat_client.chat.completions.create.call_count == 6
+
+
+@pytest.mark.asyncio
+async def test_ask_semantic_cache(client, monkeypatch):
+    semantic_cache = SemanticCache(max_entries=10)
+    ask_approach = client.app.config[app.CONFIG_ASK_APPROACH]
+    monkeypatch.setattr(ask_approach, "answer_cache", None)
+    monkeypatch.setattr(ask_approach, "semantic_cache", semantic_cache)
+    request_json = {"messages": [{"content": "What is the capital of France?", "role": "user"}]}
+    response = await client.post("/ask", json=request_json)
+    assert response.status_code == 200
+    result = await response.get_json()
+
+    chat_client = client.app.config[app.CONFIG_OPENAI_CLIENT]
+    monkeypatch.setattr(chat_client.chat.completions, "create", mock.Mock(side_effect=ZeroDivisionError("cache miss")))
+
+    response = await client.post(
+        "/ask",
+        json={"messages": [{"content": "Which city is France's capital?", "role": "user"}], "session_state": {"id": 1}},
+    )
+    assert response.status_code == 200
+    cached_result = await response.get_json()
+    assert cached_result["choices"][0]["message"] == result["choices"][0]["message"]
+    assert cached_result["choices"][0]["session_state"] == {"id": 1}
+
+    # Text-only retrieval doesn't compute an embedding, so there is nothing to compare
+    response = await client.post("/ask", json={**request_json, "context": {"overrides": {"retrieval_mode": "text"}}})
+    assert response.status_code == 500
+
+
+@pytest.mark.asyncio
+async def test_embedding_cache(client, monkeypatch):
+    for approach in (app.CONFIG_ASK_APPROACH, app.CONFIG_CHAT_APPROACH):
+        monkeypatch.setattr(client.app.config[approach], "answer_cache", None)
+    embeddings_client = client.app.config[app.CONFIG_OPENAI_CLIENT].embeddings
+    monkeypatch.setattr(embeddings_client, "create", mock.AsyncMock(side_effect=embeddings_client.create))
+
+    request_json = {"messages": [{"content": "What is the capital of France?", "role": "user"}]}
+    for _ in range(2):
+        response = await client.post("/ask", json=request_json)
+        assert response.status_code == 200
+    assert embeddings_client.create.call_count == 1
+
+    # The embedding cache is shared by both approaches
+    response = await client.post("/chat", json=request_json)
+    assert response.status_code == 200
+    embedding_cache = client.app.config[app.CONFIG_EMBEDDING_CACHE]
+    assert embedding_cache.hits + embedding_cache.misses == 3
+
+
+@pytest.mark.asyncio
+async def test_ask_batch(client, monkeypatch):
+    monkeypatch.setattr(client.app.config[app.CONFIG_ASK_APPROACH], "answer_cache", None)
+    embeddings_client = client.app.config[app.CONFIG_OPENAI_CLIENT].embeddings
+    single_embedding = await embeddings_client.create(model="test", input="test")
+
+    async def batch_create(*args, **kwargs):
+        response = single_embedding.model_copy(deep=True)
+        response.data = [
+            single_embedding.data[0].model_copy(update={"index": index}) for index in range(len(kwargs["input"]))
+        ]
+        return response
+
+    monkeypatch.setattr(embeddings_client, "create", mock.AsyncMock(side_effect=batch_create))
+
+    questions = ["What is the capital of France?", "What is the capital of Spain?", "What is the capital of France?"]
+    response = await client.post("/ask/batch", json={"questions": questions})
+    assert response.status_code == 200
+    assert response.mimetype == "application/json-lines"
+    results = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert sorted(result["index"] for result in results) == [0, 1, 2]
+    assert all(result["choices"][0]["message"]["content"] for result in results)
+    # The questions are embedded with a single call, each distinct question once
+    assert embeddings_client.create.call_count == 1
+    assert embeddings_client.create.call_args.kwargs["input"] == questions[:2]
+
+
+@pytest.mark.asyncio
+async def test_ask_batch_dry_run(client, monkeypatch):
+    chat_client = client.app.config[app.CONFIG_OPENAI_CLIENT]
+    monkeypatch.setattr(chat_client.chat.completions, "create", mock.AsyncMock())
+    response = await client.post(
+        "/ask/batch",
+        json={
+            "questions": ["What is the capital of France?", "What is the capital of Spain?"],
+            "context": {"overrides": {"retrieval_mode": "text", "dry_run": True}},
+        },
+    )
+    assert response.status_code == 200
+    results = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert sorted(result["index"] for result in results) == [0, 1]
+    assert all("dry_run" in result["choices"][0]["context"] for result in results)
+    assert chat_client.chat.completions.create.call_count == 0
+
+
+@pytest.mark.asyncio
+async def test_ask_batch_error(client, monkeypatch):
+    monkeypatch.setattr(client.app.config[app.CONFIG_ASK_APPROACH], "answer_cache", None)
+    chat_client = client.app.config[app.CONFIG_OPENAI_CLIENT]
+    create = chat_client.chat.completions.create
+
+    async def failing_create(*args, **kwargs):
+        if "Spain" in kwargs["messages"][-1]["content"]:
+            raise ZeroDivisionError("something bad happened")
+        return await create(*args, **kwargs)
+
+    monkeypatch.setattr(chat_client.chat.completions, "create", failing_create)
+
+    questions = ["What is the capital of France?", "What is the capital of Spain?"]
+    response = await client.post(
+        "/ask/batch", json={"questions": questions, "context": {"overrides": {"retrieval_mode": "text"}}}
+    )
+    assert response.status_code == 200
+    results = {
+        result["index"]: result for result in map(json.loads, (await response.get_data(as_text=True)).splitlines())
+    }
+    assert "choices" in results[0]
+    assert "ZeroDivisionError" in results[1]["error"]
+
+
+@pytest.mark.asyncio
+async def test_ask_batch_invalid(client):
+    response = await client.post("/ask/batch", json={"questions": "What is the capital of France?"})
+    assert response.status_code == 400
+    client.app.config[app.CONFIG_ASK_BATCH_MAX_QUESTIONS] = 1
+    response = await client.post("/ask/batch", json={"questions": ["a", "b"]})
+    assert response.status_code == 400
+    assert (await response.get_json()) == {"error": "too many questions"}
+
+
+@pytest.mark.asyncio
+async def test_ask_coalescing(client, monkeypatch):
+    monkeypatch.setattr(client.app.config[app.CONFIG_ASK_APPROACH], "answer_cache", None)
+    chat_client = client.app.config[app.CONFIG_OPENAI_CLIENT]
+    create = chat_client.chat.completions.create
+
+    async def slow_create(*args, **kwargs):
+        await asyncio.sleep(0.05)
+        return await create(*args, **kwargs)
+
+    monkeypatch.setattr(chat_client.chat.completions, "create", mock.AsyncMock(side_effect=slow_create))
+
+    responses = await asyncio.gather(
+        *[
+            client.post(
+                "/ask",
+                json={
+                    "messages": [{"content": "What is the capital of France?", "role": "user"}],
+                    "session_state": {"id": i},
+                },
+            )
+            for i in range(3)
+        ]
+    )
+    results = [await response.get_json() for response in responses]
+    assert chat_client.chat.completions.create.call_count == 1
+    assert [result["choices"][0]["session_state"] for result in results] == [{"id": 0}, {"id": 1}, {"id": 2}]
+    assert results[0]["choices"][0]["message"] == results[2]["choices"][0]["message"]
+    assert client.app.config[app.CONFIG_REQUEST_COALESCER].coalesced == 2
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_coalescing(client, monkeypatch):
+    monkeypatch.setattr(client.app.config[app.CONFIG_CHAT_APPROACH], "answer_cache", None)
+    chat_client = client.app.config[app.CONFIG_OPENAI_CLIENT]
+    create = chat_client.chat.completions.create
+
+    async def slow_create(*args, **kwargs):
+        await asyncio.sleep(0.05)
+        return await create(*args, **kwargs)
+
+    monkeypatch.setattr(chat_client.chat.completions, "create", mock.AsyncMock(side_effect=slow_create))
+
+    responses = await asyncio.gather(
+        *[
+            client.post(
+                "/chat",
+                json={
+                    "messages": [{"content": "What is the capital of France?", "role": "user"}],
+                    "stream": True,
+                    "session_state": {"id": i},
+                },
+            )
+            for i in range(2)
+        ]
+    )
+    events = [
+        [json.loads(line) for line in (await response.get_data()).decode().splitlines()] for response in responses
+    ]
+    # The query rewrite and the answer are only generated once
+    assert chat_client.chat.completions.create.call_count == 2
+    assert events[0][0]["choices"][0]["session_state"] == {"id": 0}
+    assert events[1][0]["choices"][0]["session_state"] == {"id": 1}
+    assert events[0][1:] == events[1][1:]
+
+
+@pytest.mark.asyncio
+async def test_ask_busy(client):
+    admission_controller = client.app.config[app.CONFIG_ADMISSION_CONTROLLER]
+    admission_controller.max_inflight = 1
+    admission_controller.max_queue = 0
+    await admission_controller.acquire()
+
+    response = await client.post(
+        "/ask", json={"messages": [{"content": "What is the capital of France?", "role": "user"}]}
+    )
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1"
+    result = await response.get_json()
+    assert result["error"] == app.ERROR_MESSAGE_BUSY
+
+    admission_controller.release(0)
+    response = await client.post(
+        "/ask", json={"messages": [{"content": "What is the capital of France?", "role": "user"}]}
+    )
+    assert response.status_code == 200
+    assert admission_controller.inflight == 0
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_admission(client):
+    admission_controller = client.app.config[app.CONFIG_ADMISSION_CONTROLLER]
+    response = await client.post(
+        "/chat",
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}], "stream": True},
+    )
+    assert response.status_code == 200
+    await response.get_data()
+    assert admission_controller.inflight == 0
+    assert admission_controller.admitted == 1
+
+
+@pytest.mark.asyncio
+async def test_metrics(client, monkeypatch):
+    monkeypatch.setattr(client.app.config[app.CONFIG_CHAT_APPROACH], "answer_cache", None)
+    response = await client.post(
+        "/chat",
+        json={"stream": True, "messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 200
+    await response.get_data()
+
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    result = await response.get_data(as_text=True)
+    for stage in ["query_rewrite", "embedding", "search", "first_token"]:
+        assert f'app_stage_duration_seconds_count{{approach="chat",stage="{stage}"}}' in result
+    assert 'app_requests_total{route="/chat",status="200"}' in result
+    assert 'app_requests_in_flight{route="/chat"} 0.0' in result
+    assert 'app_cache_lookups_total{cache="embedding",result="miss"}' in result
+
+
+@pytest.mark.asyncio
+async def test_ready(client):
+    readiness = client.app.config[app.CONFIG_READINESS]
+    await asyncio.gather(*readiness.tasks)
+    response = await client.get("/ready")
+    assert response.status_code == 200
+    assert await response.get_json() == {"status": "ready"}
+
+
+@pytest.mark.asyncio
+async def test_ready_warming_up(client):
+    readiness = client.app.config[app.CONFIG_READINESS]
+    readiness.pending.add("openai")
+    response = await client.get("/ready")
+    assert response.status_code == 503
+    assert await response.get_json() == {"status": "warming up", "pending": ["openai"]}
+
+
+@pytest.mark.asyncio
+async def test_chat_dry_run(client):
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [
+                {"role": "user", "content": "Is there a dress code?"},
+                {
+                    "role": "assistant",
+                    "content": "Yes, there is a dress code at Contoso Electronics. Look sharp! [employee_handbook-1.pdf]"
+                    * 150,
+                },
+                {"role": "user", "content": "What is the capital of France?"},
+            ],
+            "context": {"overrides": {"retrieval_mode": "text", "dry_run": True}},
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    # The final completion isn't called, so the answer is empty
+    assert result["choices"][0]["message"]["content"] == ""
+    dry_run = result["choices"][0]["context"]["dry_run"]
+    assert [message["role"] for message in dry_run["messages"]] == ["system", "user"]
+    assert "Sources:" in dry_run["messages"][1]["content"]
+    assert len(dry_run["token_counts"]) == 2
+    assert dry_run["total_tokens"] == sum(dry_run["token_counts"])
+    assert dry_run["token_limit"] == 4000 - 1024
+    assert dry_run["truncated_history"] == 2
+    assert dry_run["dropped_sources"] == 0
+    assert [timing["name"] for timing in dry_run["timings"]] == ["auth", "query_rewrite", "search", "prompt", "total"]
+
+
+@pytest.mark.asyncio
+async def test_chat_dry_run_not_cached(client):
+    request_json = {
+        "messages": [{"content": "What is the capital of France?", "role": "user"}],
+        "context": {"overrides": {"dry_run": True}},
+    }
+    for _ in range(2):
+        response = await client.post("/chat", json=request_json)
+        result = await response.get_json()
+        assert result["choices"][0]["message"]["content"] == ""
+        assert "dry_run" in result["choices"][0]["context"]
+    request_json["context"]["overrides"]["dry_run"] = False
+    response = await client.post("/chat", json=request_json)
+    result = await response.get_json()
+    assert result["choices"][0]["message"]["content"] == "The capital of France is Paris. [Benefit_Options-2.pdf]."
+    assert "dry_run" not in result["choices"][0]["context"]
+
+
+@pytest.mark.asyncio
+async def test_chat_stream_dry_run(client):
+    response = await client.post(
+        "/chat",
+        json={
+            "stream": True,
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"dry_run": True}},
+        },
+    )
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert events[0]["choices"][0]["context"]["dry_run"]["truncated_history"] == 0
+    assert "".join(event["choices"][0]["delta"].get("content") or "" for event in events) == ""
+
+
+@pytest.mark.asyncio
+async def test_ask_dry_run(client):
+    response = await client.post(
+        "/ask",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"retrieval_mode": "text", "dry_run": True}},
+        },
+    )
+    assert response.status_code == 200
+    result = await response.get_json()
+    assert result["choices"][0]["message"]["content"] == ""
+    dry_run = result["choices"][0]["context"]["dry_run"]
+    assert [message["role"] for message in dry_run["messages"]] == ["system", "user", "assistant", "user"]
+    assert dry_run["total_tokens"] == sum(dry_run["token_counts"])
+    assert dry_run["token_limit"] == 4000 - 1024
+    assert dry_run["truncated_history"] == 0
+    assert dry_run["dropped_sources"] == 0
+    assert [timing["name"] for timing in dry_run["timings"]] == ["auth", "search", "prompt", "total"]
+
+
+@pytest.mark.asyncio
+async def test_ask_dry_run_dropped_sources(client):
+    response = await client.post(
+        "/ask",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            # The prompt leaves no room for the sources
+            "context": {"overrides": {"dry_run": True, "prompt_template": "You are a bot. " * 1000}},
+        },
+    )
+    assert response.status_code == 200
+    context = (await response.get_json())["choices"][0]["context"]
+    assert context["dry_run"]["dropped_sources"] == 1
+    assert context["data_points"] == []
+    assert context["dry_run"]["messages"][-1]["content"] == "What is the capital of France?\nSources:\n "
+
+
+@pytest.mark.asyncio
+async def test_chat_dry_run_dropped_sources(client):
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"dry_run": True, "prompt_template": "You are a bot. " * 1000}},
+        },
+    )
+    assert response.status_code == 200
+    context = (await response.get_json())["choices"][0]["context"]
+    assert context["dry_run"]["dropped_sources"] == 1
+    assert context["data_points"] == []
+
+
+@pytest.mark.asyncio
+async def test_ask_stream_dry_run(client):
+    response = await client.post(
+        "/ask",
+        json={
+            "stream": True,
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"dry_run": True}},
+        },
+    )
+    assert response.status_code == 200
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    assert "dry_run" in events[0]["choices"][0]["context"]
+    assert events[-1]["choices"][0]["delta"]["content"] == ""
+
+
+@pytest.mark.asyncio
+async def test_server_timing(client, monkeypatch):
+    monkeypatch.setattr(client.app.config[app.CONFIG_CHAT_APPROACH], "answer_cache", None)
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"include_timings": True},
+        },
+    )
+    assert response.status_code == 200
+    server_timing = response.headers["Server-Timing"]
+    for stage in ["auth", "query_rewrite", "embedding", "search", "prompt", "answer", "total"]:
+        assert f"{stage};dur=" in server_timing
+    result = await response.get_json()
+    timings = result["choices"][0]["context"]["timings"]
+    assert [timing["name"] for timing in timings] == [
+        "auth",
+        "query_rewrite",
+        "embedding",
+        "search",
+        "prompt",
+        "answer",
+        "total",
+    ]
+    assert all(timing["start"] >= 0 and timing["duration"] >= 0 for timing in timings)
+
+
+@pytest.mark.asyncio
+async def test_server_timing_without_timings(client):
+    response = await client.post(
+        "/ask",
+        json={"messages": [{"content": "What is the capital of France?", "role": "user"}]},
+    )
+    assert response.status_code == 200
+    assert "auth;dur=" in response.headers["Server-Timing"]
+    result = await response.get_json()
+    assert "timings" not in result["choices"][0]["context"]
+
+
+@pytest.mark.asyncio
+async def test_chat_speculative_retrieval(client, monkeypatch):
+    monkeypatch.setattr(client.app.config[app.CONFIG_CHAT_APPROACH], "answer_cache", None)
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"overrides": {"speculative_retrieval": True}, "include_timings": True},
+        },
+    )
+    assert response.status_code == 200
+    context = (await response.get_json())["choices"][0]["context"]
+    # The search query "capital of France" is close enough to the question to use its sources
+    assert context["thoughts"].startswith("Searched for:<br>What is the capital of France?<br>")
+    assert context["data_points"] == ["Benefit_Options-2.pdf: There is a whistleblower policy."]
+    names = [timing["name"] for timing in context["timings"]]
+    assert "speculative_search" in names
+    assert "search" not in names
+
+
+@pytest.mark.asyncio
+async def test_chat_speculative_retrieval_rejected(client, monkeypatch):
+    monkeypatch.setattr(client.app.config[app.CONFIG_CHAT_APPROACH], "answer_cache", None)
+    response = await client.post(
+        "/chat",
+        json={
+            "messages": [{"content": "Is there a dress code?", "role": "user"}],
+            "context": {"overrides": {"speculative_retrieval": True}, "include_timings": True},
+        },
+    )
+    assert response.status_code == 200
+    context = (await response.get_json())["choices"][0]["context"]
+    assert context["thoughts"].startswith("Searched for:<br>The capital of France is Paris.")
+    assert "search" in [timing["name"] for timing in context["timings"]]
+
+
+@pytest.mark.asyncio
+async def test_server_timing_stream(client, monkeypatch):
+    monkeypatch.setattr(client.app.config[app.CONFIG_ASK_APPROACH], "answer_cache", None)
+    monkeypatch.setattr(client.app.config[app.CONFIG_ASK_APPROACH], "semantic_cache", None)
+    response = await client.post(
+        "/ask",
+        json={
+            "stream": True,
+            "messages": [{"content": "What is the capital of France?", "role": "user"}],
+            "context": {"include_timings": True},
+        },
+    )
+    assert response.status_code == 200
+    # The header is sent before the answer, so only holds the stages before it
+    assert response.headers["Server-Timing"].startswith("auth;dur=")
+    events = [json.loads(line) for line in (await response.get_data(as_text=True)).splitlines()]
+    timings = events[-1]["choices"][0]["context"]["timings"]
+    assert [timing["name"] for timing in timings] == [
+        "auth",
+        "embedding",
+        "search",
+        "prompt",
+        "first_token",
+        "answer",
+        "total",
+    ]
+
+
 @pytest.mark.asyncio
 async def test_format_as_ndjson():
     async def gen():
@@ -578,7 +1273,7 @@ async def test_format_as_ndjson():
         yield {"b": "Newlines inside \n strings are fine"}
 
     result = [line async for line in app.format_as_ndjson(gen())]
-    assert result == ['{"a": "I ❤️ 🐍"}\n', '{"b": "Newlines inside \\n strings are fine"}\n']
+    assert result == ['{"a":"I ❤️ 🐍"}\n', '{"b":"Newlines inside \\n strings are fine"}\n']
 
 
 @pytest.mark.asyncio
@@ -591,7 +1286,7 @@ async def test_format_as_ndjson_error(caplog):
     result = [line async for line in app.format_as_ndjson(gen())]
     assert "Exception while generating response stream: something bad happened\n" in caplog.text
     assert result == [
-        '{"error": "The app encountered an error processing your request.\\nIf you are an administrator of the app, view the full error in the logs. See aka.ms/appservice-logs for more information.\\nError type: <class \'ZeroDivisionError\'>\\n"}'
+        '{"error":"The app encountered an error processing your request.\\nIf you are an administrator of the app, view the full error in the logs. See aka.ms/appservice-logs for more information.\\nError type: <class \'ZeroDivisionError\'>\\n"}'
     ]
 
 
@@ -1,6 +1,15 @@
+import asyncio
+import base64
+import json
+import threading
+import time
+
+import aiohttp
+import msal
 import pytest
 
 from core.authentication import AuthenticationHelper, AuthError
+from core.tokencache import SqliteTokenCache
 
 
 def create_authentication_helper():
@@ -44,6 +53,62 @@ async def test_get_auth_claims_overage_unauthorized(mock_confidential_client_ove
     assert len(auth_claims.keys()) == 0
 
 
+def create_token(exp: float) -> str:
+    payload = base64.urlsafe_b64encode(json.dumps({"oid": "OID_X", "exp": exp}).encode()).decode().rstrip("=")
+    return f"header.{payload}.signature"
+
+
+def test_get_token_expiration():
+    assert AuthenticationHelper.get_token_expiration(create_token(1700000000)) == 1700000000
+    assert AuthenticationHelper.get_token_expiration("Token") is None
+    assert AuthenticationHelper.get_token_expiration("header.not-base64!.signature") is None
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_cached(monkeypatch, mock_confidential_client_success):
+    calls = []
+
+    def mock_acquire_token_on_behalf_of(self, *args, **kwargs):
+        calls.append(threading.current_thread())
+        return {"access_token": "MockToken", "id_token_claims": {"oid": "OID_X", "groups": ["GROUP_Y"]}}
+
+    monkeypatch.setattr(
+        msal.ConfidentialClientApplication, "acquire_token_on_behalf_of", mock_acquire_token_on_behalf_of
+    )
+    helper = create_authentication_helper()
+    headers = {"Authorization": "Bearer " + create_token(time.time() + 3600)}
+    auth_claims = await helper.get_auth_claims_if_enabled(headers=headers)
+    assert auth_claims == {"oid": "OID_X", "groups": ["GROUP_Y"]}
+    # The token exchange doesn't block the event loop
+    assert calls[0] is not threading.current_thread()
+
+    auth_claims["groups"].append("GROUP_Z")
+    assert await helper.get_auth_claims_if_enabled(headers=headers) == {"oid": "OID_X", "groups": ["GROUP_Y"]}
+    assert len(calls) == 1
+
+    # A different token is exchanged again
+    other_headers = {"Authorization": "Bearer " + create_token(time.time() + 3601)}
+    await helper.get_auth_claims_if_enabled(headers=other_headers)
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_expired(mock_confidential_client_success):
+    helper = create_authentication_helper()
+    headers = {"Authorization": "Bearer " + create_token(time.time() - 1)}
+    await helper.get_auth_claims_if_enabled(headers=headers)
+    assert helper.get_cached_auth_claims(next(iter(helper.claims_cache))) is None
+    assert len(helper.claims_cache) == 0
+
+
+@pytest.mark.asyncio
+async def test_get_auth_claims_unauthorized_not_cached(mock_confidential_client_unauthorized):
+    helper = create_authentication_helper()
+    headers = {"Authorization": "Bearer " + create_token(time.time() + 3600)}
+    assert await helper.get_auth_claims_if_enabled(headers=headers) == {}
+    assert len(helper.claims_cache) == 0
+
+
 @pytest.mark.asyncio
 async def test_list_groups_success(mock_list_groups_success):
     groups = await AuthenticationHelper.list_groups(graph_resource_access_token={"access_token": "MockToken"})
@@ -57,6 +122,85 @@ async def test_list_groups_unauthorized(mock_list_groups_unauthorized):
     assert exc_info.value.error == '{"error": "unauthorized"}'
 
 
+@pytest.mark.asyncio
+async def test_get_groups_cached(monkeypatch, mock_confidential_client_success):
+    calls = []
+
+    async def mock_list_groups(graph_resource_access_token, session=None):
+        calls.append(graph_resource_access_token["access_token"])
+        assert isinstance(session, aiohttp.ClientSession)
+        await asyncio.sleep(0)
+        return [f"GROUP_{len(calls)}"]
+
+    monkeypatch.setattr(AuthenticationHelper, "list_groups", mock_list_groups)
+    helper = create_authentication_helper()
+
+    # Concurrent requests from the same user share one lookup
+    results = await asyncio.gather(*[helper.get_groups("OID_X", {"access_token": "A"}) for _ in range(3)])
+    assert results == [["GROUP_1"]] * 3
+    assert await helper.get_groups("OID_X", {"access_token": "B"}) == ["GROUP_1"]
+    assert calls == ["A"]
+
+    # Other users get their own lookup
+    assert await helper.get_groups("OID_Y", {"access_token": "C"}) == ["GROUP_2"]
+    graph_session = helper.graph_session
+    await helper.close()
+    assert graph_session.closed
+
+
+@pytest.mark.asyncio
+async def test_get_groups_refresh(monkeypatch, mock_confidential_client_success):
+    calls = []
+
+    async def mock_list_groups(graph_resource_access_token, session=None):
+        calls.append(graph_resource_access_token["access_token"])
+        return [f"GROUP_{len(calls)}"]
+
+    monkeypatch.setattr(AuthenticationHelper, "list_groups", mock_list_groups)
+    helper = AuthenticationHelper(
+        use_authentication=True,
+        server_app_id="SERVER_APP",
+        server_app_secret="SERVER_SECRET",
+        client_app_id="CLIENT_APP",
+        tenant_id="TENANT_ID",
+        groups_refresh_after=0,
+    )
+    assert await helper.get_groups("OID_X", {"access_token": "A"}) == ["GROUP_1"]
+    # The stale groups are returned while they are refreshed in the background
+    assert await helper.get_groups("OID_X", {"access_token": "B"}) == ["GROUP_1"]
+    await asyncio.gather(*helper.groups_inflight.values())
+    assert calls == ["A", "B"]
+    assert helper.groups_cache["OID_X"][1] == ["GROUP_2"]
+
+    helper.groups_cache_ttl = 0
+    assert await helper.get_groups("OID_X", {"access_token": "C"}) == ["GROUP_3"]
+    await helper.close()
+
+
+@pytest.mark.asyncio
+async def test_get_groups_error(mock_confidential_client_success, mock_list_groups_unauthorized):
+    helper = create_authentication_helper()
+    with pytest.raises(AuthError):
+        await helper.get_groups("OID_X", {"access_token": "A"})
+    assert "OID_X" not in helper.groups_cache
+    assert helper.groups_inflight == {}
+    await helper.close()
+
+
+def test_build_token_cache(mock_confidential_client_success, tmp_path):
+    helper = create_authentication_helper()
+    assert helper.token_cache_backend == "memory"
+    assert type(helper.build_token_cache()) is msal.TokenCache
+
+    helper.token_cache_backend = "sqlite"
+    helper.token_cache_path = str(tmp_path / "token_cache.db")
+    assert isinstance(helper.build_token_cache(), SqliteTokenCache)
+
+    helper.token_cache_backend = "redis"
+    with pytest.raises(ValueError):
+        helper.build_token_cache()
+
+
 def test_auth_setup(mock_confidential_client_success):
     helper = create_authentication_helper()
     assert helper.get_auth_setup_for_client() == {
@@ -0,0 +1,220 @@
+import asyncio
+import os
+import threading
+from types import SimpleNamespace
+
+import pytest
+from azure.core.exceptions import ResourceNotFoundError
+
+from core.blobcache import BlobCache
+
+
+class MockDownloader:
+    def __init__(self, etag: str, content: bytes, chunk_size: int = 2):
+        self.content = content
+        self.size = len(content)
+        self.chunk_size = chunk_size
+        self.properties = SimpleNamespace(etag=etag, content_settings=SimpleNamespace(content_type="application/pdf"))
+
+    async def chunks(self):
+        for start in range(0, self.size, self.chunk_size):
+            await asyncio.sleep(0)
+            yield self.content[start : start + self.chunk_size]
+
+
+class MockBlobClient:
+    def __init__(self, container, path):
+        self.container = container
+        self.path = path
+
+    async def get_blob_properties(self):
+        self.container.properties_calls += 1
+        if self.path not in self.container.blobs:
+            raise ResourceNotFoundError("not found")
+        etag, content = self.container.blobs[self.path]
+        await asyncio.sleep(0)
+        return SimpleNamespace(
+            etag=etag, size=len(content), content_settings=SimpleNamespace(content_type="application/pdf")
+        )
+
+
+class MockContainerClient:
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.properties_calls = 0
+
+    def get_blob_client(self, path):
+        return MockBlobClient(self, path)
+
+
+async def add(blob_cache: BlobCache, path: str):
+    etag, content = blob_cache.container_client.blobs[path]
+    return await blob_cache.add(path, etag, "application/pdf", content)
+
+
+@pytest.mark.asyncio
+async def test_blobcache_hit():
+    container = MockContainerClient({"a.pdf": ('"1"', b"aaaa")})
+    blob_cache = BlobCache(container)
+    assert await blob_cache.get("a.pdf") is None
+
+    cached_blob = await add(blob_cache, "a.pdf")
+    assert cached_blob.etag == '"1"'
+    assert cached_blob.content_type == "application/pdf"
+    assert await blob_cache.read(cached_blob) == b"aaaa"
+    assert await blob_cache.read(cached_blob, 1, 3) == b"aa"
+
+    assert await blob_cache.get("a.pdf") is cached_blob
+    assert await add(blob_cache, "a.pdf") is cached_blob
+    assert container.properties_calls == 0
+    assert blob_cache.memory_size == 4
+
+
+@pytest.mark.asyncio
+async def test_blobcache_stream():
+    blob_cache = BlobCache(MockContainerClient({}))
+    chunks = [chunk async for chunk in blob_cache.stream("a.pdf", MockDownloader('"1"', b"aaaaa"))]
+    assert chunks == [b"aa", b"aa", b"a"]
+    # The blob is cached once it has been streamed whole
+    cached_blob = await blob_cache.get("a.pdf")
+    assert cached_blob.etag == '"1"'
+    assert await blob_cache.read(cached_blob) == b"aaaaa"
+
+
+@pytest.mark.asyncio
+async def test_blobcache_stream_closed():
+    blob_cache = BlobCache(MockContainerClient({}))
+    stream = blob_cache.stream("a.pdf", MockDownloader('"1"', b"aaaaa"))
+    assert await stream.__anext__() == b"aa"
+    await stream.aclose()
+    assert await blob_cache.get("a.pdf") is None
+
+
+@pytest.mark.asyncio
+async def test_blobcache_not_found():
+    container = MockContainerClient({"a.pdf": ('"1"', b"aaaa")})
+    blob_cache = BlobCache(container, revalidate_after=0)
+    await add(blob_cache, "a.pdf")
+    del container.blobs["a.pdf"]
+    with pytest.raises(ResourceNotFoundError):
+        await blob_cache.get("a.pdf")
+    assert "a.pdf" not in blob_cache.entries
+
+
+@pytest.mark.asyncio
+async def test_blobcache_too_large():
+    blob_cache = BlobCache(MockContainerClient({}), max_item_size=3)
+    chunks = [chunk async for chunk in blob_cache.stream("a.pdf", MockDownloader('"1"', b"aaaa"))]
+    assert b"".join(chunks) == b"aaaa"
+    assert await blob_cache.add("b.pdf", '"1"', None, b"bbbb") is None
+    assert blob_cache.entries == {}
+
+
+@pytest.mark.asyncio
+async def test_blobcache_revalidate():
+    container = MockContainerClient({"a.pdf": ('"1"', b"aaaa")})
+    blob_cache = BlobCache(container, revalidate_after=0)
+
+    cached_blob = await add(blob_cache, "a.pdf")
+    # The ETag hasn't changed, so the cached blob is still used
+    assert await blob_cache.get("a.pdf") is cached_blob
+    assert container.properties_calls == 1
+
+    # The blob has changed, so it has to be read from storage again
+    container.blobs["a.pdf"] = ('"2"', b"bbbbbb")
+    assert await blob_cache.get("a.pdf") is None
+    assert blob_cache.memory_size == 0
+    cached_blob = await add(blob_cache, "a.pdf")
+    assert cached_blob.etag == '"2"'
+    assert await blob_cache.read(cached_blob) == b"bbbbbb"
+    assert blob_cache.memory_size == 6
+
+
+@pytest.mark.asyncio
+async def test_blobcache_single_flight():
+    container = MockContainerClient({"a.pdf": ('"1"', b"aaaa")})
+    blob_cache = BlobCache(container, revalidate_after=0)
+    cached_blob = await add(blob_cache, "a.pdf")
+
+    results = await asyncio.gather(*[blob_cache.get("a.pdf") for _ in range(5)])
+    assert all(result is cached_blob for result in results)
+    assert container.properties_calls == 1
+    assert blob_cache.inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_blobcache_memory_eviction():
+    container = MockContainerClient({"a.pdf": ('"1"', b"aaaa"), "b.pdf": ('"1"', b"bbbb"), "c.pdf": ('"1"', b"cccc")})
+    blob_cache = BlobCache(container, max_memory_size=8)
+
+    await add(blob_cache, "a.pdf")
+    await add(blob_cache, "b.pdf")
+    await blob_cache.get("a.pdf")
+    await add(blob_cache, "c.pdf")
+    # b.pdf was the least recently used
+    assert list(blob_cache.entries) == ["a.pdf", "c.pdf"]
+    assert blob_cache.memory_size == 8
+
+
+@pytest.mark.asyncio
+async def test_blobcache_disk_tier(tmp_path):
+    container = MockContainerClient({"a.pdf": ('"1"', b"aaaa"), "b.pdf": ('"1"', b"bbbb"), "c.pdf": ('"1"', b"cccc")})
+    blob_cache = BlobCache(container, max_memory_size=4, disk_path=str(tmp_path), max_disk_size=4)
+
+    cached_a = await add(blob_cache, "a.pdf")
+    cached_b = await add(blob_cache, "b.pdf")
+    # a.pdf is demoted to disk when b.pdf is added to memory
+    assert cached_a.content is None
+    assert os.path.exists(cached_a.file_path)
+    assert await blob_cache.read(cached_a, 2) == b"aa"
+    assert cached_b.content == b"bbbb"
+    assert blob_cache.disk_size == 4
+
+    # a.pdf is dropped from disk when b.pdf is demoted
+    await add(blob_cache, "c.pdf")
+    assert list(blob_cache.entries) == ["b.pdf", "c.pdf"]
+    assert cached_a.file_path is None
+    assert await blob_cache.read(cached_b) == b"bbbb"
+
+    blob_cache.close()
+    assert not os.path.exists(blob_cache.disk_directory)
+
+
+@pytest.mark.asyncio
+async def test_blobcache_read_while_demoted(tmp_path, monkeypatch):
+    container = MockContainerClient({"a.pdf": ('"1"', b"aaaa"), "b.pdf": ('"1"', b"bbbb")})
+    blob_cache = BlobCache(container, max_memory_size=4, disk_path=str(tmp_path))
+    cached_a = await add(blob_cache, "a.pdf")
+
+    # The file of a.pdf is only written once it has been read during its demotion
+    read_done = threading.Event()
+    write_file = BlobCache.write_file
+
+    def blocking_write_file(file_path, content):
+        read_done.wait(timeout=5)
+        write_file(file_path, content)
+
+    async def read_during_write():
+        while "a.pdf" not in blob_cache.demoting:
+            await asyncio.sleep(0)
+        try:
+            return await blob_cache.read(cached_a)
+        finally:
+            read_done.set()
+
+    monkeypatch.setattr(BlobCache, "write_file", staticmethod(blocking_write_file))
+    _, content = await asyncio.gather(add(blob_cache, "b.pdf"), read_during_write())
+    assert content == b"aaaa"
+    assert cached_a.content is None
+    assert await blob_cache.read(cached_a) == b"aaaa"
+    assert blob_cache.memory_size == 4
+
+
+@pytest.mark.asyncio
+async def test_blobcache_read_evicted():
+    container = MockContainerClient({"a.pdf": ('"1"', b"aaaa"), "b.pdf": ('"1"', b"bbbb")})
+    blob_cache = BlobCache(container, max_memory_size=4)
+    cached_a = await add(blob_cache, "a.pdf")
+    await add(blob_cache, "b.pdf")
+    # The entry was looked up before it was evicted, so callers have to read it from storage
+    assert await blob_cache.read(cached_a) is None
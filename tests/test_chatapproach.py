@@ -1,3 +1,4 @@
+import asyncio
 import json
 
 import pytest
@@ -208,3 +209,61 @@ def test_get_messages_from_history_few_shots(chat_approach):
     assert messages[4]["role"] == "assistant"
     assert messages[5]["role"] == "user"
     assert messages[5]["content"] == user_query_request
+
+
+async def retrieved(reranker_score=None):
+    return None, ["Benefit_Options-2.pdf: There is a whistleblower policy."], reranker_score
+
+
+@pytest.mark.asyncio
+async def test_use_speculative_retrieval(chat_approach):
+    speculative_retrieval = asyncio.create_task(retrieved())
+    assert await chat_approach.use_speculative_retrieval(
+        speculative_retrieval, "What is the capital of France?", "capital of France", use_reranker_score=False
+    ) == (None, ["Benefit_Options-2.pdf: There is a whistleblower policy."], None)
+
+
+@pytest.mark.asyncio
+async def test_use_speculative_retrieval_rejected(chat_approach):
+    speculative_retrieval = asyncio.create_task(retrieved(reranker_score=3.5))
+    assert (
+        await chat_approach.use_speculative_retrieval(
+            speculative_retrieval,
+            "And for the other plan?",
+            "Northwind Health Plus deductible",
+            use_reranker_score=False,
+        )
+        is None
+    )
+    # The search query isn't known in time, so the speculative retrieval is stopped without waiting for it
+    await asyncio.sleep(0)
+    assert speculative_retrieval.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_use_speculative_retrieval_reranker_score(chat_approach):
+    speculative_retrieval = asyncio.create_task(retrieved(reranker_score=3.5))
+    assert await chat_approach.use_speculative_retrieval(
+        speculative_retrieval, "Can I see a doctor abroad?", "international coverage", use_reranker_score=True
+    )
+    speculative_retrieval = asyncio.create_task(retrieved(reranker_score=1.2))
+    assert (
+        await chat_approach.use_speculative_retrieval(
+            speculative_retrieval, "Can I see a doctor abroad?", "international coverage", use_reranker_score=True
+        )
+        is None
+    )
+
+
+@pytest.mark.asyncio
+async def test_use_speculative_retrieval_failed(chat_approach):
+    async def fail():
+        raise ZeroDivisionError()
+
+    speculative_retrieval = asyncio.create_task(fail())
+    assert (
+        await chat_approach.use_speculative_retrieval(
+            speculative_retrieval, "What is the capital of France?", "capital of France", use_reranker_score=False
+        )
+        is None
+    )
@@ -0,0 +1,46 @@
+import pytest
+
+from core.closingstream import ClosingStream
+
+
+async def events():
+    yield 1
+    yield 2
+
+
+@pytest.mark.asyncio
+async def test_closingstream():
+    closed = []
+    stream = ClosingStream(events(), lambda: closed.append(True))
+    assert [event async for event in stream] == [1, 2]
+    assert closed == [True]
+    await stream.aclose()
+    assert closed == [True]
+
+
+@pytest.mark.asyncio
+async def test_closingstream_error():
+    async def failing_events():
+        yield 1
+        raise ZeroDivisionError()
+
+    closed = []
+    stream = ClosingStream(failing_events(), lambda: closed.append(True))
+    with pytest.raises(ZeroDivisionError):
+        [event async for event in stream]
+    assert closed == [True]
+
+
+@pytest.mark.asyncio
+async def test_closingstream_closed_before_start():
+    closed = []
+    stream = ClosingStream(events(), lambda: closed.append(True))
+    await stream.aclose()
+    assert closed == [True]
+
+
+def test_closingstream_dropped():
+    closed = []
+    stream = ClosingStream(events(), lambda: closed.append(True))
+    del stream
+    assert closed == [True]
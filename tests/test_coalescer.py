@@ -0,0 +1,134 @@
+import asyncio
+
+import pytest
+
+from core.coalescer import RequestCoalescer
+
+
+def test_make_key():
+    messages = [{"role": "user", "content": "What is the capital of France?"}]
+    key = RequestCoalescer.make_key("/ask", messages, {}, None, False)
+    assert key == RequestCoalescer.make_key(
+        "/ask", [{"role": "user", "content": " what is the capital of  france?"}], {}, None, False
+    )
+    assert key != RequestCoalescer.make_key("/chat", messages, {}, None, False)
+    assert key != RequestCoalescer.make_key("/ask", messages, {"top": 1}, None, False)
+    assert key != RequestCoalescer.make_key("/ask", messages, {}, None, True)
+    assert key != RequestCoalescer.make_key("/ask", messages, {}, "oids/any(g:search.in(g, 'OID_X'))", False)
+
+
+@pytest.mark.asyncio
+async def test_coalescer_run():
+    coalescer = RequestCoalescer()
+    calls = 0
+
+    async def run():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return {"answer": calls}
+
+    results = await asyncio.gather(*[coalescer.run("key", run) for _ in range(5)])
+    assert results == [{"answer": 1}] * 5
+    # Each request gets its own copy of the result
+    assert len({id(result) for result in results}) == 5
+    assert coalescer.coalesced == 4
+    assert coalescer.inflight == {}
+
+    # Once finished, the next request runs again
+    assert await coalescer.run("key", run) == {"answer": 2}
+
+
+@pytest.mark.asyncio
+async def test_coalescer_run_error():
+    coalescer = RequestCoalescer()
+
+    async def run():
+        await asyncio.sleep(0.01)
+        raise ZeroDivisionError("something bad happened")
+
+    results = await asyncio.gather(*[coalescer.run("key", run) for _ in range(2)], return_exceptions=True)
+    assert all(isinstance(result, ZeroDivisionError) for result in results)
+    assert coalescer.inflight == {}
+
+
+@pytest.mark.asyncio
+async def test_coalescer_stream():
+    coalescer = RequestCoalescer()
+    calls = 0
+
+    async def events():
+        for i in range(3):
+            await asyncio.sleep(0.01)
+            yield {"index": i}
+
+    async def run():
+        nonlocal calls
+        calls += 1
+        return events()
+
+    async def collect(delay):
+        await asyncio.sleep(delay)
+        return [event async for event in coalescer.stream("key", run)]
+
+    # The second request joins after the first event and still gets the whole stream
+    results = await asyncio.gather(collect(0), collect(0.015))
+    assert results == [[{"index": 0}, {"index": 1}, {"index": 2}]] * 2
+    assert calls == 1
+    assert coalescer.coalesced == 1
+    assert coalescer.streams == {}
+
+
+@pytest.mark.asyncio
+async def test_coalescer_stream_error():
+    coalescer = RequestCoalescer()
+
+    async def events():
+        yield {"index": 0}
+        raise ZeroDivisionError("something bad happened")
+
+    async def run():
+        return events()
+
+    received = []
+    with pytest.raises(ZeroDivisionError):
+        async for event in coalescer.stream("key", run):
+            received.append(event)
+    assert received == [{"index": 0}]
+
+
+@pytest.mark.asyncio
+async def test_coalescer_stream_abandoned():
+    coalescer = RequestCoalescer()
+    produced = []
+
+    async def events():
+        for i in range(100):
+            await asyncio.sleep(0.01)
+            produced.append(i)
+            yield {"index": i}
+
+    async def run():
+        return events()
+
+    first = coalescer.stream("key", run)
+    second = coalescer.stream("key", run)
+    assert await first.__anext__() == {"index": 0}
+    # One of the requests goes away, the other one keeps receiving the stream
+    await first.aclose()
+    assert [await second.__anext__(), await second.__anext__()] == [{"index": 0}, {"index": 1}]
+    # The last request goes away, so the stream stops being read
+    await second.aclose()
+    await asyncio.sleep(0.05)
+    assert produced == [0, 1]
+    assert coalescer.streams == {}
+
+    # A request that was dropped before reading anything also counts as gone
+    third = coalescer.stream("other", run)
+    broadcast = coalescer.streams["other"]
+    del third
+    assert broadcast.abandoned
+    # New requests don't join an abandoned stream
+    fourth = coalescer.stream("other", run)
+    assert coalescer.streams["other"] is not broadcast
+    await fourth.aclose()
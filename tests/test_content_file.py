@@ -1,8 +1,10 @@
+import io
 import os
 from collections import namedtuple
 
 import aiohttp
 import pytest
+import pytest_asyncio
 from azure.core.exceptions import ResourceNotFoundError
 from azure.core.pipeline.transport import (
     AioHttpTransportResponse,
@@ -10,8 +12,10 @@ from azure.core.pipeline.transport import (
     HttpRequest,
 )
 from azure.storage.blob.aio import BlobServiceClient
+from pypdf import PdfReader, PdfWriter
 
 import app
+from core.blobcache import BlobCache
 
 MockToken = namedtuple("MockToken", ["token", "expires_on"])
 
@@ -21,57 +25,87 @@ class MockAzureCredential:
         return MockToken("mock_token", 9999999999)
 
 
-@pytest.mark.asyncio
-async def test_content_file(monkeypatch, mock_env):
-    class MockAiohttpClientResponse404(aiohttp.ClientResponse):
-        def __init__(self, url, body_bytes, headers=None):
-            self._body = body_bytes
-            self._headers = headers
-            self._cache = {}
-            self.status = 404
-            self.reason = "Not Found"
-            self._url = url
-
-    class MockAiohttpClientResponse(aiohttp.ClientResponse):
-        def __init__(self, url, body_bytes, headers=None):
-            self._body = body_bytes
-            self._headers = headers
-            self._cache = {}
-            self.status = 200
-            self.reason = "OK"
-            self._url = url
-
-    class MockTransport(AsyncHttpTransport):
-        async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
-            if request.url.endswith("notfound.pdf"):
-                raise ResourceNotFoundError(MockAiohttpClientResponse404(request.url, b""))
-            else:
-                return AioHttpTransportResponse(
-                    request,
-                    MockAiohttpClientResponse(
-                        request.url,
-                        b"test content",
-                        {
-                            "Content-Type": "application/octet-stream",
-                            "Content-Range": "bytes 0-27/28",
-                            "Content-Length": "28",
-                        },
-                    ),
-                )
-
-        async def __aenter__(self):
-            return self
-
-        async def __aexit__(self, *args):
-            pass
-
-        async def open(self):
-            pass
-
-        async def close(self):
-            pass
-
-    # Then we can plug this into any SDK via kwargs:
+class MockAiohttpClientResponse404(aiohttp.ClientResponse):
+    def __init__(self, url, body_bytes, headers=None):
+        self._body = body_bytes
+        self._headers = headers
+        self._cache = {}
+        self.status = 404
+        self.reason = "Not Found"
+        self._url = url
+
+
+class MockAiohttpClientResponse416(aiohttp.ClientResponse):
+    def __init__(self, url, body_bytes, headers=None):
+        self._body = body_bytes
+        self._headers = headers
+        self._cache = {}
+        self.status = 416
+        self.reason = "Range Not Satisfiable"
+        self._url = url
+
+
+class MockAiohttpClientResponse(aiohttp.ClientResponse):
+    def __init__(self, url, body_bytes, headers=None, status=200):
+        self._body = body_bytes
+        self._headers = headers
+        self._cache = {}
+        self.status = status
+        self.reason = "OK"
+        self._url = url
+
+
+class MockTransport(AsyncHttpTransport):
+    content = b"test content"
+    etag = '"0x8DC0000000000"'
+
+    async def send(self, request: HttpRequest, **kwargs) -> AioHttpTransportResponse:
+        if request.url.endswith("notfound.pdf"):
+            raise ResourceNotFoundError(MockAiohttpClientResponse404(request.url, b""))
+        size = len(self.content)
+        if request.method == "HEAD":
+            return AioHttpTransportResponse(
+                request,
+                MockAiohttpClientResponse(
+                    request.url,
+                    b"",
+                    {"Content-Type": "application/octet-stream", "Content-Length": str(size), "ETag": self.etag},
+                ),
+            )
+        start, end = (int(part) for part in request.headers["x-ms-range"].split("=")[1].split("-"))
+        if start >= size:
+            return AioHttpTransportResponse(request, MockAiohttpClientResponse416(request.url, b"", {}))
+        end = min(end, size - 1)
+        return AioHttpTransportResponse(
+            request,
+            MockAiohttpClientResponse(
+                request.url,
+                self.content[start : end + 1],
+                {
+                    "Content-Type": "application/octet-stream",
+                    "Content-Range": f"bytes {start}-{end}/{size}",
+                    "Content-Length": str(end - start + 1),
+                    "ETag": self.etag,
+                },
+                status=206,
+            ),
+        )
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+@pytest_asyncio.fixture(params=[True, False], ids=["cached", "streamed"])
+async def content_client(mock_env, mock_warm_up, request):
     blob_client = BlobServiceClient(
         f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
         credential=MockAzureCredential(),
@@ -82,18 +116,156 @@ async def test_content_file(monkeypatch, mock_env):
 
     quart_app = app.create_app()
     async with quart_app.test_app() as test_app:
-        quart_app.config.update({"blob_container_client": blob_container_client})
+        # Blobs larger than the max item size skip the cache and are streamed from storage
+        blob_cache = BlobCache(blob_container_client, max_item_size=1024 if request.param else 0)
+        quart_app.config.update({"blob_container_client": blob_container_client, "blob_cache": blob_cache})
+        yield test_app.test_client()
+
+
+@pytest.mark.asyncio
+async def test_content_file(content_client):
+    response = await content_client.get("/content/notfound.pdf")
+    assert response.status_code == 404
+
+    response = await content_client.get("/content/role_library.pdf")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/pdf"
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.headers["Content-Length"] == "12"
+    assert await response.get_data() == b"test content"
+
+    response = await content_client.get("/content/role_library.pdf#page=10")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/pdf"
+    assert await response.get_data() == b"test content"
+
+
+@pytest.mark.asyncio
+async def test_content_file_range(content_client):
+    response = await content_client.get("/content/role_library.pdf", headers={"Range": "bytes=5-11"})
+    assert response.status_code == 206
+    assert response.headers["Content-Type"] == "application/pdf"
+    assert response.headers["Content-Range"] == "bytes 5-11/12"
+    assert response.headers["Content-Length"] == "7"
+    assert await response.get_data() == b"content"
+
+    response = await content_client.get("/content/role_library.pdf", headers={"Range": "bytes=5-"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == "bytes 5-11/12"
+    assert await response.get_data() == b"content"
+
+    # Suffix ranges are ignored and the whole file is returned
+    response = await content_client.get("/content/role_library.pdf", headers={"Range": "bytes=-4"})
+    assert response.status_code == 200
+    assert await response.get_data() == b"test content"
+
+    response = await content_client.get("/content/role_library.pdf", headers={"Range": "bytes=100-200"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */12"
+
+
+@pytest.mark.asyncio
+async def test_content_file_cached_once_streamed(monkeypatch, content_client):
+    blob_cache = content_client.app.config["blob_cache"]
+    # Byte ranges of blobs that aren't cached are streamed from storage without being cached
+    response = await content_client.get("/content/role_library.pdf", headers={"Range": "bytes=5-11"})
+    assert await response.get_data() == b"content"
+    assert blob_cache.entries == {}
+
+    response = await content_client.get("/content/role_library.pdf")
+    assert await response.get_data() == b"test content"
+    assert ("role_library.pdf" in blob_cache.entries) == (blob_cache.max_item_size > 0)
+
+    # Cached blobs are served without reading the storage again until they are revalidated
+    monkeypatch.setattr(MockTransport, "content", b"new content!")
+    response = await content_client.get("/content/role_library.pdf")
+    expected = b"test content" if blob_cache.max_item_size > 0 else b"new content!"
+    assert await response.get_data() == expected
 
+
+@pytest.mark.asyncio
+async def test_content_file_if_none_match(monkeypatch, mock_env, mock_warm_up):
+    blob_client = BlobServiceClient(
+        f"https://{os.environ['AZURE_STORAGE_ACCOUNT']}.blob.core.windows.net",
+        credential=MockAzureCredential(),
+        transport=MockTransport(),
+        retry_total=0,  # Necessary to avoid unnecessary network requests during tests
+    )
+    blob_container_client = blob_client.get_container_client(os.environ["AZURE_STORAGE_CONTAINER"])
+
+    quart_app = app.create_app()
+    async with quart_app.test_app() as test_app:
+        blob_cache = BlobCache(blob_container_client)
+        quart_app.config.update({"blob_container_client": blob_container_client, "blob_cache": blob_cache})
         client = test_app.test_client()
-        response = await client.get("/content/notfound.pdf")
-        assert response.status_code == 404
 
         response = await client.get("/content/role_library.pdf")
         assert response.status_code == 200
-        assert response.headers["Content-Type"] == "application/pdf"
-        assert await response.get_data() == b"test content"
+        assert response.headers["ETag"] == MockTransport.etag
+
+        response = await client.get("/content/role_library.pdf", headers={"If-None-Match": MockTransport.etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == MockTransport.etag
+        assert await response.get_data() == b""
 
-        response = await client.get("/content/role_library.pdf#page=10")
+        response = await client.get("/content/role_library.pdf", headers={"If-None-Match": '"0xOTHER"'})
         assert response.status_code == 200
-        assert response.headers["Content-Type"] == "application/pdf"
         assert await response.get_data() == b"test content"
+
+
+@pytest.mark.asyncio
+async def test_content_file_page(monkeypatch, content_client):
+    writer = PdfWriter()
+    for index in range(5):
+        writer.add_blank_page(width=100 + index, height=100)
+    pdf = io.BytesIO()
+    writer.write(pdf)
+    monkeypatch.setattr(MockTransport, "content", pdf.getvalue())
+
+    response = await content_client.get("/content/role_library.pdf?page=3")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/pdf"
+    assert response.headers["ETag"] == '"0x8DC0000000000-3-0"'
+    pages = PdfReader(io.BytesIO(await response.get_data())).pages
+    assert [int(page.mediabox.width) for page in pages] == [102]
+
+    response = await content_client.get("/content/role_library.pdf?page=3&pages_around=1")
+    assert response.status_code == 200
+    pages = PdfReader(io.BytesIO(await response.get_data())).pages
+    assert [int(page.mediabox.width) for page in pages] == [101, 102, 103]
+
+    response = await content_client.get(
+        "/content/role_library.pdf?page=3", headers={"If-None-Match": '"0x8DC0000000000-3-0"'}
+    )
+    assert response.status_code == 304
+
+    response = await content_client.get("/content/role_library.pdf?page=6")
+    assert response.status_code == 404
+
+    response = await content_client.get("/content/notfound.pdf?page=1")
+    assert response.status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_content_file_evicted(monkeypatch, content_client):
+    async def read_evicted(self, entry, start=0, stop=None):
+        return None
+
+    # The blob is evicted from the cache between its lookup and its read, so it's read from storage instead
+    monkeypatch.setattr(BlobCache, "read", read_evicted)
+    response = await content_client.get("/content/role_library.pdf")
+    assert response.status_code == 200
+    assert await response.get_data() == b"test content"
+
+    response = await content_client.get("/content/role_library.pdf", headers={"Range": "bytes=5-11"})
+    assert response.status_code == 206
+    assert await response.get_data() == b"content"
+
+    writer = PdfWriter()
+    writer.add_blank_page(width=100, height=100)
+    pdf = io.BytesIO()
+    writer.write(pdf)
+    monkeypatch.setattr(MockTransport, "content", pdf.getvalue())
+    response = await content_client.get("/content/role_library.pdf?page=1")
+    assert response.status_code == 200
+    assert len(PdfReader(io.BytesIO(await response.get_data())).pages) == 1
@@ -0,0 +1,24 @@
+import io
+import os
+import urllib.request
+
+from scripts.downloadencodings import download_encodings
+
+
+def test_download_encodings(monkeypatch, tmp_path):
+    urls = []
+
+    def urlopen(url, timeout):
+        urls.append(url)
+        return io.BytesIO(b"IQ== 0\n")
+
+    monkeypatch.setattr(urllib.request, "urlopen", urlopen)
+    downloaded = download_encodings(str(tmp_path), ["cl100k_base"])
+    assert urls == ["https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken"]
+    # The file is named like tiktoken names the files of its cache
+    assert downloaded == [os.path.join(tmp_path, "9b5ad71b2ce5302211f9c61530b329a4922fc6a4")]
+    with open(downloaded[0], "rb") as f:
+        assert f.read() == b"IQ== 0\n"
+    # Encodings already in the cache aren't downloaded again
+    assert download_encodings(str(tmp_path), ["cl100k_base"]) == []
+    assert len(urls) == 1
@@ -0,0 +1,41 @@
+import numpy as np
+
+from core.embeddingcache import EmbeddingCache
+
+
+def test_embeddingcache_get_set():
+    embedding_cache = EmbeddingCache()
+    assert embedding_cache.get("text-embedding-ada-002", "What is the capital of France?") is None
+    embedding_cache.set("text-embedding-ada-002", "What is the capital of France?", [0.5, 0.25])
+    assert embedding_cache.get("text-embedding-ada-002", " What is the  capital\nof France? ") == [0.5, 0.25]
+    # Embeddings are case sensitive and specific to the model that computed them
+    assert embedding_cache.get("text-embedding-ada-002", "what is the capital of france?") is None
+    assert embedding_cache.get("text-embedding-3-small", "What is the capital of France?") is None
+    assert embedding_cache.hits == 1
+    assert embedding_cache.misses == 3
+    assert embedding_cache.hit_rate == 0.25
+
+
+def test_embeddingcache_float32():
+    embedding_cache = EmbeddingCache()
+    embedding_cache.set("model", "text", [0.1] * 1536)
+    assert embedding_cache.entries[("model", "text")].dtype == np.float32
+    assert embedding_cache.size == 1536 * 4
+
+
+def test_embeddingcache_eviction():
+    embedding_cache = EmbeddingCache(max_size=16)
+    embedding_cache.set("model", "a", [1.0, 0.0])
+    embedding_cache.set("model", "b", [0.0, 1.0])
+    embedding_cache.get("model", "a")
+    embedding_cache.set("model", "c", [1.0, 1.0])
+    # b was the least recently used
+    assert list(embedding_cache.entries) == [("model", "a"), ("model", "c")]
+    assert embedding_cache.size == 16
+
+    embedding_cache.set("model", "a", [1.0, 2.0])
+    assert embedding_cache.get("model", "a") == [1.0, 2.0]
+    assert embedding_cache.size == 16
+
+    embedding_cache.set("model", "d", [1.0, 2.0, 3.0, 4.0, 5.0])
+    assert embedding_cache.get("model", "d") is None
@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+
+from core.framing import DeltaCoalescer
+
+
+def delta(content: str) -> dict:
+    return {
+        "choices": [{"delta": {"content": content}, "finish_reason": None, "index": 0}],
+        "object": "chat.completion.chunk",
+    }
+
+
+def contents(events: list[dict]) -> list:
+    return [event["choices"][0]["delta"].get("content") for event in events]
+
+
+async def generate(events: list[dict], delay: float = 0):
+    for event in events:
+        if delay:
+            await asyncio.sleep(delay)
+        yield event
+
+
+context_event = {
+    "choices": [{"delta": {"role": "assistant"}, "context": {"data_points": []}, "finish_reason": None, "index": 0}],
+    "object": "chat.completion.chunk",
+}
+
+
+@pytest.mark.asyncio
+async def test_coalesce_deltas():
+    coalescer = DeltaCoalescer(max_delay=10, max_size=1000)
+    events = [context_event] + [delta(c) for c in ["The", " capital", " of", " France", " is", " Paris."]]
+    result = [event async for event in coalescer.coalesce(generate(events))]
+    # The first delta is sent right away, and the rest is merged into one frame
+    assert result[0] is context_event
+    assert contents(result[1:]) == ["The", " capital of France is Paris."]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_max_size():
+    coalescer = DeltaCoalescer(max_delay=10, max_size=4)
+    events = [delta(c) for c in ["a", "bb", "cc", "d", "eeee", "f"]]
+    result = [event async for event in coalescer.coalesce(generate(events))]
+    assert contents(result) == ["a", "bbcc", "deeee", "f"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_max_delay():
+    coalescer = DeltaCoalescer(max_delay=0.03, max_size=1000)
+    events = [delta(c) for c in ["a", "b", "c", "d"]]
+    result = [event async for event in coalescer.coalesce(generate(events, delay=0.02))]
+    # Each frame is sent once its first delta is 30ms old, even while waiting for the next delta
+    assert len(result) > 2
+    assert "".join(contents(result)) == "abcd"
+
+
+@pytest.mark.asyncio
+async def test_coalesce_other_events_flush():
+    coalescer = DeltaCoalescer(max_delay=10, max_size=1000)
+    followup_event = {
+        "choices": [{"delta": {"role": "assistant"}, "context": {"followup_questions": ["Why?"]}, "index": 0}],
+        "object": "chat.completion.chunk",
+    }
+    events = [delta("a"), delta("b"), delta("c"), followup_event, delta("d"), {"error": "failed"}]
+    result = [event async for event in coalescer.coalesce(generate(events))]
+    assert contents(result[:2]) == ["a", "bc"]
+    assert result[2] is followup_event
+    assert contents(result[3:4]) == ["d"]
+    assert result[4] == {"error": "failed"}
+
+
+@pytest.mark.asyncio
+async def test_coalesce_error():
+    async def failing():
+        yield delta("a")
+        yield delta("b")
+        raise ZeroDivisionError("something bad happened")
+
+    coalescer = DeltaCoalescer(max_delay=10, max_size=1000)
+    result = []
+    with pytest.raises(ZeroDivisionError):
+        async for event in coalescer.coalesce(failing()):
+            result.append(event)
+    assert contents(result) == ["a", "b"]
+
+
+@pytest.mark.asyncio
+async def test_coalesce_close():
+    closed = asyncio.Event()
+
+    async def endless():
+        try:
+            yield delta("a")
+            while True:
+                await asyncio.sleep(1)
+                yield delta("b")
+        finally:
+            closed.set()
+
+    coalescer = DeltaCoalescer(max_delay=10, max_size=1000)
+    frames = coalescer.coalesce(endless())
+    assert contents([await frames.__anext__()]) == ["a"]
+    next_frame = asyncio.ensure_future(frames.__anext__())
+    await asyncio.sleep(0.01)
+    next_frame.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await next_frame
+    await frames.aclose()
+    await asyncio.wait_for(closed.wait(), 1)
@@ -1,4 +1,6 @@
-from core.messagebuilder import MessageBuilder
+import pytest
+
+from core.messagebuilder import MessageBuilder, compile_message
 
 
 def test_messagebuilder():
@@ -47,3 +49,26 @@ def test_messagebuilder_unicode_append():
     assert builder.model == "gpt-35-turbo"
     assert builder.count_tokens_for_message(builder.messages[0]) == 4
     assert builder.count_tokens_for_message(builder.messages[1]) == 4
+
+
+def test_messagebuilder_insert_prompt_message():
+    builder = MessageBuilder("You are a bot.", "gpt-35-turbo")
+    builder.insert_message("user", "Hello, how are you?")
+    builder.insert_prompt_message("assistant", "á")
+    builder.insert_prompt_message("user", "á")
+    assert builder.messages == [
+        {"role": "system", "content": "You are a bot."},
+        {"role": "user", "content": "á"},
+        {"role": "assistant", "content": "á"},
+        {"role": "user", "content": "Hello, how are you?"},
+    ]
+    # The compiled messages are shared by the builders, which get copies of them
+    builder.messages[1]["content"] = "Changed"
+    assert compile_message("user", "a\u0301") == {"role": "user", "content": "á"}
+    assert MessageBuilder("You are a bot.", "gpt-35-turbo").messages[0] is not builder.messages[0]
+    assert compile_message("user", "a\u0301") is compile_message("user", "a\u0301")
+
+
+def test_compile_message_invalid_role():
+    with pytest.raises(ValueError):
+        compile_message("tool", "Hello")
@@ -0,0 +1,130 @@
+import asyncio
+
+import pytest
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from prometheus_client import REGISTRY
+
+from core import metrics
+
+
+def sample(name: str, **labels) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def chunk(content) -> ChatCompletionChunk:
+    return ChatCompletionChunk.model_validate(
+        {
+            "id": "test-id",
+            "object": "chat.completion.chunk",
+            "created": 1,
+            "model": "gpt-35-turbo",
+            "choices": [{"delta": {"content": content}, "index": 0, "finish_reason": None}],
+        }
+    )
+
+
+def test_measure_stage():
+    before = sample("app_stage_duration_seconds_count", approach="test", stage="search")
+    with pytest.raises(ZeroDivisionError):
+        with metrics.measure_stage("test", "search"):
+            raise ZeroDivisionError()
+    assert sample("app_stage_duration_seconds_count", approach="test", stage="search") == before + 1
+
+
+@pytest.mark.asyncio
+async def test_measure_completion():
+    completion = ChatCompletion.model_validate(
+        {"id": "test-id", "object": "chat.completion", "created": 1, "model": "gpt-35-turbo", "choices": []}
+    )
+
+    async def create():
+        return completion
+
+    before = sample("app_stage_duration_seconds_count", approach="test", stage="answer")
+    assert await metrics.measure_completion("test", create()) is completion
+    assert sample("app_stage_duration_seconds_count", approach="test", stage="answer") == before + 1
+
+
+@pytest.mark.asyncio
+async def test_measure_completion_stream():
+    async def stream():
+        for content in [None, "The", " capital", " is", " Paris."]:
+            yield chunk(content)
+
+    async def create():
+        return stream()
+
+    first_token_before = sample("app_stage_duration_seconds_count", approach="test", stage="first_token")
+    tokens_before = sample("app_streamed_tokens_total", approach="test")
+    rates_before = sample("app_stream_tokens_per_second_count", approach="test")
+    chunks = [chunk async for chunk in await metrics.measure_completion("test", create())]
+    assert len(chunks) == 5
+    assert sample("app_stage_duration_seconds_count", approach="test", stage="first_token") == first_token_before + 1
+    assert sample("app_streamed_tokens_total", approach="test") == tokens_before + 4
+    assert sample("app_stream_tokens_per_second_count", approach="test") == rates_before + 1
+
+
+@pytest.mark.asyncio
+async def test_track_stream():
+    async def events():
+        yield {"a": 1}
+
+    started_at = metrics.start_request("/test")
+    assert sample("app_requests_in_flight", route="/test") == 1
+    assert [event async for event in metrics.track_stream("/test", events(), started_at)] == [{"a": 1}]
+    assert sample("app_requests_in_flight", route="/test") == 0
+    assert sample("app_requests_total", route="/test", status="200") >= 1
+
+
+@pytest.mark.asyncio
+async def test_track_stream_not_started():
+    async def events():
+        yield {"a": 1}
+
+    before = sample("app_requests_total", route="/test-closed", status="200")
+    started_at = metrics.start_request("/test-closed")
+    stream = metrics.track_stream("/test-closed", events(), started_at)
+    # The client disconnected before the response started
+    await stream.aclose()
+    assert sample("app_requests_in_flight", route="/test-closed") == 0
+    assert sample("app_requests_total", route="/test-closed", status="200") == before + 1
+
+
+def test_request_timings():
+    timings = metrics.RequestTimings(started_at=10.0)
+    timings.add("search", 10.5, 0.25)
+    timings.add("embedding", 10.1, 0.3)
+    timings.add("embedding", 10.2, 0.3)
+    assert timings.as_list(total=False) == [
+        {"name": "embedding", "start": 100.0, "duration": 300.0},
+        {"name": "embedding", "start": 200.0, "duration": 300.0},
+        {"name": "search", "start": 500.0, "duration": 250.0},
+    ]
+    assert timings.as_header(total=False) == "embedding;dur=300.0, embedding;dur=300.0, search;dur=250.0"
+    assert timings.as_list()[-1]["name"] == "total"
+
+
+@pytest.mark.asyncio
+async def test_bind_timings():
+    async def events():
+        with metrics.measure_stage("test", "search"):
+            pass
+        yield {"a": 1}
+
+    timings = metrics.RequestTimings()
+    bound = metrics.bind_timings(events(), timings, include_timings=True)
+    # The events are read from other tasks, which don't see the timings of the request otherwise
+    result = [await asyncio.ensure_future(bound.__anext__()), await asyncio.ensure_future(bound.__anext__())]
+    assert result[0] == {"a": 1}
+    assert [timing["name"] for timing in result[1]["choices"][0]["context"]["timings"]] == ["search", "total"]
+    assert metrics.current_timings.get() is None
+
+
+def test_generate_metrics(monkeypatch, tmp_path):
+    data, content_type = metrics.generate_metrics()
+    assert content_type.startswith("text/plain")
+    assert b"app_stage_duration_seconds" in data
+    # Metrics written by other workers are aggregated from the multiprocess directory
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+    data, _ = metrics.generate_metrics()
+    assert data == b""
@@ -0,0 +1,171 @@
+import random
+import time
+
+import httpx
+import openai
+import pytest
+
+from core.openaipool import OpenAIEndpoint, OpenAIPoolTransport, parse_endpoints
+from core.ratelimit import RateLimitedTransport, SharedRateLimiter
+
+CHAT_PATH = "/openai/deployments/chat/chat/completions"
+
+
+def make_pool(handler, endpoints=None):
+    endpoints = endpoints or [OpenAIEndpoint("first", "chat"), OpenAIEndpoint("second", "chat-second")]
+    return OpenAIPoolTransport("chat", endpoints, httpx.MockTransport(handler), random_generator=random.Random(0))
+
+
+async def post(transport: httpx.AsyncBaseTransport, path: str = CHAT_PATH) -> httpx.Response:
+    async with httpx.AsyncClient(transport=transport) as client:
+        return await client.post(f"https://first.openai.azure.com{path}", json={"messages": []})
+
+
+@pytest.mark.asyncio
+async def test_failover_on_rate_limit():
+    hosts = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        hosts.append(request.url.host)
+        if request.url.host == "first.openai.azure.com":
+            return httpx.Response(429, headers={"Retry-After": "30"})
+        assert request.url.path == "/openai/deployments/chat-second/chat/completions"
+        return httpx.Response(200, json={"choices": []})
+
+    transport = make_pool(handler)
+    for _ in range(3):
+        response = await post(transport)
+        assert response.status_code == 200
+    # The first endpoint is left out after its 429, so it is called at most once
+    assert hosts.count("first.openai.azure.com") <= 1
+    assert hosts.count("second.openai.azure.com") == 3
+
+
+@pytest.mark.asyncio
+async def test_failover_on_connection_error():
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.host == "first.openai.azure.com":
+            raise httpx.ConnectError("unreachable", request=request)
+        return httpx.Response(200, json={"choices": []})
+
+    transport = make_pool(handler)
+    for _ in range(3):
+        assert (await post(transport)).status_code == 200
+    assert transport.endpoints[1].requests == 3
+
+
+@pytest.mark.asyncio
+async def test_all_endpoints_ejected():
+    calls = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(request)
+        return httpx.Response(503, headers={"retry-after-ms": "20000"})
+
+    transport = make_pool(handler)
+    response = await post(transport)
+    assert response.status_code == 503
+    assert len(calls) == 2
+    # Until an endpoint is back, calls are answered without reaching any of them
+    response = await post(transport)
+    assert response.status_code == 429
+    assert 1 <= int(response.headers["Retry-After"]) <= 20
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_other_deployments_pass_through():
+    def handler(request: httpx.Request) -> httpx.Response:
+        assert request.url.host == "first.openai.azure.com"
+        return httpx.Response(200, json={"data": []})
+
+    transport = make_pool(handler)
+    response = await post(transport, "/openai/deployments/embedding/embeddings")
+    assert response.status_code == 200
+    assert all(endpoint.requests == 0 for endpoint in transport.endpoints)
+
+
+@pytest.mark.asyncio
+async def test_weighted_by_remaining_quota():
+    def handler(request: httpx.Request) -> httpx.Response:
+        remaining = "100000" if request.url.host == "first.openai.azure.com" else "10"
+        return httpx.Response(200, headers={"x-ratelimit-remaining-tokens": remaining}, json={})
+
+    transport = make_pool(handler)
+    for _ in range(50):
+        await post(transport)
+    first, second = transport.endpoints
+    assert first.remaining_tokens == 100000
+    assert second.remaining_tokens == 10
+    assert first.requests > 40
+
+
+@pytest.mark.asyncio
+async def test_openai_client_stream_failover():
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.host == "first.openai.azure.com":
+            return httpx.Response(500)
+        return httpx.Response(
+            200,
+            headers={"content-type": "text/event-stream"},
+            content=(
+                b'data: {"id": "1", "object": "chat.completion.chunk", "created": 0, "model": "gpt", '
+                b'"choices": [{"index": 0, "delta": {"content": "Hello"}, "finish_reason": null}]}\n\n'
+                b"data: [DONE]\n\n"
+            ),
+        )
+
+    transport = make_pool(handler)
+    # The first endpoint reports the most remaining quota, so it is tried first and fails over
+    first, second = transport.endpoints
+    first.remaining_tokens, second.remaining_tokens = 1000000, 1
+    first.updated_at = second.updated_at = time.monotonic()
+    openai_client = openai.AsyncAzureOpenAI(
+        api_version="2023-07-01-preview",
+        azure_endpoint="https://first.openai.azure.com",
+        api_key="key",
+        http_client=httpx.AsyncClient(transport=transport),
+        max_retries=0,
+    )
+    stream = await openai_client.chat.completions.create(
+        model="chat", messages=[{"role": "user", "content": "Hi"}], stream=True
+    )
+    contents = [chunk.choices[0].delta.content async for chunk in stream]
+    assert contents == ["Hello"]
+    assert first.failures == 1
+    assert second.requests == 1
+
+
+@pytest.mark.asyncio
+async def test_rate_limited_per_endpoint(tmp_path):
+    hosts = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        hosts.append(request.url.host)
+        return httpx.Response(200, json={"choices": []})
+
+    rate_limiter = SharedRateLimiter(
+        str(tmp_path / "ratelimit.sqlite"), {"first/chat": (6000, 1), "second/chat-second": (6000, 60)}, max_wait=1
+    )
+    endpoints = [OpenAIEndpoint("first", "chat"), OpenAIEndpoint("second", "chat-second")]
+    transport = OpenAIPoolTransport(
+        "chat", endpoints, RateLimitedTransport(rate_limiter, httpx.MockTransport(handler)), random.Random(0)
+    )
+    for _ in range(4):
+        assert (await post(transport)).status_code == 200
+    # The first endpoint allows a single request per minute, then the calls fail over to the second one
+    # without waiting, which is limited by its own quota
+    assert hosts.count("first.openai.azure.com") <= 1
+    assert hosts.count("second.openai.azure.com") >= 3
+
+
+def test_parse_endpoints():
+    endpoints = parse_endpoints([" second/chat-second ", "", "third/chat:60000"], 30000)
+    assert [(repr(endpoint), tokens_per_minute) for endpoint, tokens_per_minute in endpoints] == [
+        ("second/chat-second", 30000),
+        ("third/chat", 60000),
+    ]
+    assert endpoints[0][0].host == "second.openai.azure.com"
+    for entry in ["second", "second/", "/chat", "second/chat/other", "second/chat:fast"]:
+        with pytest.raises(ValueError, match=entry):
+            parse_endpoints([entry], 30000)
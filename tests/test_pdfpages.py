@@ -0,0 +1,71 @@
+import io
+
+import pytest
+from pypdf import PdfReader, PdfWriter
+
+from core.pdfpages import PageOutOfRangeError, PdfPageCache
+
+
+def create_pdf(page_count: int) -> bytes:
+    # Each page gets a distinct width so that extracted pages can be identified
+    writer = PdfWriter()
+    for index in range(page_count):
+        writer.add_blank_page(width=100 + index, height=100)
+    output = io.BytesIO()
+    writer.write(output)
+    return output.getvalue()
+
+
+def page_widths(pdf: bytes) -> list[int]:
+    return [int(page.mediabox.width) for page in PdfReader(io.BytesIO(pdf)).pages]
+
+
+@pytest.mark.asyncio
+async def test_extract_page():
+    pdf_page_cache = PdfPageCache()
+    content = await pdf_page_cache.extract("a.pdf", '"1"', create_pdf(5), page=3)
+    assert page_widths(content) == [102]
+
+
+@pytest.mark.asyncio
+async def test_extract_pages_around():
+    pdf_page_cache = PdfPageCache()
+    pdf = create_pdf(5)
+    assert page_widths(await pdf_page_cache.extract("a.pdf", '"1"', pdf, page=3, pages_around=1)) == [101, 102, 103]
+    # Neighbours are clipped at the start and end of the document
+    assert page_widths(await pdf_page_cache.extract("a.pdf", '"1"', pdf, page=1, pages_around=2)) == [100, 101, 102]
+    assert page_widths(await pdf_page_cache.extract("a.pdf", '"1"', pdf, page=5, pages_around=1)) == [103, 104]
+
+
+@pytest.mark.asyncio
+async def test_extract_page_out_of_range():
+    pdf_page_cache = PdfPageCache()
+    with pytest.raises(PageOutOfRangeError):
+        await pdf_page_cache.extract("a.pdf", '"1"', create_pdf(2), page=3)
+    with pytest.raises(PageOutOfRangeError):
+        await pdf_page_cache.extract("a.pdf", '"1"', create_pdf(2), page=0)
+
+
+@pytest.mark.asyncio
+async def test_extract_page_cached():
+    pdf_page_cache = PdfPageCache()
+    content = await pdf_page_cache.extract("a.pdf", '"1"', create_pdf(5), page=2)
+    assert pdf_page_cache.get("a.pdf", '"1"', 2, 0) == content
+    # The cached page is returned without parsing the document again
+    assert await pdf_page_cache.extract("a.pdf", '"1"', b"not a pdf", page=2) == content
+    # A new ETag means the blob was re-uploaded
+    assert pdf_page_cache.get("a.pdf", '"2"', 2, 0) is None
+    assert pdf_page_cache.size == len(content)
+
+
+@pytest.mark.asyncio
+async def test_extract_page_eviction():
+    pdf = create_pdf(5)
+    page_size = len(PdfPageCache.extract_pages(pdf, 1, 0))
+    pdf_page_cache = PdfPageCache(max_size=page_size * 2)
+    await pdf_page_cache.extract("a.pdf", '"1"', pdf, page=1)
+    await pdf_page_cache.extract("a.pdf", '"1"', pdf, page=2)
+    await pdf_page_cache.extract("a.pdf", '"1"', pdf, page=1)
+    await pdf_page_cache.extract("a.pdf", '"1"', pdf, page=3)
+    assert [key[2] for key in pdf_page_cache.entries] == [1, 3]
+    assert pdf_page_cache.size <= pdf_page_cache.max_size
@@ -0,0 +1,187 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from core.ratelimit import (
+    RateLimitedTransport,
+    RateLimitExceededError,
+    SharedRateLimiter,
+)
+
+
+@pytest.fixture
+def rate_limiter(tmp_path):
+    return SharedRateLimiter(str(tmp_path / "ratelimit.sqlite"), {"gpt": (6000, 60)})
+
+
+def test_reserve_within_quota(rate_limiter):
+    assert rate_limiter.reserve_sync("gpt", 1000, now=100) == 0
+    assert rate_limiter.reserve_sync("gpt", 5000, now=100) == 0
+    # The bucket is empty, so the next call waits for 1000 tokens, i.e. 10 seconds at 6000 tokens per minute
+    assert rate_limiter.reserve_sync("gpt", 1000, now=100) == pytest.approx(10)
+    # ...and the one after it also waits for the tokens reserved by the previous call
+    assert rate_limiter.reserve_sync("gpt", 1000, now=100) == pytest.approx(20)
+
+
+def test_reserve_refills(rate_limiter):
+    rate_limiter.reserve_sync("gpt", 6000, now=100)
+    assert rate_limiter.reserve_sync("gpt", 3000, now=130) == 0
+    assert rate_limiter.reserve_sync("gpt", 600, now=130) == pytest.approx(6)
+
+
+def test_reserve_requests_per_minute(tmp_path):
+    rate_limiter = SharedRateLimiter(str(tmp_path / "ratelimit.sqlite"), {"gpt": (100000, 2)})
+    assert rate_limiter.reserve_sync("gpt", 1, now=100) == 0
+    assert rate_limiter.reserve_sync("gpt", 1, now=100) == 0
+    assert rate_limiter.reserve_sync("gpt", 1, now=100) == pytest.approx(30)
+
+
+def test_reserve_max_wait(rate_limiter):
+    rate_limiter.reserve_sync("gpt", 6000, now=100)
+    with pytest.raises(RateLimitExceededError) as exc_info:
+        rate_limiter.reserve_sync("gpt", 7000, now=100)
+    assert exc_info.value.retry_after == 71
+    # The rejected call doesn't take anything from the bucket
+    assert rate_limiter.reserve_sync("gpt", 600, now=100) == pytest.approx(6)
+
+
+def test_adjust(rate_limiter):
+    rate_limiter.reserve_sync("gpt", 6000, now=100)
+    rate_limiter.adjust_sync("gpt", 4000, now=100)
+    assert rate_limiter.reserve_sync("gpt", 4000, now=100) == 0
+    # Refunds can't fill the bucket beyond its capacity
+    rate_limiter.adjust_sync("gpt", 100000, now=100)
+    assert rate_limiter.reserve_sync("gpt", 6600, now=100) == pytest.approx(6)
+
+
+def test_shared_between_limiters(tmp_path):
+    path = str(tmp_path / "ratelimit.sqlite")
+    first = SharedRateLimiter(path, {"gpt": (6000, 60)})
+    second = SharedRateLimiter(path, {"gpt": (6000, 60)})
+    assert first.reserve_sync("gpt", 6000, now=100) == 0
+    assert second.reserve_sync("gpt", 600, now=100) == pytest.approx(6)
+
+
+@pytest.mark.asyncio
+async def test_reserve_unknown_key(rate_limiter):
+    await rate_limiter.reserve("other", 1000000)
+
+
+def chat_body(model: str, content: str, max_tokens: int = 100) -> bytes:
+    return json.dumps(
+        {"model": model, "messages": [{"role": "user", "content": content}], "max_tokens": max_tokens}
+    ).encode("utf-8")
+
+
+@pytest.mark.asyncio
+async def test_transport_reconciles_usage(rate_limiter):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, json={"choices": [], "usage": {"total_tokens": 20}})
+
+    transport = RateLimitedTransport(rate_limiter, httpx.MockTransport(handler))
+    async with httpx.AsyncClient(transport=transport) as client:
+        response = await client.post("https://test/chat/completions", content=chat_body("gpt", "hello there"))
+    assert response.status_code == 200
+    assert response.json()["usage"]["total_tokens"] == 20
+    assert len(requests) == 1
+    tokens, requests_left, _ = (
+        rate_limiter.connect().execute("SELECT tokens, requests, updated_at FROM buckets WHERE key = 'gpt'").fetchone()
+    )
+    assert tokens == pytest.approx(6000 - 20, abs=5)
+    assert requests_left == pytest.approx(59, abs=0.1)
+
+
+@pytest.mark.asyncio
+async def test_transport_unknown_model(rate_limiter):
+    transport = RateLimitedTransport(rate_limiter, httpx.MockTransport(lambda request: httpx.Response(200, json={})))
+    async with httpx.AsyncClient(transport=transport) as client:
+        response = await client.post("https://test/chat/completions", content=chat_body("other", "hello"))
+    assert response.status_code == 200
+    assert rate_limiter.connect().execute("SELECT COUNT(*) FROM buckets").fetchone()[0] == 0
+
+
+@pytest.mark.asyncio
+async def test_transport_rate_limited(rate_limiter):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, json={})
+
+    transport = RateLimitedTransport(rate_limiter, httpx.MockTransport(handler))
+    async with httpx.AsyncClient(transport=transport) as client:
+        response = await client.post(
+            "https://test/chat/completions", content=chat_body("gpt", "hello", max_tokens=100000)
+        )
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 60
+    assert requests == []
+
+
+@pytest.mark.asyncio
+async def test_transport_gives_back_failed_calls(rate_limiter):
+    def handler(request: httpx.Request) -> httpx.Response:
+        if b"fail" in request.content:
+            raise httpx.ConnectError("unreachable", request=request)
+        return httpx.Response(500, json={"error": {}})
+
+    transport = RateLimitedTransport(rate_limiter, httpx.MockTransport(handler))
+    async with httpx.AsyncClient(transport=transport) as client:
+        response = await client.post("https://test/chat/completions", content=chat_body("gpt", "hello", 1000))
+        assert response.status_code == 500
+        with pytest.raises(httpx.ConnectError):
+            await client.post("https://test/chat/completions", content=chat_body("gpt", "fail", 1000))
+    tokens, requests_left, _ = (
+        rate_limiter.connect().execute("SELECT tokens, requests, updated_at FROM buckets WHERE key = 'gpt'").fetchone()
+    )
+    assert tokens == pytest.approx(6000, abs=1)
+    assert requests_left == pytest.approx(58, abs=0.1)
+
+
+@pytest.mark.asyncio
+async def test_transport_gives_back_cancelled_calls(rate_limiter):
+    requests = []
+    transport = RateLimitedTransport(rate_limiter, httpx.MockTransport(lambda request: requests.append(request)))
+    rate_limiter.reserve_sync("gpt", 6000)
+    async with httpx.AsyncClient(transport=transport) as client:
+        call = asyncio.create_task(
+            client.post("https://test/chat/completions", content=chat_body("gpt", "hello", max_tokens=1000))
+        )
+        await asyncio.sleep(0.2)
+        call.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await call
+    while rate_limiter.tasks:
+        await asyncio.sleep(0.01)
+    assert requests == []
+    # Without the tokens of the cancelled call, the bucket has refilled for the time spent instead of going negative
+    tokens, _ = rate_limiter.refill(rate_limiter.connect(), "gpt", time.time())
+    assert tokens > 0
+
+
+def test_estimate_tokens(rate_limiter):
+    transport = RateLimitedTransport(rate_limiter, httpx.MockTransport(lambda request: httpx.Response(200)))
+    body = {"messages": [{"role": "user", "content": "hello"}], "max_tokens": 10}
+    assert transport.estimate_tokens(body) == 3 + 4 + 1 + 10
+    assert transport.estimate_tokens({"input": "hello"}) == 1
+    assert transport.estimate_tokens({"input": ["hello", "hello world"]}) == 3
+
+
+@pytest.mark.asyncio
+async def test_transport_endpoint_key(tmp_path):
+    rate_limiter = SharedRateLimiter(str(tmp_path / "ratelimit.sqlite"), {"first/chat": (6000, 60)})
+    transport = RateLimitedTransport(rate_limiter, httpx.MockTransport(lambda request: httpx.Response(200, json={})))
+    async with httpx.AsyncClient(transport=transport) as client:
+        await client.post(
+            "https://first.openai.azure.com/openai/deployments/chat/chat/completions", content=chat_body("gpt", "hi")
+        )
+        await client.post(
+            "https://second.openai.azure.com/openai/deployments/chat/chat/completions", content=chat_body("gpt", "hi")
+        )
+    assert rate_limiter.connect().execute("SELECT key FROM buckets").fetchall() == [("first/chat",)]
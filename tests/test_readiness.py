@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+from core.readiness import Readiness
+
+
+@pytest.mark.asyncio
+async def test_readiness(monkeypatch):
+    attempts = []
+
+    async def warm_up():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError("Connection refused")
+
+    async def sleep(delay):
+        pass
+
+    readiness = Readiness()
+    assert readiness.ready
+    monkeypatch.setattr(asyncio, "sleep", sleep)
+    readiness.start("openai", warm_up)
+    assert not readiness.ready
+    assert readiness.pending == {"openai"}
+    await asyncio.gather(*readiness.tasks)
+    assert readiness.ready
+    assert len(attempts) == 3
+
+
+@pytest.mark.asyncio
+async def test_readiness_close():
+    started = asyncio.Event()
+
+    async def warm_up():
+        started.set()
+        await asyncio.Event().wait()
+
+    readiness = Readiness()
+    readiness.start("search", warm_up)
+    await started.wait()
+    await readiness.close()
+    assert readiness.tasks[0].cancelled()
+    assert not readiness.ready
@@ -0,0 +1,69 @@
+import dataclasses
+import datetime
+import json
+
+from openai.types.chat import ChatCompletionChunk
+from quart import Quart
+
+from core import serialization
+from core.serialization import dumps, encode_chunk
+
+
+@dataclasses.dataclass
+class Point:
+    x: int
+    y: int
+
+
+def test_dumps():
+    obj = {"b": "I ❤️ 🐍\nline", "a": [1, 2.5, None, True]}
+    assert dumps(obj) == '{"b":"I ❤️ 🐍\\nline","a":[1,2.5,null,true]}'
+    assert dumps(obj, sort_keys=True) == '{"a":[1,2.5,null,true],"b":"I ❤️ 🐍\\nline"}'
+    assert json.loads(dumps(obj)) == obj
+
+
+def test_dumps_without_orjson(monkeypatch):
+    obj = {"b": "I ❤️ 🐍\nline", "a": [1, 2.5, None, True]}
+    expected = dumps(obj, sort_keys=True)
+    monkeypatch.setattr(serialization, "orjson", None)
+    assert dumps(obj, sort_keys=True) == expected
+
+
+def test_dumps_same_as_json(monkeypatch):
+    provider = serialization.JSONProvider(Quart(__name__))
+    obj = {
+        1: "int key",
+        "date": datetime.datetime(2023, 12, 14, 10, 30, tzinfo=datetime.timezone.utc),
+        "point": Point(1, 2),
+    }
+    expected = dumps(obj, default=provider.default)
+    assert json.loads(expected) == {"1": "int key", "date": "Thu, 14 Dec 2023 10:30:00 GMT", "point": {"x": 1, "y": 2}}
+    monkeypatch.setattr(serialization, "orjson", None)
+    assert dumps(obj, default=provider.default) == expected
+
+
+def test_dumps_default():
+    assert dumps({"a": {1, 2}}, default=sorted) == '{"a":[1,2]}'
+
+
+def test_encode_chunk():
+    chunk = ChatCompletionChunk.model_validate(
+        {
+            "id": "test-id",
+            "object": "chat.completion.chunk",
+            "created": 1,
+            "model": "gpt-35-turbo",
+            "choices": [{"delta": {"content": "Paris", "role": None}, "index": 0, "finish_reason": None}],
+        }
+    )
+    assert encode_chunk(chunk) == {
+        "choices": [{"delta": {"content": "Paris"}, "finish_reason": None, "index": 0}],
+        "object": "chat.completion.chunk",
+    }
+
+
+def test_encode_chunk_without_choices():
+    chunk = ChatCompletionChunk.model_validate(
+        {"id": "test-id", "object": "chat.completion.chunk", "created": 1, "model": "gpt-35-turbo", "choices": []}
+    )
+    assert encode_chunk(chunk) == {"choices": [], "object": "chat.completion.chunk"}
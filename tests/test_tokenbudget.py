@@ -0,0 +1,44 @@
+from core.tokenbudget import TokenBudget
+
+
+def test_reserve():
+    budget = TokenBudget("gpt-35-turbo", 1024)
+    assert budget.available == 4000 - 1024
+    # 1 token, 1 token, 1 token, 5 tokens
+    assert budget.reserve("system", "You are a bot.") == 8
+    assert budget.available == 4000 - 1024 - 8
+    budget = TokenBudget("gpt-35-turbo", 1024, token_limit=1030)
+    budget.reserve("system", "You are a bot.")
+    assert budget.available == 0
+
+
+def test_pack_sources():
+    sources = [
+        "Benefit_Options-2.pdf: There is a whistleblower policy.",  # 13 tokens
+        "Benefit_Options-3.pdf: Overlake is in-network for the employee plan.",  # 17 tokens
+        "Benefit_Options-4.pdf: The deductible is $500.",  # 13 tokens
+    ]
+    budget = TokenBudget("gpt-35-turbo", 0, token_limit=30)
+    # Each source also takes a token for its newline, and lower ranked sources are dropped even if they'd fit
+    assert budget.pack_sources(sources) == sources[:1]
+    assert budget.dropped_sources == 2
+    assert budget.available == 30 - 14
+    budget = TokenBudget("gpt-35-turbo", 0, token_limit=100)
+    assert budget.pack_sources(sources) == sources
+    assert budget.dropped_sources == 0
+    budget = TokenBudget("gpt-35-turbo", 0, token_limit=100)
+    assert budget.pack_sources(sources, share=0.35) == sources[:2]
+    assert budget.available == 100 - 14 - 18
+
+
+def test_pack_history():
+    history = [
+        {"role": "user", "content": "What happens in a performance review?"},  # 10 tokens
+        {"role": "assistant", "content": "There is a dress code. [employee_handbook-1.pdf]"},  # 17 tokens
+        {"role": "user", "content": "Is there a dress code?"},  # 9 tokens
+    ]
+    budget = TokenBudget("gpt-35-turbo", 0, token_limit=30)
+    assert budget.pack_history(history) == history[1:]
+    assert budget.truncated_history == 1
+    assert budget.pack_history([]) == []
+    assert budget.truncated_history == 0
@@ -0,0 +1,88 @@
+import base64
+import json
+import sqlite3
+import time
+
+from msal import TokenCache
+
+from core.tokencache import SqliteTokenCache
+
+
+def token_event(uid: str, access_token: str, scope: str = "https://graph.microsoft.com/.default"):
+    client_info = base64.urlsafe_b64encode(json.dumps({"uid": uid, "utid": "tenant"}).encode()).decode()
+    return {
+        "client_id": "SERVER_APP",
+        "scope": [scope],
+        "token_endpoint": "https://login.microsoftonline.com/tenant/oauth2/v2.0/token",
+        "response": {
+            "access_token": access_token,
+            "refresh_token": "refresh-" + access_token,
+            "expires_in": 3600,
+            "client_info": client_info,
+        },
+    }
+
+
+def test_sqlitetokencache_find(tmp_path):
+    token_cache = SqliteTokenCache(str(tmp_path / "token_cache.db"))
+    token_cache.add(token_event("user1", "token1"))
+    token_cache.add(token_event("user2", "token2"))
+    token_cache.add(token_event("user2", "token3", scope="api://other/.default"))
+
+    access_tokens = token_cache.find(TokenCache.CredentialType.ACCESS_TOKEN)
+    assert sorted(token["secret"] for token in access_tokens) == ["token1", "token2", "token3"]
+    access_tokens = token_cache.find(
+        TokenCache.CredentialType.ACCESS_TOKEN,
+        target=["https://graph.microsoft.com/.default"],
+        query={"home_account_id": "user2.tenant"},
+    )
+    assert [token["secret"] for token in access_tokens] == ["token2"]
+    refresh_tokens = token_cache.find(TokenCache.CredentialType.REFRESH_TOKEN, query={"client_id": "SERVER_APP"})
+    assert len(refresh_tokens) == 3
+
+
+def test_sqlitetokencache_shared(tmp_path):
+    # Each worker process opens its own cache on the same database
+    worker1 = SqliteTokenCache(str(tmp_path / "token_cache.db"))
+    worker2 = SqliteTokenCache(str(tmp_path / "token_cache.db"))
+    worker1.add(token_event("user1", "token1"))
+    assert [token["secret"] for token in worker2.find(TokenCache.CredentialType.ACCESS_TOKEN)] == ["token1"]
+
+    # Replacing a token updates its row instead of adding one
+    worker2.add(token_event("user1", "token2"))
+    assert [token["secret"] for token in worker1.find(TokenCache.CredentialType.ACCESS_TOKEN)] == ["token2"]
+
+    worker1.remove_at(worker1.find(TokenCache.CredentialType.ACCESS_TOKEN)[0])
+    assert worker2.find(TokenCache.CredentialType.ACCESS_TOKEN) == []
+
+
+def test_sqlitetokencache_deletes_expired(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+    token_cache = SqliteTokenCache(str(tmp_path / "token_cache.db"), max_age=600)
+    expiring_event = token_event("user1", "token1")
+    expiring_event["response"]["expires_in"] = 60
+    token_cache.add(expiring_event)
+
+    # The expired access token is deleted by the next write, but the refresh token is kept until max_age
+    now[0] = 1100
+    token_cache.add(token_event("user2", "token2"))
+    assert [token["secret"] for token in token_cache.find(TokenCache.CredentialType.ACCESS_TOKEN)] == ["token2"]
+    assert len(token_cache.find(TokenCache.CredentialType.REFRESH_TOKEN)) == 2
+
+    now[0] = 1650
+    token_cache.add(token_event("user3", "token3"))
+    refresh_tokens = token_cache.find(TokenCache.CredentialType.REFRESH_TOKEN)
+    assert sorted(token["secret"] for token in refresh_tokens) == ["refresh-token2", "refresh-token3"]
+
+
+def test_sqlitetokencache_adds_expires_at(tmp_path):
+    path = str(tmp_path / "token_cache.db")
+    with sqlite3.connect(path) as connection:
+        connection.execute(
+            "CREATE TABLE tokens (credential_type TEXT NOT NULL, key TEXT NOT NULL, home_account_id TEXT, "
+            "entry TEXT NOT NULL, PRIMARY KEY (credential_type, key))"
+        )
+    token_cache = SqliteTokenCache(path)
+    token_cache.add(token_event("user1", "token1"))
+    assert [token["secret"] for token in token_cache.find(TokenCache.CredentialType.ACCESS_TOKEN)] == ["token1"]
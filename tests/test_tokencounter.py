@@ -0,0 +1,76 @@
+import os
+
+import tiktoken
+
+from core import tokencounter
+from core.tokencounter import TokenCounter
+
+
+def test_count():
+    counter = TokenCounter()
+    encoding = tiktoken.get_encoding("cl100k_base")
+    text = "What is the deductible for the employee plan for a visit to Overlake in Bellevue?"
+    assert counter.count(text, "cl100k_base") == len(encoding.encode(text))
+    assert counter.count(text, "cl100k_base") == len(encoding.encode(text))
+    assert (counter.hits, counter.misses) == (1, 1)
+    # Counts depend on the encoding
+    assert counter.count(text, "p50k_base") == len(tiktoken.get_encoding("p50k_base").encode(text))
+    assert counter.misses == 2
+
+
+def test_count_many():
+    counter = TokenCounter()
+    assert counter.count_many(["Hello", "Hello world", "Hello"], "cl100k_base") == [1, 2, 1]
+    assert (counter.hits, counter.misses) == (0, 3)
+    assert counter.count_many(["Hello world", "Goodbye"], "cl100k_base") == [2, 2]
+    assert (counter.hits, counter.misses) == (1, 4)
+    assert counter.count_many([], "cl100k_base") == []
+
+
+def test_count_many_batch(monkeypatch):
+    monkeypatch.setattr(tokencounter, "BATCH_THRESHOLD", 10)
+    encoding = tiktoken.get_encoding("cl100k_base")
+    encode_batch_calls = []
+    original_encode_batch = tiktoken.Encoding.encode_batch
+
+    def encode_batch(self, texts, **kwargs):
+        encode_batch_calls.append(texts)
+        return original_encode_batch(self, texts, **kwargs)
+
+    monkeypatch.setattr(tiktoken.Encoding, "encode_batch", encode_batch)
+    counter = TokenCounter()
+    texts = ["The capital of France is Paris.", "Overlake is in-network for the employee plan."]
+    assert counter.count_many(texts, "cl100k_base") == [len(encoding.encode(text)) for text in texts]
+    assert encode_batch_calls == [texts]
+    # Short texts are encoded one by one
+    assert counter.count_many(["Hi"], "cl100k_base") == [1]
+    assert len(encode_batch_calls) == 1
+
+
+def test_count_evicts_least_recently_used():
+    counter = TokenCounter(max_entries=2)
+    counter.count("a", "cl100k_base")
+    counter.count("b", "cl100k_base")
+    counter.count("a", "cl100k_base")
+    counter.count("c", "cl100k_base")
+    assert len(counter.counts) == 2
+    assert TokenCounter.make_key("cl100k_base", "a") in counter.counts
+    assert TokenCounter.make_key("cl100k_base", "b") not in counter.counts
+
+
+def test_use_bundled_cache(monkeypatch, tmp_path):
+    monkeypatch.delenv("TIKTOKEN_CACHE_DIR", raising=False)
+    monkeypatch.delenv("DATA_GYM_CACHE_DIR", raising=False)
+    monkeypatch.setattr(tokencounter, "BUNDLED_CACHE_DIR", str(tmp_path / "missing"))
+    assert not tokencounter.use_bundled_cache()
+    assert "TIKTOKEN_CACHE_DIR" not in os.environ
+    monkeypatch.setattr(tokencounter, "BUNDLED_CACHE_DIR", str(tmp_path))
+    assert tokencounter.use_bundled_cache()
+    assert os.environ["TIKTOKEN_CACHE_DIR"] == str(tmp_path)
+
+
+def test_use_bundled_cache_configured(monkeypatch, tmp_path):
+    monkeypatch.setenv("TIKTOKEN_CACHE_DIR", "/var/cache/tiktoken")
+    monkeypatch.setattr(tokencounter, "BUNDLED_CACHE_DIR", str(tmp_path))
+    assert not tokencounter.use_bundled_cache()
+    assert os.environ["TIKTOKEN_CACHE_DIR"] == "/var/cache/tiktoken"